@@ -0,0 +1,288 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+# Benchmark sin cuentas reales: arranca los simuladores de Cloudflare y Unifi, carga la aplicación
+# contra ellos y envía webhooks DOWN/UP sintéticos a /api/route para distintos tamaños de zonas.json.
+#
+#   python benchmark/benchmark.py --zonas 1,10,100,1000 --latencia 0.02 --limite 0.01
+#   python benchmark/benchmark.py --comparar resultados-anteriores.json
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simuladores import CloudflareSimulado, Fallos, UnifiSimulado  # noqa: E402
+
+NOMBRE_PBR = 'benchmark-pbr'
+
+def parsear_argumentos() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(description="Benchmark de failover con servidores simulados de Cloudflare y Unifi")
+    parser.add_argument('--zonas', default='1,10,100,1000', help="Tamaños de zonas.json a medir, separados por comas")
+    parser.add_argument('--registros-por-zona', type=int, default=1, help="Registros de zonas.json en cada zona de Cloudflare")
+    parser.add_argument('--eventos', type=int, default=6, help="Webhooks (DOWN/UP alternos) por tamaño")
+    parser.add_argument('--latencia', type=float, default=0.02, help="Latencia media de los simuladores en segundos")
+    parser.add_argument('--variacion', type=float, default=0.005, help="Variación aleatoria de la latencia en segundos")
+    parser.add_argument('--errores', type=float, default=0.0, help="Probabilidad de responder 503")
+    parser.add_argument('--limite', type=float, default=0.0, help="Probabilidad de responder 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After de las respuestas 429")
+    parser.add_argument('--cupo-cloudflare', type=int, default=1000000,
+                        help="CLOUDFLARE_LIMITE durante el benchmark (1200 para medir con el cupo real)")
+    parser.add_argument('--batch', action='store_true', help="Usar CLOUDFLARE_BATCH=1")
+    parser.add_argument('--concurrencia', type=int, default=None, help="CONCURRENCIA_ZONAS durante el benchmark")
+    parser.add_argument('--sin-unifi', action='store_true', help="No simular Unifi")
+    parser.add_argument('--salida', default=None, help="Fichero JSON de resultados (por defecto benchmark/resultados-<fecha>.json)")
+    parser.add_argument('--comparar', default=None, help="Resultados anteriores con los que comparar")
+    return parser.parse_args()
+
+def generar_certificado(directorio: str) -> Optional[Tuple[str, str]]:
+    # Unifi solo se usa por HTTPS: certificado autofirmado con openssl para el simulador.
+
+    certificado, clave = os.path.join(directorio, 'cert.pem'), os.path.join(directorio, 'key.pem')
+    try:
+        subprocess.run(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+             '-subj', '/CN=127.0.0.1', '-keyout', clave, '-out', certificado],
+            check=True, capture_output=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"No se pudo generar el certificado para el simulador de Unifi ({e}). Se omite Unifi.", file=sys.stderr)
+        return None
+    return certificado, clave
+
+def cargar_aplicacion(args: argparse.Namespace, directorio: str, cloudflare: CloudflareSimulado,
+                      unifi: Optional[UnifiSimulado]):
+    # Configura el entorno antes de importar config.py y redirige los ficheros de /app/data al
+    # directorio temporal antes de cargar la aplicación.
+
+    os.environ.update({
+        'CLOUDFLARE_API_URL': f"{cloudflare.url}/client/v4",
+        'CLOUDFLARE_API_TOKEN': 'benchmark',
+        'CLOUDFLARE_LIMITE': str(args.cupo_cloudflare),
+        'CLOUDFLARE_RAFAGA': str(max(20, args.cupo_cloudflare // 60)),
+        'CLOUDFLARE_BATCH': '1' if args.batch else '0',
+        'DEBOUNCE_SEGUNDOS': '0',
+        'DEBUG': '0',
+    })
+    if args.concurrencia:
+        os.environ['CONCURRENCIA_ZONAS'] = str(args.concurrencia)
+    if unifi:
+        os.environ.update({'UNIFI_URL': unifi.url, 'UNIFI_API_TOKEN': 'benchmark', 'NOMBRE_PBR': NOMBRE_PBR})
+    else:
+        for variable in ('UNIFI_URL', 'UNIFI_API_TOKEN', 'NOMBRE_PBR'):
+            os.environ.pop(variable, None)
+
+    import bloqueos
+    import config
+    import enrutado
+    import estado_registros
+    import ip_info
+    import plan_zonas
+    import trazas
+
+    fichero_rutas = os.path.join(directorio, 'rutas.json')
+    config.FICHERO_RUTAS = enrutado.FICHERO_RUTAS = fichero_rutas
+    plan_zonas.FICHERO_ZONAS = os.path.join(directorio, 'zonas.json')
+    estado_registros.almacen_estado.ruta = os.path.join(directorio, 'estado.db')
+    bloqueos.DIRECTORIO_BLOQUEOS = os.path.join(directorio, 'bloqueos')
+    trazas.exportador.fichero = os.path.join(directorio, 'trazas.jsonl')
+    fichero_ip = os.path.join(directorio, 'check_ip.txt')
+    with open(fichero_ip, 'w') as f:
+        f.write(f"{cloudflare.url}/ip\n")
+    ip_info.FICHEROS_URLS[4] = fichero_ip
+
+    escribir_zonas(plan_zonas.FICHERO_ZONAS, cloudflare, 1, 1, 'arranque')
+
+    spec = importlib.util.spec_from_file_location('aplicacion', os.path.join(RAIZ, 'unifi-pbr-cloudflare.py'))
+    aplicacion = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(aplicacion)
+    return aplicacion, plan_zonas.FICHERO_ZONAS
+
+def escribir_zonas(fichero: str, cloudflare: CloudflareSimulado, total: int, por_zona: int, prefijo: str):
+    # Genera zonas.json con `total` registros A (cambiar_ip y cambiar_proxied) y sus zonas en el simulador.
+
+    zonas: Dict[str, List[Dict[str, Any]]] = {}
+    entradas = []
+    for i in range(total):
+        zone_id = f"{prefijo}-z{i // por_zona}"
+        nombre = f"h{i}.{zone_id}.example"
+        zonas.setdefault(zone_id, []).append({
+            "id": f"{prefijo}-r{i}", "type": "A", "name": nombre,
+            "content": "198.51.100.1", "proxied": True, "ttl": 1
+        })
+        entradas.append({"id_zona": zone_id, "nombre": nombre, "cambiar_ip": True, "cambiar_proxied": True})
+
+    cloudflare.cargar_zonas(zonas)
+    with open(fichero, 'w') as f:
+        json.dump(entradas, f)
+    # El plan se recompila por fecha de modificación: nos aseguramos de que cambie aunque se
+    # escriba dos veces en el mismo instante
+    escribir_zonas.secuencia += 1
+    os.utime(fichero, (time.time(), time.time() + escribir_zonas.secuencia))
+
+escribir_zonas.secuencia = 0
+
+def percentil(valores: List[float], p: float) -> float:
+
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return ordenados[indice]
+
+def medir(aplicacion, eventos: int, servicios: Tuple[str, ...]) -> Tuple[List[float], int, float]:
+    # Envía los webhooks de uno en uno y espera a que termine cada trabajo.
+    # Devuelve (latencias de cada evento, trabajos con error, duración total).
+
+    cliente = aplicacion.app.test_client()
+    latencias = []
+    fallidos = 0
+    inicio = time.perf_counter()
+    for i in range(eventos):
+        status = 0 if i % 2 == 0 else 1
+        respuesta = cliente.post('/api/route', json={
+            "heartbeat": {"status": status},
+            "monitor": {"id": 1, "name": "benchmark"},
+            "msg": "benchmark"
+        })
+        trabajo_id = respuesta.get_json()['job_id']
+        while True:
+            trabajo = aplicacion.cola_trabajos.obtener(trabajo_id)
+            if trabajo and trabajo['estado'] in ('completado', 'error'):
+                break
+            time.sleep(0.002)
+        latencias.append(trabajo['fin'] - trabajo['creado'])
+        resultado = trabajo.get('resultado') or {}
+        if trabajo['estado'] == 'error' or not all(
+                (resultado.get(servicio) or {}).get('processed', False) for servicio in servicios):
+            fallidos += 1
+    return latencias, fallidos, time.perf_counter() - inicio
+
+def ejecutar(args: argparse.Namespace) -> Dict[str, Any]:
+
+    fallos = Fallos(args.latencia, args.variacion, args.errores, args.limite, args.retry_after)
+    directorio = tempfile.mkdtemp(prefix='benchmark-unifi-pbr-')
+    cloudflare = CloudflareSimulado(fallos).iniciar()
+    unifi = None
+    if not args.sin_unifi:
+        certificado = generar_certificado(directorio)
+        if certificado:
+            unifi = UnifiSimulado(fallos, certificado).iniciar()
+            unifi.cargar_rutas([NOMBRE_PBR])
+
+    try:
+        aplicacion, fichero_zonas = cargar_aplicacion(args, directorio, cloudflare, unifi)
+        resultados = []
+        for total in [int(z) for z in args.zonas.split(',') if z.strip()]:
+            escribir_zonas(fichero_zonas, cloudflare, total, args.registros_por_zona, f"n{total}")
+            # Cada tamaño empieza con las caches de validación frías para contar también esas llamadas
+            aplicacion.cache_validacion.invalidar()
+            cloudflare.reiniciar_contadores()
+            if unifi:
+                unifi.reiniciar_contadores()
+
+            latencias, fallidos, duracion = medir(aplicacion, args.eventos, ('cloudflare', 'unifi') if unifi else ('cloudflare',))
+            resultado = {
+                "registros": total,
+                "zonas_cloudflare": -(-total // args.registros_por_zona),
+                "eventos": args.eventos,
+                "eventos_fallidos": fallidos,
+                "duracion_segundos": round(duracion, 4),
+                "eventos_por_segundo": round(args.eventos / duracion, 3),
+                "registros_por_segundo": round(total * args.eventos / duracion, 3),
+                "latencia_segundos": {
+                    "p50": round(percentil(latencias, 50), 4),
+                    "p99": round(percentil(latencias, 99), 4),
+                    "media": round(sum(latencias) / len(latencias), 4),
+                    "max": round(max(latencias), 4),
+                },
+                "llamadas": {"cloudflare": cloudflare.contadores()},
+            }
+            if unifi:
+                resultado["llamadas"]["unifi"] = unifi.contadores()
+            resultados.append(resultado)
+            imprimir_fila(resultado)
+    finally:
+        cloudflare.detener()
+        if unifi:
+            unifi.detener()
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    return {
+        "version": os.getenv('VERSION') or version_git(),
+        "fecha": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "parametros": {
+            "latencia": args.latencia, "variacion": args.variacion, "errores": args.errores,
+            "limite": args.limite, "retry_after": args.retry_after, "eventos": args.eventos,
+            "registros_por_zona": args.registros_por_zona, "cupo_cloudflare": args.cupo_cloudflare,
+            "batch": args.batch, "concurrencia": args.concurrencia, "unifi": unifi is not None,
+        },
+        "resultados": resultados,
+    }
+
+def version_git() -> Optional[str]:
+
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=RAIZ,
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def imprimir_fila(r: Dict[str, Any]):
+
+    llamadas = r["llamadas"]["cloudflare"]
+    print(f"{r['registros']:>6} registros | {r['eventos_por_segundo']:>8} ev/s | "
+          f"p50 {r['latencia_segundos']['p50']:>7}s | p99 {r['latencia_segundos']['p99']:>7}s | "
+          f"cloudflare {llamadas['total']:>6} llamadas {llamadas['inyectados'] or ''} | "
+          f"unifi {r['llamadas'].get('unifi', {}).get('total', '-')} | fallidos {r['eventos_fallidos']}")
+
+def comparar(actual: Dict[str, Any], fichero: str):
+    # Variación respecto a una ejecución anterior para cada tamaño medido en ambas.
+
+    with open(fichero, 'r') as f:
+        anterior = json.load(f)
+    previos = {r["registros"]: r for r in anterior.get("resultados", [])}
+    print(f"\nComparación con {fichero} (versión {anterior.get('version')}):")
+    for r in actual["resultados"]:
+        previo = previos.get(r["registros"])
+        if previo is None:
+            continue
+
+        def variacion(a: float, b: float) -> str:
+            return f"{(a - b) / b * 100:+.1f}%" if b else "-"
+
+        print(f"{r['registros']:>6} registros | p50 {variacion(r['latencia_segundos']['p50'], previo['latencia_segundos']['p50'])} | "
+              f"p99 {variacion(r['latencia_segundos']['p99'], previo['latencia_segundos']['p99'])} | "
+              f"ev/s {variacion(r['eventos_por_segundo'], previo['eventos_por_segundo'])} | "
+              f"llamadas cloudflare {variacion(r['llamadas']['cloudflare']['total'], previo['llamadas']['cloudflare']['total'])}")
+
+def main():
+
+    args = parsear_argumentos()
+    informe = ejecutar(args)
+
+    salida = args.salida or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         f"resultados-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(salida, 'w') as f:
+        json.dump(informe, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados guardados en {salida}")
+
+    if args.comparar:
+        comparar(informe, args.comparar)
+
+    # Los hilos en segundo plano de la aplicación (caches, notificaciones) no deben retener el proceso
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
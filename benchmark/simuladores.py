@@ -0,0 +1,279 @@
+import hashlib
+import json
+import random
+import re
+import ssl
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+# Servidores locales que imitan las APIs de Cloudflare v4 y de Unifi que usa la aplicación,
+# con latencia, errores 5xx y respuestas 429 configurables. Solo para el benchmark y las pruebas.
+
+_RUTA_CLOUDFLARE = re.compile(r'^/client/v4/zones/([^/]+)(/dns_records)?(?:/([^/]+))?$')
+_RUTA_UNIFI = re.compile(r'^/proxy/network/v2/api/site/([^/]+)/trafficroutes(?:/([^/]+))?$')
+
+class Fallos:
+    # Comportamiento inyectado en cada respuesta.
+
+    def __init__(self, latencia: float = 0.0, variacion: float = 0.0, errores: float = 0.0,
+                 limite: float = 0.0, retry_after: int = 1):
+        self.latencia = latencia
+        self.variacion = variacion
+        self.errores = errores
+        self.limite = limite
+        self.retry_after = retry_after
+
+class ServidorSimulado(ABC):
+    # Servidor HTTP (o HTTPS con certificado) en un hilo, con contadores de llamadas por endpoint.
+
+    servicio = ''
+
+    def __init__(self, fallos: Fallos, certificado: Optional[Tuple[str, str]] = None):
+        self.fallos = fallos
+        self.llamadas: Counter = Counter()
+        self.inyectados: Counter = Counter()
+        self._lock = threading.Lock()
+
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _atender(self):
+                servidor._atender(self)
+
+            do_GET = do_PUT = do_POST = do_PATCH = _atender
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Manejador)
+        self._httpd.daemon_threads = True
+        self.esquema = 'http'
+        if certificado:
+            contexto = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            contexto.load_cert_chain(*certificado)
+            self._httpd.socket = contexto.wrap_socket(self._httpd.socket, server_side=True)
+            self.esquema = 'https'
+        self._hilo = threading.Thread(target=self._httpd.serve_forever, name=f"simulador-{self.servicio}", daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"{self.esquema}://127.0.0.1:{self._httpd.server_address[1]}"
+
+    def iniciar(self) -> "ServidorSimulado":
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reiniciar_contadores(self):
+        with self._lock:
+            self.llamadas.clear()
+            self.inyectados.clear()
+
+    def contadores(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "total": sum(self.llamadas.values()),
+                "por_endpoint": dict(sorted(self.llamadas.items())),
+                "inyectados": dict(self.inyectados),
+            }
+
+    def _atender(self, peticion: BaseHTTPRequestHandler):
+
+        url = urlparse(peticion.path)
+        longitud = int(peticion.headers.get('Content-Length') or 0)
+        cuerpo = json.loads(peticion.rfile.read(longitud) or b'{}') if longitud else {}
+
+        if self.fallos.latencia or self.fallos.variacion:
+            time.sleep(max(0.0, self.fallos.latencia + random.uniform(-self.fallos.variacion, self.fallos.variacion)))
+
+        endpoint = self.clasificar(url.path)
+        inyectado = None
+        with self._lock:
+            self.llamadas[f"{peticion.command} {endpoint}"] += 1
+            # Los fallos se inyectan antes de aplicar nada, como haría la API real
+            if endpoint not in ('ip', 'desconocido'):
+                if random.random() < self.fallos.limite:
+                    self.inyectados['429'] += 1
+                    inyectado = 429, {"success": False, "errors": [{"code": 10000}]}, \
+                        {'Retry-After': str(self.fallos.retry_after)}
+                elif random.random() < self.fallos.errores:
+                    self.inyectados['5xx'] += 1
+                    inyectado = 503, {"success": False, "errors": [{"code": 10001}]}, {}
+
+        if inyectado:
+            codigo, respuesta, cabeceras = inyectado
+        else:
+            codigo, respuesta, cabeceras = self.responder(peticion.command, url.path, parse_qs(url.query),
+                                                         cuerpo, peticion.headers)
+
+        if isinstance(respuesta, (dict, list)):
+            datos = json.dumps(respuesta).encode()
+            tipo = 'application/json'
+        else:
+            datos = (respuesta or '').encode()
+            tipo = 'text/plain'
+
+        peticion.send_response(codigo)
+        peticion.send_header('Content-Type', tipo)
+        peticion.send_header('Content-Length', str(len(datos)))
+        for nombre, valor in cabeceras.items():
+            peticion.send_header(nombre, valor)
+        peticion.end_headers()
+        if codigo != 304:
+            peticion.wfile.write(datos)
+
+    @abstractmethod
+    def clasificar(self, ruta: str) -> str:
+        # Nombre del endpoint para los contadores.
+        ...
+
+    @abstractmethod
+    def responder(self, metodo: str, ruta: str, consulta: Dict[str, List[str]], cuerpo: Any,
+                  cabeceras) -> Tuple[int, Any, Dict[str, str]]:
+        # (código, cuerpo JSON o texto, cabeceras) de la respuesta.
+        ...
+
+class CloudflareSimulado(ServidorSimulado):
+    # tokens/verify, zones/<id>, dns_records (listado paginado con ETag, por id, PATCH y batch)
+    # y /ip para los proveedores de IP pública.
+
+    servicio = 'cloudflare'
+
+    def __init__(self, fallos: Fallos, ip_publica: str = '203.0.113.10'):
+        super().__init__(fallos)
+        self.ip_publica = ip_publica
+        self.zonas: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # Con etag = False el listado no devuelve ETag y nunca responde 304
+        self.etag = True
+
+    def cargar_zonas(self, zonas: Dict[str, List[Dict[str, Any]]]):
+        with self._lock:
+            self.zonas = {zone_id: {r['id']: dict(r) for r in registros} for zone_id, registros in zonas.items()}
+
+    def clasificar(self, ruta: str) -> str:
+
+        if ruta == '/ip':
+            return 'ip'
+        if ruta == '/client/v4/user/tokens/verify':
+            return 'tokens/verify'
+        m = _RUTA_CLOUDFLARE.match(ruta)
+        if not m:
+            return 'desconocido'
+        _, dns, registro_id = m.groups()
+        if not dns:
+            return 'zones'
+        if registro_id is None:
+            return 'dns_records'
+        return 'dns_records/batch' if registro_id == 'batch' else 'dns_records/id'
+
+    def responder(self, metodo, ruta, consulta, cuerpo, cabeceras):
+
+        if ruta == '/ip':
+            return 200, self.ip_publica, {}
+        if ruta == '/client/v4/user/tokens/verify':
+            return 200, {"success": True, "result": {"status": "active"}}, {}
+
+        m = _RUTA_CLOUDFLARE.match(ruta)
+        if not m:
+            return 404, {"success": False}, {}
+        zone_id, dns, registro_id = m.groups()
+
+        with self._lock:
+            zona = self.zonas.get(zone_id)
+            if zona is None:
+                return 404, {"success": False, "errors": [{"code": 1001}]}, {}
+
+            if not dns:
+                return 200, {"success": True, "result": {"id": zone_id, "name": f"{zone_id}.example", "status": "active"}}, {}
+
+            if registro_id is None:
+                return self._listar(zone_id, zona, consulta, cabeceras)
+
+            if registro_id == 'batch' and metodo == 'POST':
+                resultado = []
+                for cambio in cuerpo.get('patches') or []:
+                    registro = zona.get(cambio.get('id'))
+                    if registro is None:
+                        return 400, {"success": False, "errors": [{"code": 81044}]}, {}
+                    registro.update({k: v for k, v in cambio.items() if k != 'id'})
+                    resultado.append(dict(registro))
+                return 200, {"success": True, "result": {"patches": resultado}}, {}
+
+            registro = zona.get(registro_id)
+            if registro is None:
+                return 404, {"success": False, "errors": [{"code": 81044}]}, {}
+            if metodo in ('PATCH', 'PUT'):
+                registro.update({k: v for k, v in cuerpo.items() if k != 'id'})
+            return 200, {"success": True, "result": dict(registro)}, {}
+
+    def _listar(self, zone_id, zona, consulta, cabeceras) -> Tuple[int, Any, Dict[str, str]]:
+        # Como la API real, el ETag de cada página depende de su contenido (incluido result_info).
+
+        registros = list(zona.values())
+        if 'type' in consulta:
+            registros = [r for r in registros if r['type'] == consulta['type'][0]]
+        if 'name' in consulta:
+            registros = [r for r in registros if r['name'] == consulta['name'][0]]
+        por_pagina = int(consulta.get('per_page', ['100'])[0])
+        pagina = int(consulta.get('page', ['1'])[0])
+        trozo = registros[(pagina - 1) * por_pagina:pagina * por_pagina]
+        paginas = max(1, -(-len(registros) // por_pagina))
+        cuerpo = {
+            "success": True,
+            "result": [dict(r) for r in trozo],
+            "result_info": {"page": pagina, "per_page": por_pagina, "count": len(trozo),
+                            "total_count": len(registros), "total_pages": paginas},
+        }
+        if not self.etag:
+            return 200, cuerpo, {}
+        etag = '"%s"' % hashlib.sha1(json.dumps(cuerpo, sort_keys=True).encode()).hexdigest()
+        if cabeceras.get('If-None-Match') == etag:
+            return 304, None, {'ETag': etag}
+        return 200, cuerpo, {'ETag': etag}
+
+class UnifiSimulado(ServidorSimulado):
+    # /proxy/network/v2/api/site/<sitio>/trafficroutes (listado y PUT por _id), siempre por HTTPS.
+
+    servicio = 'unifi'
+
+    def __init__(self, fallos: Fallos, certificado: Tuple[str, str]):
+        super().__init__(fallos, certificado)
+        self.rutas: List[Dict[str, Any]] = []
+
+    def cargar_rutas(self, descripciones: List[str]):
+        with self._lock:
+            self.rutas = [{"_id": f"ruta{i}", "description": d, "enabled": False} for i, d in enumerate(descripciones)]
+
+    def clasificar(self, ruta: str) -> str:
+
+        m = _RUTA_UNIFI.match(ruta)
+        if not m:
+            return 'desconocido'
+        return 'trafficroutes' if m.group(2) is None else 'trafficroutes/id'
+
+    def responder(self, metodo, ruta, consulta, cuerpo, cabeceras):
+
+        m = _RUTA_UNIFI.match(ruta)
+        if not m:
+            return 404, {}, {}
+        _, ruta_id = m.groups()
+
+        with self._lock:
+            if ruta_id is None:
+                return 200, [dict(r) for r in self.rutas], {}
+            for existente in self.rutas:
+                if existente['_id'] == ruta_id:
+                    if metodo == 'PUT':
+                        existente.update(cuerpo)
+                    return 200, dict(existente), {}
+            return 404, {}, {}
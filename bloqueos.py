@@ -0,0 +1,44 @@
+import fcntl
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+DIRECTORIO_BLOQUEOS = '/app/data/bloqueos'
+
+_lock = threading.Lock()
+_directorio_creado = False
+
+def _ruta(nombre: str) -> str:
+    # El nombre puede ser el de un monitor, así que el fichero se nombra con su hash
+
+    global _directorio_creado
+    with _lock:
+        if not _directorio_creado:
+            os.makedirs(DIRECTORIO_BLOQUEOS, exist_ok=True)
+            _directorio_creado = True
+    return os.path.join(DIRECTORIO_BLOQUEOS, hashlib.sha256(nombre.encode()).hexdigest()[:32] + '.lock')
+
+@contextmanager
+def bloqueo_exclusivo(nombre: str, esperar: bool = True):
+    # Bloqueo entre procesos (y entre hilos, cada uno abre su propio descriptor) con flock.
+    # El sistema lo libera si el worker muere, así que nunca queda un bloqueo huérfano.
+    # Devuelve si se ha obtenido: con esperar=False no se espera si lo tiene otro.
+
+    with open(_ruta(nombre), 'a') as fichero:
+        try:
+            fcntl.flock(fichero, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not esperar:
+                yield False
+                return
+            logger.debug(f"Esperando el bloqueo {nombre}, lo tiene otro worker")
+            fcntl.flock(fichero, fcntl.LOCK_EX)
+        try:
+            yield True
+        finally:
+            fcntl.flock(fichero, fcntl.LOCK_UN)
@@ -0,0 +1,217 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from config import CLOUDFLARE_API_URL, DNS_CACHE_TTL
+from http_client import CLOUDFLARE, obtener_sesion
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+REGISTROS_POR_PAGINA = 1000
+
+Clave = Tuple[str, str]
+
+class SnapshotZona:
+    # Índice (tipo, nombre) -> registro de todos los registros DNS de una zona. Guarda también cada
+    # página del listado con su ETag para revalidarlas una a una.
+
+    def __init__(self, paginas: List[List[Dict[str, Any]]], etags: List[Optional[str]], total: Optional[int]):
+        self.indice: Dict[Clave, Dict[str, Any]] = {}
+        self.paginas = paginas
+        self.etags = etags
+        self.total = total
+        self.cargado = time.monotonic()
+        for registros in paginas:
+            for registro in registros:
+                # Si hay varios registros con el mismo tipo y nombre nos quedamos con el primero, como la API filtrada
+                self.indice.setdefault(_clave(registro.get('type', ''), registro.get('name', '')), registro)
+
+    def caducado(self) -> bool:
+        return time.monotonic() - self.cargado > DNS_CACHE_TTL
+
+def _clave(tipo: str, nombre: str) -> Clave:
+    return tipo.upper(), nombre.lower().rstrip('.')
+
+class CacheRegistrosDNS:
+    # Cache por zona de los registros DNS de Cloudflare, cargada con un único listado paginado.
+
+    def __init__(self):
+        self._zonas: Dict[str, SnapshotZona] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.cargas = 0
+        self.sin_cambios = 0
+        self.recargas_completas = 0
+        self.sin_etag = 0
+        self._zonas_sin_etag: Set[str] = set()
+
+    def _lock_zona(self, zone_id: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(zone_id, threading.Lock())
+
+    def obtener(self, headers: Dict[str, str], zone_id: str, tipo: str, nombre: str,
+                desde: Optional[float] = None) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        # Devuelve (snapshot_disponible, registro). Si no hay snapshot el llamante debe consultar la API.
+
+        snapshot = self.snapshot(headers, zone_id, desde)
+        if snapshot is None:
+            return False, None
+
+        registro = snapshot.indice.get(_clave(tipo, nombre))
+        return True, dict(registro) if registro else None
+
+    def snapshot(self, headers: Dict[str, str], zone_id: str, desde: Optional[float] = None) -> Optional[SnapshotZona]:
+        # Con desde (time.monotonic()) el snapshot cargado antes de ese instante se revalida aunque no
+        # haya caducado. Las escrituras lo usan porque otros workers, o cambios a mano, modifican la zona
+        # sin pasar por este snapshot. Si la zona no ha cambiado la revalidación es un listado condicional
+        # (ETag) que responde 304, y los hilos de una misma ejecución la hacen una sola vez por zona.
+
+        def vigente(s: Optional[SnapshotZona]) -> bool:
+            return s is not None and not s.caducado() and (desde is None or s.cargado >= desde)
+
+        snapshot = self._zonas.get(zone_id)
+        if vigente(snapshot):
+            return snapshot
+
+        # Un único hilo por zona recarga el snapshot, el resto espera y reutiliza el resultado
+        with self._lock_zona(zone_id):
+            snapshot = self._zonas.get(zone_id)
+            if vigente(snapshot):
+                return snapshot
+
+            nuevo = self._cargar_zona(headers, zone_id, snapshot)
+            if nuevo is not None:
+                self._zonas[zone_id] = nuevo
+            return nuevo
+
+    def _cargar_zona(self, headers: Dict[str, str], zone_id: str,
+                     anterior: Optional[SnapshotZona]) -> Optional[SnapshotZona]:
+        # Cada página del snapshot anterior se revalida con su propio ETag: un 304 en la primera no
+        # dice nada de las siguientes en zonas de más de REGISTROS_POR_PAGINA registros. Si total_count
+        # cambia las páginas se desplazan, así que se descartan los ETag y se recarga el listado entero.
+
+        try:
+            nuevo, recargar = self._listar_paginas(headers, zone_id, anterior)
+            if recargar:
+                with self._lock:
+                    self.recargas_completas += 1
+                logger.debug("El número de registros de la zona %s ha cambiado, recargando todas sus páginas", zone_id)
+                nuevo, _ = self._listar_paginas(headers, zone_id, None)
+        except Exception as e:
+            logger.error(f"Error inesperado al listar registros DNS de la zona {zone_id}: {e}")
+            return None
+        return nuevo
+
+    def _listar_paginas(self, headers: Dict[str, str], zone_id: str,
+                        anterior: Optional[SnapshotZona]) -> Tuple[Optional[SnapshotZona], bool]:
+        # Devuelve (snapshot o None si no se puede listar la zona, si hay que recargarla entera porque
+        # total_count no coincide con el del snapshot anterior).
+
+        url = f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records"
+        sesion = obtener_sesion(CLOUDFLARE)
+        paginas: List[List[Dict[str, Any]]] = []
+        etags: List[Optional[str]] = []
+        total = anterior.total if anterior is not None else None
+        total_paginas = len(anterior.paginas) if anterior is not None else 1
+        cambios = False
+        pagina = 1
+
+        while pagina <= total_paginas:
+            cabeceras = dict(headers)
+            etag_anterior = anterior.etags[pagina - 1] if anterior is not None and pagina <= len(anterior.etags) else None
+            if etag_anterior:
+                cabeceras['If-None-Match'] = etag_anterior
+
+            response = sesion.get(url, headers=cabeceras,
+                                  params={'page': pagina, 'per_page': REGISTROS_POR_PAGINA})
+
+            if response.status_code == 304 and etag_anterior:
+                paginas.append(anterior.paginas[pagina - 1])
+                etags.append(etag_anterior)
+                pagina += 1
+                continue
+
+            if response.status_code != 200:
+                logger.error(f"Error al listar registros DNS de la zona {zone_id}: Status={response.status_code}, Response={response.text}")
+                return None, False
+
+            etag = response.headers.get('ETag')
+            if not etag:
+                self._sin_etag(zone_id)
+
+            datos = response.json()
+            info = datos.get('result_info') or {}
+            if anterior is not None and info.get('total_count', total) != total:
+                return None, True
+
+            total = info.get('total_count', total)
+            total_paginas = info.get('total_pages', 1)
+            paginas.append(datos.get('result') or [])
+            etags.append(etag)
+            cambios = True
+            pagina += 1
+
+        if anterior is not None and not cambios:
+            logger.debug("Snapshot DNS de la zona %s sin cambios (%s páginas con 304)", zone_id, len(paginas))
+            with self._lock:
+                self.sin_cambios += 1
+            anterior.cargado = time.monotonic()
+            return anterior, False
+
+        with self._lock:
+            self.cargas += 1
+        logger.debug("Snapshot DNS de la zona %s cargado: %s registros en %s páginas",
+                     zone_id, sum(len(registros) for registros in paginas), len(paginas))
+        return SnapshotZona(paginas, etags, total), False
+
+    def _sin_etag(self, zone_id: str):
+        # Sin ETag cada revalidación descarga la página completa: se avisa una vez por zona y se cuenta.
+
+        with self._lock:
+            self.sin_etag += 1
+            primera = zone_id not in self._zonas_sin_etag
+            self._zonas_sin_etag.add(zone_id)
+        if primera:
+            logger.warning(f"Cloudflare no ha devuelto ETag al listar la zona {zone_id}: sus revalidaciones no serán condicionales")
+
+    def actualizar(self, zone_id: str, registro: Optional[Dict[str, Any]]):
+        # Actualiza el snapshot con el registro devuelto por Cloudflare tras un PUT.
+
+        snapshot = self._zonas.get(zone_id)
+        if snapshot is None or not registro:
+            return
+
+        clave = _clave(registro.get('type', ''), registro.get('name', ''))
+        # Los cambios de nombre o tipo dejan la clave anterior huérfana, la eliminamos
+        for otra, existente in list(snapshot.indice.items()):
+            if existente.get('id') == registro.get('id') and otra != clave:
+                del snapshot.indice[otra]
+        snapshot.indice[clave] = registro
+
+        # La página guardada ya no refleja el registro: sin su ETag la siguiente revalidación la descarga.
+        # Si otro worker deja la página como estaba al cargarla, su ETag vuelve a coincidir y un 304
+        # dejaría en el índice este cambio que ya no existe.
+        for i, registros in enumerate(snapshot.paginas):
+            if any(existente.get('id') == registro.get('id') for existente in registros):
+                snapshot.etags[i] = None
+
+    def estadisticas(self) -> Dict[str, int]:
+
+        with self._lock:
+            return {
+                "zonas": len(self._zonas),
+                "cargas": self.cargas,
+                "sin_cambios": self.sin_cambios,
+                "recargas_completas": self.recargas_completas,
+                "sin_etag": self.sin_etag,
+            }
+
+    def invalidar(self, zone_id: Optional[str] = None):
+
+        if zone_id is None:
+            self._zonas.clear()
+        else:
+            self._zonas.pop(zone_id, None)
+
+cache_dns = CacheRegistrosDNS()
@@ -0,0 +1,122 @@
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import VALIDACION_CACHE_TTL, VALIDACION_REFRESCO
+from http_client import CLOUDFLARE, obtener_sesion
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+CLAVE_TOKEN = 'token'
+
+# Solo la propia zona o su listado de registros: un 404 de un registro concreto no invalida la zona
+_patron_zona = re.compile(r'/zones/([^/?]+)(?:/dns_records)?(?:\?|$)')
+
+def clave_zona(zone_id: str) -> str:
+    return f"zona:{zone_id}"
+
+class CacheValidacion:
+    # Cache en memoria de comprobaciones (token, zonas) con caducidad y refresco en segundo plano.
+
+    def __init__(self, ttl: int, refresco: bool):
+        self.ttl = ttl
+        self.refresco = refresco
+        self.hits = 0
+        self.misses = 0
+        self.invalidaciones = 0
+        self.refrescos = 0
+        self._entradas: Dict[str, Tuple[Any, float, Callable[[], Any]]] = {}
+        self._lock = threading.Lock()
+        self._hilo: Optional[threading.Thread] = None
+
+    def obtener(self, clave: str, cargar: Callable[[], Any]) -> Any:
+        # Devuelve el valor cacheado o lo calcula con cargar(). Los resultados falsos no se cachean.
+
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and entrada[1] > time.monotonic():
+                self.hits += 1
+                return entrada[0]
+            self.misses += 1
+
+        valor = cargar()
+        if valor:
+            with self._lock:
+                self._entradas[clave] = (valor, time.monotonic() + self.ttl, cargar)
+            self._arrancar_refresco()
+        return valor
+
+    def invalidar(self, clave: Optional[str] = None):
+
+        with self._lock:
+            if clave is None:
+                eliminadas = len(self._entradas)
+                self._entradas.clear()
+            else:
+                eliminadas = 1 if self._entradas.pop(clave, None) is not None else 0
+            self.invalidaciones += eliminadas
+
+        if eliminadas:
+            logger.debug(f"Cache de validación invalidada: {clave or 'todas las entradas'}")
+
+    def estadisticas(self) -> Dict[str, int]:
+
+        with self._lock:
+            return {
+                "entradas": len(self._entradas),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidaciones": self.invalidaciones,
+                "refrescos": self.refrescos,
+            }
+
+    def _arrancar_refresco(self):
+
+        if not self.refresco or self._hilo is not None:
+            return
+        with self._lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle_refresco, name="refresco-validacion", daemon=True)
+                self._hilo.start()
+
+    def _bucle_refresco(self):
+        # Revalida antes de caducar las entradas para que el webhook nunca pague la comprobación.
+
+        intervalo = max(1.0, self.ttl / 4)
+        while True:
+            time.sleep(intervalo)
+            with self._lock:
+                proximas = [
+                    (clave, cargar) for clave, (_, expira, cargar) in self._entradas.items()
+                    if expira - time.monotonic() <= intervalo * 2
+                ]
+
+            for clave, cargar in proximas:
+                try:
+                    valor = cargar()
+                except Exception as e:
+                    logger.debug(f"Error al refrescar la validación {clave}: {e}")
+                    valor = None
+
+                with self._lock:
+                    if valor:
+                        self._entradas[clave] = (valor, time.monotonic() + self.ttl, cargar)
+                        self.refrescos += 1
+                    else:
+                        self._entradas.pop(clave, None)
+
+cache_validacion = CacheValidacion(VALIDACION_CACHE_TTL, VALIDACION_REFRESCO)
+
+def _revisar_respuesta(response, *args, **kwargs):
+    # Invalida automáticamente la cache cuando Cloudflare rechaza el token o no encuentra una zona.
+
+    if response.status_code in (401, 403):
+        cache_validacion.invalidar()
+    elif response.status_code == 404:
+        coincidencia = _patron_zona.search(response.request.path_url if response.request else '')
+        if coincidencia:
+            cache_validacion.invalidar(clave_zona(coincidencia.group(1)))
+
+obtener_sesion(CLOUDFLARE).hooks['response'].append(_revisar_respuesta)
@@ -0,0 +1,123 @@
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import requests
+
+from config import CIRCUITO_ESPERA, CIRCUITO_FALLOS
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+CERRADO = 'cerrado'
+ABIERTO = 'abierto'
+SEMIABIERTO = 'semiabierto'
+
+class CircuitoAbierto(requests.ConnectionError):
+    # Llamada rechazada sin salir a la red porque el circuito del servicio está abierto. Hereda de
+    # ConnectionError para que los llamantes la traten como cualquier servicio caído.
+    pass
+
+class Circuito:
+    # Circuit breaker de un servicio externo: tras CIRCUITO_FALLOS fallos seguidos (errores de conexión,
+    # timeouts o 5xx) se abre y las llamadas fallan al momento en lugar de esperar cada una su timeout.
+    # Pasados CIRCUITO_ESPERA segundos queda semiabierto y deja salir una única llamada de prueba:
+    # si responde se cierra y si falla vuelve a abrirse.
+
+    def __init__(self, nombre: str, umbral: int, espera: float):
+        self.nombre = nombre
+        self.umbral = umbral
+        self.espera = espera
+        self.estado = CERRADO
+        self.fallos_consecutivos = 0
+        self.aperturas = 0
+        self.rechazadas = 0
+        self.ultimo_error: Optional[str] = None
+        self.desde = time.time()
+        self._reintento = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    def _cambiar(self, estado: str):
+        self.estado = estado
+        self.desde = time.time()
+
+    def permitir(self) -> bool:
+        # Indica si la llamada puede salir. En estado semiabierto solo sale la de prueba.
+
+        if self.umbral <= 0:
+            return True
+        with self._lock:
+            if self.estado == ABIERTO and time.monotonic() >= self._reintento:
+                self._cambiar(SEMIABIERTO)
+                logger.info(f"Circuito de {self.nombre} semiabierto, probando con la siguiente llamada")
+            if self.estado == CERRADO:
+                return True
+            if self.estado == SEMIABIERTO and not self._prueba_en_curso:
+                self._prueba_en_curso = True
+                return True
+            self.rechazadas += 1
+            return False
+
+    def exito(self):
+
+        with self._lock:
+            self.fallos_consecutivos = 0
+            self._prueba_en_curso = False
+            if self.estado != CERRADO:
+                self._cambiar(CERRADO)
+                logger.info(f"Circuito de {self.nombre} cerrado, el servicio vuelve a responder")
+
+    def fallo(self, motivo: str):
+
+        with self._lock:
+            self.fallos_consecutivos += 1
+            self.ultimo_error = motivo
+            prueba = self._prueba_en_curso
+            self._prueba_en_curso = False
+            if self.umbral <= 0 or self.estado == ABIERTO:
+                return
+            if prueba or self.fallos_consecutivos >= self.umbral:
+                self._cambiar(ABIERTO)
+                self._reintento = time.monotonic() + self.espera
+                self.aperturas += 1
+                logger.warning(f"Circuito de {self.nombre} abierto tras {self.fallos_consecutivos} fallos ({motivo}). "
+                               f"Las llamadas fallarán al momento durante {self.espera:.0f} segundos")
+
+    def estadisticas(self) -> Dict[str, Any]:
+
+        with self._lock:
+            return {
+                "estado": self.estado,
+                "desde": self.desde,
+                "fallos_consecutivos": self.fallos_consecutivos,
+                "aperturas": self.aperturas,
+                "rechazadas": self.rechazadas,
+                "ultimo_error": self.ultimo_error,
+            }
+
+_circuitos: Dict[str, Circuito] = {}
+_lock = threading.Lock()
+
+def obtener_circuito(nombre: str) -> Circuito:
+
+    circuito = _circuitos.get(nombre)
+    if circuito is not None:
+        return circuito
+    with _lock:
+        return _circuitos.setdefault(nombre, Circuito(nombre, CIRCUITO_FALLOS, CIRCUITO_ESPERA))
+
+def estados() -> Dict[str, Dict[str, Any]]:
+
+    return {nombre: circuito.estadisticas() for nombre, circuito in sorted(list(_circuitos.items()))}
+
+def resumen() -> Dict[str, float]:
+    # Totales para /metrics.
+
+    todos = list(estados().values())
+    return {
+        "abiertos": sum(1 for c in todos if c["estado"] == ABIERTO),
+        "semiabiertos": sum(1 for c in todos if c["estado"] == SEMIABIERTO),
+        "aperturas": sum(c["aperturas"] for c in todos),
+        "rechazadas": sum(c["rechazadas"] for c in todos),
+    }
@@ -1,41 +1,65 @@
-import json
+import contextvars
+import logging
+import random
 import time
-from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import requests
 
-from config import CLOUDFLARE_API_TOKEN, CLOUDFLARE_API_URL
+import metricas
+import trazas
+from cache_dns import cache_dns
+from cache_validacion import CLAVE_TOKEN, cache_validacion, clave_zona
+from circuito import CircuitoAbierto
+from config import (
+    CLOUDFLARE_API_TOKEN,
+    CLOUDFLARE_API_URL,
+    CLOUDFLARE_BATCH,
+    CLOUDFLARE_PLAZO,
+    CLOUDFLARE_REINTENTOS,
+    CONCURRENCIA_ZONAS,
+    HTTP_TIMEOUT,
+    HTTP_TIMEOUT_CONEXION,
+    check_cloudflare_config,
+    check_unifi_config,
+)
+from enrutado import TODOS_LOS_MONITORES, clave_monitor, perfil
+from estado_registros import almacen_estado
+from http_client import CLOUDFLARE, obtener_sesion
 from ip_info import obtener_ip_publica
-from utils import setup_logger
+from metricas import medir
+from plan_zonas import OperacionZona, obtener_plan
+from planificador import VERIFICACION, segundos_retry_after
+from unifi import planificar_destinos
+from utils import setup_logger, volcar
 
 logger = setup_logger(__name__)
 
-def cargar_zonas() -> List[Dict[str, Any]]:
+# Espera base y máxima entre reintentos, en segundos
+BACKOFF_BASE = 0.5
+BACKOFF_MAXIMO = 10.0
 
-    try:
-        with open('/app/data/zonas.json', 'r') as f:
-            zonas = json.load(f)
-            return zonas
-    except Exception as e:
-        logger.error(f"Error al cargar el archivo zonas.json: {e}")
-        return []
-
-def guardar_zonas(zonas: List[Dict[str, Any]]) -> bool:
+# Duración de una escritura en Cloudflare para estimar el plan cuando aún no hay ninguna medida
+LATENCIA_ESCRITURA_POR_DEFECTO = 0.5
 
-    try:
-        with open('/app/data/zonas.json', 'w') as f:
-            json.dump(zonas, f, indent=4)
-        return True
-    except Exception as e:
-        logger.error(f"Error al guardar en el archivo zonas.json: {e}")
-        return False
+# Sesión compartida con la API de Cloudflare
+sesion = obtener_sesion(CLOUDFLARE)
 
+@medir('connect_cloudflare')
 def connect_cloudflare() -> Tuple[bool, Optional[Dict[str, str]]]:
 
     if not CLOUDFLARE_API_TOKEN:
         logger.error("CLOUDFLARE_API_TOKEN no está configurado.")
         return False, None
 
+    headers = cache_validacion.obtener(CLAVE_TOKEN, _verificar_token)
+    if headers:
+        return True, headers
+    return False, None
+
+def _verificar_token() -> Optional[Dict[str, str]]:
+
     headers = {
         "Authorization": f"Bearer {CLOUDFLARE_API_TOKEN}",
         "Content-Type": "application/json"
@@ -43,23 +67,30 @@ def connect_cloudflare() -> Tuple[bool, Optional[Dict[str, str]]]:
 
     try:
         logger.debug(f"Intentando verificar conexión con Cloudflare API TOKEN: {CLOUDFLARE_API_TOKEN}")
-        response = requests.get(f"{CLOUDFLARE_API_URL}/user/tokens/verify", headers=headers)
+        response = sesion.get(f"{CLOUDFLARE_API_URL}/user/tokens/verify", headers=headers,
+                               prioridad=VERIFICACION)
 
         if response.status_code == 200:
             logger.info("Cliente Cloudflare inicializado correctamente.")
-            return True, headers
+            return headers
         else:
             logger.error(f"Error al verificar token de Cloudflare: {response.text}")
-            return False, None
+            return None
 
     except Exception as e:
         logger.error(f"Error al conectar con Cloudflare: {str(e)}")
-        return False, None
+        return None
 
+@medir('verificar_zona')
 def verificar_zona(headers: Dict[str, str], zone_id: str) -> bool:
 
+    return bool(cache_validacion.obtener(clave_zona(zone_id), lambda: _verificar_zona(headers, zone_id)))
+
+def _verificar_zona(headers: Dict[str, str], zone_id: str) -> bool:
+
     try:
-        response = requests.get(f"{CLOUDFLARE_API_URL}/zones/{zone_id}", headers=headers)
+        response = sesion.get(f"{CLOUDFLARE_API_URL}/zones/{zone_id}", headers=headers,
+                              prioridad=VERIFICACION)
 
         if response.status_code == 200:
             zona = response.json()['result']
@@ -73,68 +104,83 @@ def verificar_zona(headers: Dict[str, str], zone_id: str) -> bool:
         logger.error(f"Error inesperado al verificar la zona {zone_id}: {e}")
         return False
 
-def buscar_registro_a(headers: Dict[str, str], zone_id: str, nombre: str) -> Optional[Dict[str, Any]]:
+@medir('buscar_registro_a')
+def buscar_registro_a(headers: Dict[str, str], zone_id: str, nombre: str, tipo: str = 'A',
+                      desde: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    # Busca un registro de dirección, tipo A (IPv4) o AAAA (IPv6).
 
     try:
-        params = {
-            'type': 'A',
-            'name': nombre
-        }
+        # Primero el snapshot de la zona, solo consultamos la API si no se pudo cargar
+        disponible, registro = cache_dns.obtener(headers, zone_id, tipo, nombre, desde)
 
-        response = requests.get(
-            f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records",
-            headers=headers,
-            params=params
-        )
+        if not disponible:
+            params = {
+                'type': tipo,
+                'name': nombre
+            }
 
-        if response.status_code == 200:
-            registros = response.json()['result']
-            if registros:
-                registro = registros[0]
-                logger.info(f"Registro encontrado: {nombre} - ID: {registro.get('id')} - IP actual: {registro.get('content')} - Proxied: {registro.get('proxied')}")
-                return registro
-            else:
-                logger.warning(f"No se encontró registro tipo A con nombre {nombre} en la zona {zone_id}")
+            response = sesion.get(
+                f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records",
+                headers=headers,
+                params=params
+            )
+
+            if response.status_code != 200:
+                logger.error(f"Error al buscar registro DNS {nombre}: {response.text}")
                 return None
+
+            registros = response.json()['result']
+            registro = registros[0] if registros else None
+
+        if registro:
+            logger.info(f"Registro encontrado: {nombre} - ID: {registro.get('id')} - IP actual: {registro.get('content')} - Proxied: {registro.get('proxied')}")
+            return registro
         else:
-            logger.error(f"Error al buscar registro DNS {nombre}: {response.text}")
+            logger.warning(f"No se encontró registro tipo {tipo} con nombre {nombre} en la zona {zone_id}")
             return None
     except Exception as e:
         logger.error(f"Error inesperado al buscar registro DNS {nombre}: {e}")
         return None
 
-def buscar_registro_cname(headers: Dict[str, str], zone_id: str, nombre: str) -> Optional[Dict[str, Any]]:
+@medir('buscar_registro_cname')
+def buscar_registro_cname(headers: Dict[str, str], zone_id: str, nombre: str,
+                          desde: Optional[float] = None) -> Optional[Dict[str, Any]]:
 
     try:
-        params = {
-            'type': 'CNAME',
-            'name': nombre
-        }
-
         logger.debug(f"Buscando registro CNAME {nombre} en zona {zone_id}")
-        logger.debug(f"Parámetros de búsqueda: {params}")
-        logger.debug(f"URL: {CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records")
-
-        response = requests.get(
-            f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records",
-            headers=headers,
-            params=params,
-            timeout=30.0
-        )
 
-        logger.debug(f"Respuesta de Cloudflare: Status={response.status_code}")
-        if response.status_code == 200:
-            registros = response.json()['result']
-            if registros:
-                registro = registros[0]
-                logger.info(f"Registro CNAME encontrado: {nombre} - ID: {registro.get('id')} - Target actual: {registro.get('content')} - Proxied: {registro.get('proxied')}")
-                return registro
-            else:
-                logger.warning(f"No se encontró registro tipo CNAME con nombre {nombre} en la zona {zone_id}")
+        # Primero el snapshot de la zona, solo consultamos la API si no se pudo cargar
+        disponible, registro = cache_dns.obtener(headers, zone_id, 'CNAME', nombre, desde)
+
+        if not disponible:
+            params = {
+                'type': 'CNAME',
+                'name': nombre
+            }
+
+            logger.debug(f"Parámetros de búsqueda: {params}")
+            logger.debug(f"URL: {CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records")
+
+            response = sesion.get(
+                f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records",
+                headers=headers,
+                params=params
+            )
+
+            logger.debug(f"Respuesta de Cloudflare: Status={response.status_code}")
+            if response.status_code != 200:
+                error_text = response.text
+                logger.error(f"Error al buscar registro CNAME {nombre}: Status={response.status_code}, Response={error_text}")
                 return None
+
+            registros = response.json()['result']
+            registro = registros[0] if registros else None
+
+        if registro:
+            logger.info(f"Registro CNAME encontrado: {nombre} - ID: {registro.get('id')} - Target actual: {registro.get('content')} - Proxied: {registro.get('proxied')}")
+            return registro
         else:
-            error_text = response.text
-            logger.error(f"Error al buscar registro CNAME {nombre}: Status={response.status_code}, Response={error_text}")
+            logger.warning(f"No se encontró registro tipo CNAME con nombre {nombre} en la zona {zone_id}")
             return None
     except requests.Timeout as e:
         logger.error(f"Timeout al buscar registro CNAME {nombre}: {str(e)}")
@@ -146,247 +192,377 @@ def buscar_registro_cname(headers: Dict[str, str], zone_id: str, nombre: str) ->
         logger.error(f"Traceback: {traceback.format_exc()}")
         return None
 
-def actualizar_registro_cname(headers: Dict[str, str], zone_id: str, registro_id: str,
-                          nuevo_target: str, registro_actual: Dict[str, Any]) -> bool:
-
-    try:
-        nombre_registro = registro_actual['name']
-        target_actual = registro_actual['content']
-
-        if target_actual == nuevo_target:
-            logger.info(f"El registro CNAME {nombre_registro} ya tiene el target {nuevo_target}. No se requiere actualización.")
-            return True
-
-        logger.info(f"Preparando actualización del registro CNAME {nombre_registro}...")
-        logger.info(f"Target actual: {target_actual}")
-        logger.info(f"Nuevo target: {nuevo_target}")
+def _peticion_cloudflare(metodo: str, url: str, headers: Dict[str, str], **kwargs) -> requests.Response:
+    # Reintenta errores de red, 429 y 5xx con espera exponencial aleatoria (jitter) sin superar
+    # el plazo total CLOUDFLARE_PLAZO. Tras un 429 se espera lo que indique Retry-After; sin la
+    # cabecera se usa la misma espera exponencial (el planificador ya pausa las demás peticiones).
+    # Los errores 4xx se devuelven al momento.
 
-        estado_proxied_actual = registro_actual.get('proxied', False)
-
-        datos_actualizacion = {
-            'name': registro_actual['name'],
-            'type': 'CNAME',
-            'content': nuevo_target,
-            'proxied': estado_proxied_actual,
-            'ttl': registro_actual.get('ttl', 1)
-        }
+    limite = time.monotonic() + CLOUDFLARE_PLAZO
+    intento = 0
 
-        response = requests.put(
+    while True:
+        restante = max(1.0, limite - time.monotonic())
+        try:
+            response = sesion.request(metodo, url, headers=headers,
+                                      timeout=(HTTP_TIMEOUT_CONEXION, min(HTTP_TIMEOUT, restante)), **kwargs)
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            error = None
+            motivo = f"Status={response.status_code}"
+        except CircuitoAbierto:
+            # El servicio está caído: reintentar solo alargaría la espera
+            raise
+        except (requests.Timeout, requests.ConnectionError) as e:
+            response = None
+            error = e
+            motivo = f"{type(e).__name__}: {str(e)}"
+
+        intento += 1
+        espera = random.uniform(0, min(BACKOFF_MAXIMO, BACKOFF_BASE * (2 ** intento)))
+        if response is not None and response.status_code == 429 and response.headers.get('Retry-After'):
+            espera = segundos_retry_after(response.headers.get('Retry-After'))
+        if intento >= CLOUDFLARE_REINTENTOS or time.monotonic() + espera >= limite:
+            if error is not None:
+                raise error
+            return response
+
+        logger.info(f"Reintentando {metodo} en {espera:.1f} segundos ({motivo})...")
+        metricas.registrar_reintento(CLOUDFLARE)
+        time.sleep(espera)
+
+@medir('actualizar_registro')
+def actualizar_registro(headers: Dict[str, str], zone_id: str, registro_id: str,
+                        campos: Dict[str, Any], nombre_registro: str = '') -> Optional[Dict[str, Any]]:
+    # Modifica solo los campos indicados con un PATCH y devuelve el registro actualizado.
+    # La respuesta de Cloudflare ya contiene el registro resultante, no hace falta volver a consultarlo.
+
+    nombre_registro = nombre_registro or registro_id
+    try:
+        logger.debug("Enviando actualización de %s a Cloudflare: %s", nombre_registro, campos)
+        response = _peticion_cloudflare(
+            'PATCH',
             f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records/{registro_id}",
-            headers=headers,
-            json=datos_actualizacion
+            headers,
+            json=campos
         )
 
         if response.status_code == 200:
             resultado = response.json()
+            registro = resultado.get('result') or {}
             if resultado.get('success', False):
-                logger.info(f"Registro CNAME {nombre_registro} actualizado: Target anterior={target_actual}, Target nuevo={nuevo_target}")
-                return True
-            else:
-                logger.error(f"Error en la respuesta de Cloudflare: {resultado.get('errors', [])}")
-                return False
+                distintos = {campo: registro.get(campo) for campo, valor in campos.items() if registro.get(campo) != valor}
+                if distintos:
+                    logger.error(f"El registro {nombre_registro} no quedó con los valores enviados. Valores actuales: {distintos}")
+                    cache_dns.invalidar(zone_id)
+                    return None
+                cache_dns.actualizar(zone_id, registro)
+                return registro
+            logger.error(f"Error en la respuesta de Cloudflare: Errors={resultado.get('errors', [])}, Messages={resultado.get('messages', [])}")
         else:
-            logger.error(f"Error al actualizar registro CNAME: {response.text}")
-            return False
+            logger.error(f"Error al actualizar registro {nombre_registro}: Status={response.status_code}, Response={response.text}")
 
+    except requests.Timeout as e:
+        logger.error(f"Timeout al actualizar el registro {nombre_registro}: {str(e)}")
     except Exception as e:
-        logger.error(f"Error inesperado al actualizar el target CNAME: {e}")
-        return False
-
-def actualizar_registro_proxied(headers: Dict[str, str], zone_id: str, registro_id: str, proxied: bool) -> bool:
+        logger.error(f"Error inesperado al actualizar el registro {nombre_registro}: {str(e)}")
 
-    max_retries = 3
-    base_timeout = 60.0  # 60 segundos de timeout base
+    cache_dns.invalidar(zone_id)
+    return None
 
-    for intento in range(max_retries):
-        try:
-            # Obtener registro actual
-            response = requests.get(
-                f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records/{registro_id}",
-                headers=headers,
-                timeout=base_timeout * (intento + 1)
-            )
+@medir('actualizar_registro_cname')
+def actualizar_registro_cname(headers: Dict[str, str], zone_id: str, registro_id: str,
+                          nuevo_target: str, registro_actual: Dict[str, Any]) -> bool:
 
-            if response.status_code != 200:
-                error_text = response.text
-                logger.error(f"Error al obtener registro actual: Status={response.status_code}, Response={error_text}")
-                if intento < max_retries - 1:
-                    logger.info("Reintentando en 5 segundos...")
-                    time.sleep(5)
-                    continue
-                return False
-
-            registro_actual = response.json()['result']
-            estado_actual = registro_actual.get('proxied', False)
-            nombre_registro = registro_actual.get('name', 'desconocido')
-            tipo_registro = registro_actual.get('type', 'desconocido')
-
-            logger.debug(f"Estado actual de proxied para {nombre_registro} ({tipo_registro}): {estado_actual}")
-
-            if estado_actual == proxied:
-                logger.info(f"El registro {nombre_registro} ya tiene el estado proxied={proxied}. No se requiere actualización.")
-                return True
-
-            datos_actualizacion = {
-                'name': registro_actual['name'],
-                'type': registro_actual['type'],
-                'content': registro_actual['content'],
-                'proxied': proxied,
-                'ttl': registro_actual.get('ttl', 1)
-            }
+    nombre_registro = registro_actual['name']
+    target_actual = registro_actual['content']
 
-            logger.debug(f"Enviando datos de actualización a Cloudflare: {datos_actualizacion}")
+    if target_actual == nuevo_target:
+        logger.info(f"El registro CNAME {nombre_registro} ya tiene el target {nuevo_target}. No se requiere actualización.")
+        return True
 
-            response = requests.put(
-                f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records/{registro_id}",
-                headers=headers,
-                json=datos_actualizacion,
-                timeout=base_timeout * (intento + 1)
-            )
+    if actualizar_registro(headers, zone_id, registro_id, {'content': nuevo_target}, nombre_registro):
+        logger.info(f"Registro CNAME {nombre_registro} actualizado: Target anterior={target_actual}, Target nuevo={nuevo_target}")
+        return True
+    return False
 
-            logger.debug(f"Respuesta de Cloudflare: Status={response.status_code}")
-            response_json = response.json()
-            logger.debug(f"Respuesta detallada: {json.dumps(response_json, indent=2)}")
-
-            if response.status_code == 200:
-                if response_json.get('success', False):
-                    logger.debug(f"Registro {nombre_registro} actualizado: proxied={proxied}")
-                    # Verificar que el cambio se aplicó correctamente
-                    verify_response = requests.get(
-                        f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records/{registro_id}",
-                        headers=headers
-                    )
-                    if verify_response.status_code == 200:
-                        registro_actualizado = verify_response.json()['result']
-                        estado_final = registro_actualizado.get('proxied', False)
-                        if estado_final == proxied:
-                            logger.debug(f"Verificación exitosa: el estado proxied se actualizó correctamente a {proxied}")
-                            return True
-                        else:
-                            logger.error(f"El estado proxied no se actualizó correctamente. Estado actual: {estado_final}")
-                            if intento < max_retries - 1:
-                                logger.info("Reintentando en 5 segundos...")
-                                time.sleep(5)
-                                continue
-                            return False
-                else:
-                    errors = response_json.get('errors', [])
-                    messages = response_json.get('messages', [])
-                    logger.error(f"Error en la respuesta de Cloudflare: Errors={errors}, Messages={messages}")
-                    if intento < max_retries - 1:
-                        logger.info("Reintentando en 5 segundos...")
-                        time.sleep(5)
-                        continue
-                    return False
-            else:
-                logger.error(f"Error al actualizar registro: Status={response.status_code}, Response={response.text}")
-                if intento < max_retries - 1:
-                    logger.info("Reintentando en 5 segundos...")
-                    time.sleep(5)
-                    continue
-                return False
-
-        except requests.Timeout as e:
-            logger.error(f"Timeout al actualizar el registro (intento {intento + 1}): {str(e)}")
-            if intento < max_retries - 1:
-                logger.info("Reintentando en 5 segundos...")
-                time.sleep(5)
-                continue
-            return False
-        except Exception as e:
-            logger.error(f"Error inesperado al actualizar el registro proxied: {str(e)}")
-            logger.error(f"Detalles del error: {type(e).__name__}")
-            import traceback
-            logger.error(f"Traceback completo:\n{traceback.format_exc()}")
-            if intento < max_retries - 1:
-                logger.info("Reintentando en 5 segundos...")
-                time.sleep(5)
-                continue
-            return False
+@medir('actualizar_registro_proxied')
+def actualizar_registro_proxied(headers: Dict[str, str], zone_id: str, registro_id: str, proxied: bool) -> bool:
 
+    registro = actualizar_registro(headers, zone_id, registro_id, {'proxied': proxied})
+    if registro:
+        logger.debug("Registro %s actualizado: proxied=%s", registro.get('name', registro_id), proxied)
+        return True
     return False
 
+@medir('actualizar_registro_contenido')
 def actualizar_registro_contenido(headers: Dict[str, str], zone_id: str, registro_id: str,
                               nuevo_contenido: str, registro_actual: Dict[str, Any]) -> bool:
 
-    try:
-        nombre_registro = registro_actual['name']
-        contenido_actual = registro_actual['content']
+    nombre_registro = registro_actual['name']
+    contenido_actual = registro_actual['content']
 
-        if contenido_actual == nuevo_contenido:
-            logger.info(f"El registro {nombre_registro} ya tiene el contenido {nuevo_contenido}. No se requiere actualización.")
-            return True
+    if contenido_actual == nuevo_contenido:
+        logger.info(f"El registro {nombre_registro} ya tiene el contenido {nuevo_contenido}. No se requiere actualización.")
+        return True
 
-        logger.info(f"Preparando actualización del registro {nombre_registro}...")
-        logger.info(f"Contenido actual: {contenido_actual}")
-        logger.info(f"Nuevo contenido: {nuevo_contenido}")
+    # PATCH conserva el resto de campos (proxied, ttl...) tal y como están en Cloudflare
+    registro = actualizar_registro(headers, zone_id, registro_id, {'content': nuevo_contenido}, nombre_registro)
+    if registro:
+        logger.info(f"Registro {nombre_registro} actualizado: IP anterior={contenido_actual}, IP nueva={nuevo_contenido}, proxied={registro.get('proxied')}")
+        return True
+    return False
 
-        # Obtener el estado actual del registro antes de actualizarlo
-        response = requests.get(
-            f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records/{registro_id}",
-            headers=headers
-        )
+@medir('obtener_registro')
+def obtener_registro(headers: Dict[str, str], zone_id: str, registro_id: str) -> Optional[Dict[str, Any]]:
+    # Lee un registro por su ID, más barato que buscarlo por nombre en el listado de la zona.
 
-        if response.status_code != 200:
-            logger.error(f"Error al obtener estado actual del registro: {response.text}")
-            return False
+    try:
+        response = sesion.get(f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records/{registro_id}", headers=headers)
+        if response.status_code == 200:
+            return response.json().get('result')
+        logger.debug(f"No se pudo leer el registro {registro_id} de la zona {zone_id}: Status={response.status_code}")
+    except Exception as e:
+        logger.debug(f"Error al leer el registro {registro_id} de la zona {zone_id}: {e}")
+    return None
+
+def _buscar_registro(headers: Dict[str, str], op: OperacionZona, desde: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    # Snapshot de la zona (revalidado si se cargó antes de desde); si no está disponible y el ID ya
+    # está resuelto, lectura directa por ID; y como último recurso, búsqueda por nombre. El ID
+    # encontrado queda resuelto en la operación.
+
+    registro = None
+    if op.registro_id:
+        disponible, registro = cache_dns.obtener(headers, op.zone_id, op.tipo, op.nombre, desde)
+        if not disponible:
+            registro = obtener_registro(headers, op.zone_id, op.registro_id)
+            if registro and (registro.get('type') != op.tipo or registro.get('name', '').lower() != op.clave[2]):
+                registro = None
+
+    if registro is None:
+        if op.tipo == 'CNAME':
+            logger.info(f"Procesando configuración CNAME para {op.nombre}...")
+            registro = buscar_registro_cname(headers, op.zone_id, op.nombre, desde)
+        else:
+            registro = buscar_registro_a(headers, op.zone_id, op.nombre, op.tipo, desde)
 
-        registro_actual_cloudflare = response.json()['result']
-        estado_proxied_actual = registro_actual_cloudflare.get('proxied', False)
+    op.resolver(registro.get('id') if registro else None)
+    return registro
 
-        datos_actualizacion = {
-            'name': registro_actual['name'],
-            'type': registro_actual['type'],
-            'content': nuevo_contenido,
-            'proxied': estado_proxied_actual,  # Mantenemos el estado proxied actual
-            'ttl': registro_actual.get('ttl', 1)
-        }
+def _diferencia(headers: Dict[str, str], op: OperacionZona, estado_webhook: str, ip_registro: Optional[str],
+                desde: Optional[float] = None
+                ) -> Optional[Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any], Dict[str, Any]]]:
+    # Busca el registro y devuelve (registro, campos a modificar, valores anteriores a guardar,
+    # valores a guardar si se aplica) o None si no existe. Lo comparten la ejecución real y el plan.
 
-        logger.debug(f"Enviando actualización a Cloudflare: {datos_actualizacion}")
-        response = requests.put(
-            f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records/{registro_id}",
-            headers=headers,
-            json=datos_actualizacion
+    registro = _buscar_registro(headers, op, desde)
+    if not registro:
+        logger.error(f"No se encontró registro tipo {op.tipo} para {op.nombre}")
+        return None
+    estado = almacen_estado.obtener(op.clave)
+    return (registro,) + _calcular_cambios(op, estado, registro, estado_webhook, ip_registro)
+
+def _procesar_zona(op: OperacionZona, total: int, headers: Dict[str, str],
+                   estado_webhook: str, ip_publica: Optional[str],
+                   ip_publica_v6: Optional[str] = None, desde: Optional[float] = None) -> Dict[str, Any]:
+    # Ejecuta la operación de una entrada de zonas.json y devuelve los valores anteriores guardados.
+
+    cambios: Dict[str, Any] = {}
+    # Cada zona se ejecuta en su propia copia del contexto, la etiqueta no se mezcla entre hilos
+    metricas.zona_actual.set(op.nombre)
+
+    logger.info(f"--- Procesando zona {op.indice+1}/{total}: {op.nombre} (ID: {op.zone_id}) ---")
+
+    # Verificamos que la zona sea válida
+    logger.debug("Verificando acceso a la zona %s...", op.zone_id)
+    if not verificar_zona(headers, op.zone_id):
+        logger.warning(f"Zona {op.zone_id} no es válida en Cloudflare. Saltando.")
+        return cambios
+
+    diferencia = _diferencia(headers, op, estado_webhook, ip_publica_v6 if op.tipo == 'AAAA' else ip_publica, desde)
+    if diferencia is None:
+        return cambios
+    registro, campos, guardar, guardar_si_exito = diferencia
+
+    # El valor anterior queda guardado antes de modificar el registro, por si el proceso se interrumpe
+    for campo, valor in guardar.items():
+        logger.info(f"Guardando {campo} de {op.nombre} ({valor}) antes de cambiarlo")
+    almacen_estado.guardar(op.clave, guardar)
+    cambios.update(guardar)
+
+    if not campos:
+        logger.info(f"El registro {op.tipo} {op.nombre} ya está en el estado deseado. No se requiere actualización.")
+        almacen_estado.guardar(op.clave, guardar_si_exito)
+        cambios.update(guardar_si_exito)
+        return cambios
+
+    # Contenido y proxied se actualizan en una única llamada
+    logger.info(f"Acción: actualizar registro {op.tipo} {op.nombre}: {campos}")
+    if actualizar_registro(headers, op.zone_id, registro['id'], campos, op.nombre):
+        logger.info(f"Registro {op.tipo} {op.nombre} actualizado correctamente: {campos}")
+        almacen_estado.guardar(op.clave, guardar_si_exito)
+        cambios.update(guardar_si_exito)
+    else:
+        logger.error(f"Error al actualizar el registro {op.tipo} {op.nombre}")
+
+    return cambios
+
+def _calcular_cambios(op: OperacionZona, zona: Dict[str, Any], registro: Dict[str, Any], estado_webhook: str,
+                      ip_registro: Optional[str]) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+    # Devuelve (campos a modificar en Cloudflare, valores anteriores a guardar,
+    # valores anteriores a guardar solo si la modificación se aplica).
+    # La configuración viene de la operación compilada y los valores anteriores del almacén de estado.
+
+    campos: Dict[str, Any] = {}
+    guardar: Dict[str, Any] = {}
+    guardar_si_exito: Dict[str, Any] = {}
+    activar = estado_webhook == 'activado'
+    contenido_actual = registro.get('content')
+
+    # El valor anterior solo se guarda al empezar la caída. Mientras siga guardado el registro ya
+    # apunta a la WAN de respaldo (un DOWN repetido, por ejemplo) y sobrescribirlo perdería el valor
+    # original. Se limpia al restaurarlo para que la siguiente caída guarde uno nuevo.
+    if op.target_cname:
+        if activar:
+            if not zona.get('target_cname_anterior'):
+                guardar['target_cname_anterior'] = contenido_actual
+            if contenido_actual != op.target_cname:
+                campos['content'] = op.target_cname
+        elif zona.get('target_cname_anterior'):
+            if contenido_actual != zona['target_cname_anterior']:
+                campos['content'] = zona['target_cname_anterior']
+            guardar_si_exito['target_cname_anterior'] = ""
+
+    elif op.cambiar_ip:
+        if activar and ip_registro:
+            if not zona.get('contenido_anterior'):
+                guardar['contenido_anterior'] = contenido_actual
+            if contenido_actual != ip_registro:
+                campos['content'] = ip_registro
+        elif not activar and zona.get('contenido_anterior'):
+            if contenido_actual != zona['contenido_anterior']:
+                campos['content'] = zona['contenido_anterior']
+            guardar_si_exito['contenido_anterior'] = ""
+
+    if op.cambiar_proxied:
+        nuevo_estado_proxied = not activar
+        if registro.get('proxied', False) != nuevo_estado_proxied:
+            campos['proxied'] = nuevo_estado_proxied
+
+    return campos, guardar, guardar_si_exito
+
+@medir('actualizar_registros_batch')
+def actualizar_registros_batch(headers: Dict[str, str], zone_id: str,
+                               patches: List[Dict[str, Any]]) -> Tuple[Optional[List[Dict[str, Any]]], bool]:
+    # Envía todos los cambios de una zona en una sola llamada al endpoint batch de Cloudflare.
+    # Cloudflare aplica el lote de forma atómica: o se aplican todos los cambios o ninguno.
+    # Devuelve (registros actualizados o None, si tiene sentido aplicar los cambios uno a uno).
+    # Los 429, 5xx y errores de red ya se han reintentado: si aun así fallan, repetir los cambios
+    # uno a uno solo añadiría más llamadas a un servicio que está limitando o caído. Solo un
+    # rechazo del lote (4xx) pasa a cambios individuales.
+
+    try:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Enviando %s cambios en lote a la zona %s: %s", len(patches), zone_id, volcar(patches, indent=None))
+        response = _peticion_cloudflare(
+            'POST',
+            f"{CLOUDFLARE_API_URL}/zones/{zone_id}/dns_records/batch",
+            headers,
+            json={'patches': patches}
         )
 
         if response.status_code == 200:
             resultado = response.json()
             if resultado.get('success', False):
-                logger.info(f"Registro {nombre_registro} actualizado: IP anterior={contenido_actual}, IP nueva={nuevo_contenido}, proxied={estado_proxied_actual}")
-                return True
-            else:
-                logger.error(f"Error en la respuesta de Cloudflare: {resultado.get('errors', [])}")
-                return False
+                registros = (resultado.get('result') or {}).get('patches') or []
+                for registro in registros:
+                    cache_dns.actualizar(zone_id, registro)
+                logger.info(f"Lote de {len(patches)} cambios aplicado en la zona {zone_id}")
+                return registros, False
+            logger.error(f"Error en la respuesta de Cloudflare al lote de la zona {zone_id}: {resultado.get('errors', [])}")
+            individual = True
         else:
-            logger.error(f"Error al actualizar registro: {response.text}")
-            return False
-
+            logger.error(f"Error al aplicar el lote en la zona {zone_id}: Status={response.status_code}, Response={response.text}")
+            individual = response.status_code != 429 and response.status_code < 500
     except Exception as e:
-        logger.error(f"Error inesperado al actualizar el contenido: {e}")
-        return False
+        logger.error(f"Error inesperado al aplicar el lote en la zona {zone_id}: {e}")
+        individual = False
 
-def procesar_zonas(estado_webhook: str, ip_publica: str = None):
+    cache_dns.invalidar(zone_id)
+    return None, individual
 
-    logger.debug(f"=== INICIANDO PROCESAMIENTO DE ZONAS PARA ESTADO: {estado_webhook} ===")
+def _aplicar_individual(headers: Dict[str, str], zone_id: str, registro: Dict[str, Any], campos: Dict[str, Any]) -> bool:
+    # Aplica los cambios de un registro con una llamada individual (respaldo del modo batch).
 
-    # Conectamos a Cloudflare
-    logger.debug("Conectando a Cloudflare API...")
-    exito, headers = connect_cloudflare()
-    if not exito or not headers:
-        logger.error("No se pudo conectar con Cloudflare. Abortando operación.")
-        return
+    return actualizar_registro(headers, zone_id, registro['id'], campos, registro.get('name', '')) is not None
 
-    # Cargamos las zonas
-    logger.info("Cargando configuración de zonas desde zonas.json...")
-    zonas = cargar_zonas()
-    if not zonas:
-        logger.error("No hay zonas configuradas o no se pudo cargar el archivo zonas.json.")
-        return
+def _procesar_zona_batch(zone_id: str, entradas: List[OperacionZona], headers: Dict[str, str],
+                         estado_webhook: str, ips: Dict[str, Optional[str]],
+                         desde: Optional[float] = None) -> Dict[int, Dict[str, Any]]:
+    # Ejecuta todas las operaciones de una misma zona con un único lote de cambios.
+
+    cambios: Dict[int, Dict[str, Any]] = {}
 
-    logger.info(f"Se encontraron {len(zonas)} zonas configuradas.")
+    logger.info(f"--- Procesando zona {zone_id} en modo batch: {len(entradas)} registros ---")
+    if not verificar_zona(headers, zone_id):
+        logger.warning(f"Zona {zone_id} no es válida en Cloudflare. Saltando.")
+        return cambios
 
-    # Para modificaciones en contenido, necesitamos la IP pública solo al activar
-    if estado_webhook == 'activado' and any(zona.get('cambiar_ip', False) for zona in zonas):
+    pendientes = []
+    for op in entradas:
+        diferencia = _diferencia(headers, op, estado_webhook, ips.get(op.tipo), desde)
+        if diferencia is None:
+            continue
+        registro, campos, guardar, guardar_si_exito = diferencia
+        if guardar:
+            almacen_estado.guardar(op.clave, guardar)
+            cambios[op.indice] = dict(guardar)
+        if campos:
+            pendientes.append((op, registro, campos, guardar_si_exito))
+        else:
+            logger.info(f"El registro {op.tipo} {op.nombre} ya está en el estado deseado. No se requiere actualización.")
+            if guardar_si_exito:
+                almacen_estado.guardar(op.clave, guardar_si_exito)
+                cambios.setdefault(op.indice, {}).update(guardar_si_exito)
+
+    if not pendientes:
+        return cambios
+
+    patches = [dict(campos, id=registro['id']) for _, registro, campos, _ in pendientes]
+    registros, individual = actualizar_registros_batch(headers, zone_id, patches)
+    if registros is not None:
+        for op, registro, campos, guardar_si_exito in pendientes:
+            logger.info(f"Registro {registro['name']} actualizado en lote: {campos}")
+            if guardar_si_exito:
+                almacen_estado.guardar(op.clave, guardar_si_exito)
+                cambios.setdefault(op.indice, {}).update(guardar_si_exito)
+        return cambios
+
+    if not individual:
+        logger.error(f"No se han podido aplicar {len(pendientes)} cambios en la zona {zone_id}")
+        return cambios
+
+    # Si Cloudflare rechaza el lote aplicamos los cambios uno a uno
+    logger.warning(f"Cloudflare ha rechazado el lote de la zona {zone_id}. Aplicando {len(pendientes)} cambios de forma individual.")
+    for op, registro, campos, guardar_si_exito in pendientes:
+        if _aplicar_individual(headers, zone_id, registro, campos):
+            if guardar_si_exito:
+                almacen_estado.guardar(op.clave, guardar_si_exito)
+                cambios.setdefault(op.indice, {}).update(guardar_si_exito)
+        else:
+            logger.error(f"Error al actualizar el registro {registro['name']}")
+
+    return cambios
+
+def _ips_publicas(operaciones: List[OperacionZona], estado_webhook: str,
+                  ip_publica: Optional[str]) -> Optional[Dict[str, Optional[str]]]:
+    # IP pública por tipo de registro ('A' y 'AAAA'), solo las que necesitan las operaciones al activar.
+    # Devuelve None si no se ha podido obtener alguna de ellas.
+
+    necesita_v6 = any(op.necesita_ip and op.tipo == 'AAAA' for op in operaciones)
+    necesita_v4 = any(op.necesita_ip and op.tipo == 'A' for op in operaciones)
+
+    if estado_webhook == 'activado' and necesita_v4:
         if ip_publica:
             logger.info(f"Usando IP pública proporcionada: {ip_publica}")
         else:
@@ -394,131 +570,242 @@ def procesar_zonas(estado_webhook: str, ip_publica: str = None):
             ip_publica = obtener_ip_publica()
             if not ip_publica:
                 logger.error("No se pudo obtener la IP pública. Necesaria para actualizar registros.")
-                return
+                return None
         logger.info(f"IP pública obtenida/proporcionida: {ip_publica}")
 
-    # Procesamos cada zona
-    zonas_modificadas = False
-    for i, zona in enumerate(zonas):
-        zone_id = zona.get('id_zona')
-        nombre = zona.get('name') or zona.get('nombre')
+    ip_publica_v6 = None
+    if estado_webhook == 'activado' and necesita_v6:
+        logger.info("Obteniendo IP pública IPv6 para actualizar registros AAAA...")
+        ip_publica_v6 = obtener_ip_publica(version=6)
+        if not ip_publica_v6:
+            logger.error("No se pudo obtener la IP pública IPv6. Necesaria para actualizar registros AAAA.")
+            return None
 
-        logger.info(f"--- Procesando zona {i+1}/{len(zonas)}: {nombre} (ID: {zone_id}) ---")
+    return {'A': ip_publica, 'AAAA': ip_publica_v6}
 
-        if not zone_id or not nombre:
-            logger.warning(f"Zona #{i+1} no tiene id_zona o nombre/name. Saltando.")
-            continue
+def procesar_zonas(estado_webhook: str, ip_publica: str = None, registros: Optional[Set[str]] = None) -> bool:
+    # Si se indican registros (nombres en minúsculas) solo se procesan esas entradas de zonas.json.
+    # Devuelve False si no se ha podido procesar ninguna zona (sin conexión, sin plan o sin IP pública).
 
-        # Verificamos que la zona sea válida
-        logger.debug(f"Verificando acceso a la zona {zone_id}...")
-        if not verificar_zona(headers, zone_id):
-            logger.warning(f"Zona {zone_id} no es válida en Cloudflare. Saltando.")
-            continue
+    logger.debug(f"=== INICIANDO PROCESAMIENTO DE ZONAS PARA ESTADO: {estado_webhook} ===")
 
-        # Determinar el tipo de registro basado en la configuración
-        es_cname = bool(zona.get('target_cname'))
-
-        if es_cname:
-            # Procesamiento para registros CNAME
-            logger.info(f"Procesando configuración CNAME para {nombre}...")
-            registro_cname = buscar_registro_cname(headers, zone_id, nombre)
-            if registro_cname:
-                if estado_webhook == 'activado':
-                    target_actual = registro_cname['content']
-                    logger.info(f"Guardando target actual del CNAME ({target_actual}) antes de cambiarlo")
-
-                    zonas[i]['target_cname_anterior'] = target_actual
-                    zonas_modificadas = True
-
-                    if actualizar_registro_cname(headers, zone_id, registro_cname['id'], zona['target_cname'], registro_cname):
-                        logger.info(f"Target CNAME de {nombre} actualizado a {zona['target_cname']}")
-                    else:
-                        logger.error(f"Error al actualizar target CNAME de {nombre}")
-
-                elif estado_webhook == 'desactivado' and zona.get('target_cname_anterior'):
-                    target_anterior = zona['target_cname_anterior']
-                    logger.info(f"Restaurando target CNAME anterior: {target_anterior}")
-
-                    if actualizar_registro_cname(headers, zone_id, registro_cname['id'], target_anterior, registro_cname):
-                        logger.info(f"Target CNAME de {nombre} restaurado a {target_anterior}")
-                        zonas[i]['target_cname_anterior'] = ""
-                        zonas_modificadas = True
-                        logger.info(f"Valor de target_cname_anterior limpiado para {nombre}")
-                    else:
-                        logger.error(f"Error al restaurar target CNAME de {nombre}")
-
-                # Procesamiento de cambio de proxied para registro CNAME si está configurado
-                if zona.get('cambiar_proxied', False):
-                    nuevo_estado_proxied = False if estado_webhook == 'activado' else True
-                    logger.info(f"Acción: Cambiar estado proxied del CNAME a {nuevo_estado_proxied}")
-
-                    if actualizar_registro_proxied(headers, zone_id, registro_cname['id'], nuevo_estado_proxied):
-                        logger.info(f"Proxied del CNAME {nombre} actualizado correctamente a {nuevo_estado_proxied}")
-                    else:
-                        logger.error(f"Error al actualizar proxied del CNAME {nombre}")
-            else:
-                logger.warning(f"No se encontró registro CNAME para {nombre}")
+    # Conectamos a Cloudflare
+    logger.debug("Conectando a Cloudflare API...")
+    exito, headers = connect_cloudflare()
+    if not exito or not headers:
+        logger.error("No se pudo conectar con Cloudflare. Abortando operación.")
+        return False
 
-        else:
-            # Procesamiento para registros tipo A
-            registro_a = buscar_registro_a(headers, zone_id, nombre)
-            if registro_a:
-                # Procesamiento de cambio de IP
-                if zona.get('cambiar_ip', False):
-                    if estado_webhook == 'activado':
-                        contenido_actual = registro_a['content']
-                        logger.info(f"Acción: Guardar IP actual ({contenido_actual}) y actualizar a IP pública ({ip_publica})")
-
-                        zonas[i]['contenido_anterior'] = contenido_actual
-                        zonas_modificadas = True
-
-                        if actualizar_registro_contenido(headers, zone_id, registro_a['id'], ip_publica, registro_a):
-                            logger.info(f"IP de {nombre} actualizada correctamente a {ip_publica}")
-                            registro_a = buscar_registro_a(headers, zone_id, nombre)
-                        else:
-                            logger.error(f"Error al actualizar IP de {nombre}")
-
-                    elif estado_webhook == 'desactivado' and zona.get('contenido_anterior'):
-                        contenido_anterior = zona.get('contenido_anterior')
-                        logger.info(f"Acción: Restaurar IP a valor anterior ({contenido_anterior})")
-
-                        if actualizar_registro_contenido(headers, zone_id, registro_a['id'], contenido_anterior, registro_a):
-                            logger.info(f"IP de {nombre} restaurada correctamente a {contenido_anterior}")
-                            registro_a = buscar_registro_a(headers, zone_id, nombre)
-                        else:
-                            logger.error(f"Error al restaurar IP de {nombre}")
-                else:
-                    logger.info(f"El registro A {nombre} no tiene configurado el cambio de IP. Saltando esta acción.")
-
-                # Procesamiento de cambio de proxied para registro A
-                if zona.get('cambiar_proxied', False):
-                    nuevo_estado_proxied = False if estado_webhook == 'activado' else True
-                    logger.info(f"Acción: Cambiar estado proxied del registro A a {nuevo_estado_proxied}")
-
-                    if actualizar_registro_proxied(headers, zone_id, registro_a['id'], nuevo_estado_proxied):
-                        logger.info(f"Proxied del registro A {nombre} actualizado correctamente a {nuevo_estado_proxied}")
-                    else:
-                        logger.error(f"Error al actualizar proxied del registro A {nombre}")
-                else:
-                    logger.info(f"El registro A {nombre} no tiene configurado el cambio de proxied. Saltando esta acción.")
-            else:
-                logger.error(f"No se encontró registro tipo A para {nombre}")
-
-    # Guardamos las zonas si hubo modificaciones
-    if zonas_modificadas:
-        logger.debug("Guardando cambios en zonas.json...")
-        if guardar_zonas(zonas):
-            logger.debug("Archivo zonas.json actualizado correctamente")
-        else:
-            logger.error("Error al guardar cambios en zonas.json")
+    # El plan compilado solo se reconstruye si zonas.json ha cambiado
+    plan = obtener_plan()
+    if plan is None or not plan.operaciones:
+        logger.error("No hay zonas configuradas o no se pudo cargar el archivo zonas.json.")
+        return False
+
+    operaciones = plan.seleccionar(registros)
+    if registros is not None:
+        logger.info(f"Se procesarán {len(operaciones)} de {len(plan.operaciones)} operaciones para este monitor.")
+    else:
+        logger.info(f"Se encontraron {len(operaciones)} zonas configuradas.")
+    if not operaciones:
+        return True
 
+    ips = _ips_publicas(operaciones, estado_webhook, ip_publica)
+    if ips is None:
+        return False
+    ip_publica, ip_publica_v6 = ips['A'], ips['AAAA']
+
+    # Procesamos las zonas en paralelo con un número máximo de hilos
+    total = len(plan.zonas)
+    max_workers = max(1, min(CONCURRENCIA_ZONAS, len(operaciones)))
+    logger.debug(f"Procesando {len(operaciones)} zonas con un máximo de {max_workers} hilos concurrentes")
+
+    # Cada zona se revalida una vez en esta ejecución antes de decidir qué escribir
+    desde = time.monotonic()
+    resultados: Dict[int, Dict[str, Any]] = {}
+    if CLOUDFLARE_BATCH:
+        # Un lote por zona de Cloudflare con todos los cambios de sus registros
+        por_zona: Dict[str, List[OperacionZona]] = {}
+        for op in operaciones:
+            por_zona.setdefault(op.zone_id, []).append(op)
+
+        max_workers = max(1, min(CONCURRENCIA_ZONAS, len(por_zona)))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="zona") as executor:
+            futuros = {
+                executor.submit(contextvars.copy_context().run, trazas.en_span,
+                                "zona", {"zone_id": zone_id, "registros": len(entradas), "batch": True},
+                                _procesar_zona_batch, zone_id, entradas, headers, estado_webhook, ips, desde): zone_id
+                for zone_id, entradas in por_zona.items()
+            }
+            for futuro in as_completed(futuros):
+                try:
+                    resultados.update(futuro.result())
+                except Exception as e:
+                    logger.error(f"Error inesperado al procesar la zona {futuros[futuro]}: {e}")
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="zona") as executor:
+            futuros = {
+                executor.submit(contextvars.copy_context().run, trazas.en_span,
+                                "zona", {"zone_id": op.zone_id, "registro": op.nombre, "tipo": op.tipo},
+                                _procesar_zona, op, total, headers, estado_webhook, ip_publica, ip_publica_v6, desde): op.indice
+                for op in operaciones
+            }
+            for futuro in as_completed(futuros):
+                i = futuros[futuro]
+                try:
+                    resultados[i] = futuro.result()
+                except Exception as e:
+                    logger.error(f"Error inesperado al procesar la zona #{i+1}: {e}")
+
+    # Los valores anteriores ya se han guardado registro a registro en el almacén de estado
+    guardados = sum(1 for cambios in resultados.values() if cambios)
+    if guardados:
+        logger.debug(f"Valores anteriores actualizados en {guardados} registros")
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Cache de validación: %s", cache_validacion.estadisticas())
     logger.debug(f"=== PROCESAMIENTO DE ZONAS FINALIZADO PARA ESTADO: {estado_webhook} ===")
+    return True
+
+def _entrada_plan(op: OperacionZona, accion: str, registro: Optional[Dict[str, Any]] = None,
+                  campos: Optional[Dict[str, Any]] = None, guardar: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+
+    entrada = {"indice": op.indice, "zone_id": op.zone_id, "registro": op.nombre, "tipo": op.tipo, "accion": accion}
+    if registro is not None:
+        entrada.update(
+            id=registro.get('id'),
+            actual={"content": registro.get('content'), "proxied": registro.get('proxied')},
+            cambios=campos or {},
+            guardar=guardar or {},
+        )
+    return entrada
+
+def _planificar_zona(zone_id: str, entradas: List[OperacionZona], headers: Dict[str, str],
+                     estado_webhook: str, ips: Dict[str, Optional[str]], desde: float) -> List[Dict[str, Any]]:
+
+    if not verificar_zona(headers, zone_id):
+        return [_entrada_plan(op, 'zona_no_valida') for op in entradas]
+
+    plan = []
+    for op in entradas:
+        diferencia = _diferencia(headers, op, estado_webhook, ips.get(op.tipo), desde)
+        if diferencia is None:
+            plan.append(_entrada_plan(op, 'no_encontrado'))
+            continue
+        registro, campos, guardar, _ = diferencia
+        plan.append(_entrada_plan(op, 'actualizar' if campos else 'sin_cambios', registro, campos, guardar))
+    return plan
+
+def planificar_zonas(estado_webhook: str, ip_publica: str = None, registros: Optional[Set[str]] = None) -> Dict[str, Any]:
+    # Calcula los cambios que haría procesar_zonas con los mismos argumentos sin escribir nada: solo
+    # lecturas (verificaciones cacheadas y el listado de cada zona) y el mismo cálculo de diferencias.
+    # Como la ejecución real, revalida el snapshot de cada zona con un listado condicional (ETag).
+
+    exito, headers = connect_cloudflare()
+    if not exito or not headers:
+        return {"error": "No se pudo conectar con Cloudflare."}
+    plan = obtener_plan()
+    if plan is None or not plan.operaciones:
+        return {"error": "No hay zonas configuradas o no se pudo cargar el archivo zonas.json."}
+
+    operaciones = plan.seleccionar(registros)
+    ips = _ips_publicas(operaciones, estado_webhook, ip_publica)
+    if ips is None:
+        return {"error": "No se pudo obtener la IP pública."}
+
+    por_zona: Dict[str, List[OperacionZona]] = {}
+    for op in operaciones:
+        por_zona.setdefault(op.zone_id, []).append(op)
+
+    desde = time.monotonic()
+    entradas: List[Dict[str, Any]] = []
+    with ThreadPoolExecutor(max_workers=max(1, min(CONCURRENCIA_ZONAS, len(por_zona))), thread_name_prefix="plan") as executor:
+        futuros = {
+            executor.submit(contextvars.copy_context().run, trazas.en_span, "plan_zona", {"zone_id": zone_id},
+                            _planificar_zona, zone_id, ops, headers, estado_webhook, ips, desde): ops
+            for zone_id, ops in por_zona.items()
+        }
+        for futuro in as_completed(futuros):
+            try:
+                entradas.extend(futuro.result())
+            except Exception as e:
+                logger.error(f"Error inesperado al planificar la zona {futuros[futuro][0].zone_id}: {e}")
+                entradas.extend(_entrada_plan(op, 'error') for op in futuros[futuro])
+    entradas.sort(key=lambda entrada: entrada["indice"])
+
+    # Cada registro con cambios es un PATCH, o un lote por zona en modo batch
+    cambios = [entrada for entrada in entradas if entrada["accion"] == 'actualizar']
+    if CLOUDFLARE_BATCH:
+        escrituras = len({entrada["zone_id"] for entrada in cambios})
+        etapa = 'actualizar_registros_batch'
+    else:
+        escrituras = len(cambios)
+        etapa = 'actualizar_registro'
+    espera_cupo = sesion.planificador.espera_estimada(escrituras) if sesion.planificador and escrituras else 0.0
+
+    return {
+        "estado": estado_webhook,
+        "ip_publica": ips['A'],
+        "ip_publica_v6": ips['AAAA'],
+        "registros": entradas,
+        "resumen": {accion: sum(1 for entrada in entradas if entrada["accion"] == accion)
+                    for accion in ('actualizar', 'sin_cambios', 'no_encontrado', 'zona_no_valida', 'error')},
+        "llamadas": {
+            "modo": 'batch' if CLOUDFLARE_BATCH else 'individual',
+            "escrituras": escrituras,
+            # La ejecución real vuelve a revalidar cada zona con un listado condicional (ETag)
+            "lecturas_maximas": len(por_zona),
+        },
+        "tiempo_estimado": metricas.estimar_segundos(etapa, escrituras, CONCURRENCIA_ZONAS,
+                                                     LATENCIA_ESCRITURA_POR_DEFECTO, espera_cupo),
+    }
+
+def planificar(enabled: bool, clave: str = TODOS_LOS_MONITORES, ip_publica: Optional[str] = None) -> Dict[str, Any]:
+    # Plan completo de un webhook del monitor: registros de Cloudflare y reglas de Unifi de su perfil.
+    # No registra el evento ni escribe nada en Cloudflare, Unifi o el almacén de estado.
+
+    estado_webhook = 'activado' if enabled else 'desactivado'
+    perfil_monitor = perfil(clave)
+    resultado: Dict[str, Any] = {"plan": True, "monitor": clave, "estado": estado_webhook}
+
+    cloudflare_config_valid, cloudflare_message = check_cloudflare_config()
+    if not cloudflare_config_valid:
+        resultado["cloudflare"] = {"error": cloudflare_message}
+    elif perfil_monitor.zonas is not None and not perfil_monitor.zonas:
+        resultado["cloudflare"] = {"registros": [], "message": f"No hay zonas configuradas para el monitor: {clave}"}
+    else:
+        resultado["cloudflare"] = planificar_zonas(estado_webhook, ip_publica, perfil_monitor.zonas)
+
+    unifi_config_valid, unifi_message = check_unifi_config()
+    if unifi_config_valid:
+        resultado["unifi"] = planificar_destinos(perfil_monitor.destinos, enabled)
+    else:
+        resultado["unifi"] = {"error": unifi_message}
+
+    # Cloudflare y Unifi se aplican uno detrás de otro
+    resultado["tiempo_estimado"] = round(sum(resultado[servicio].get("tiempo_estimado", 0.0)
+                                             for servicio in ("cloudflare", "unifi")), 2)
+    return resultado
 
 if __name__ == "__main__":
-    # Para pruebas manuales
-    logger.info("Iniciando prueba de conexión a Cloudflare...")
-    success, headers = connect_cloudflare()
-    if success:
-        logger.info("Conexión a Cloudflare establecida correctamente.")
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Prueba la conexión con Cloudflare o muestra el plan de cambios sin aplicarlo.")
+    parser.add_argument('--plan', choices=('activado', 'desactivado'),
+                        help="Muestra los cambios que haría un webhook con este estado (activado = monitor en DOWN)")
+    parser.add_argument('--monitor', help="Id o nombre del monitor en rutas.json (por defecto todos)")
+    parser.add_argument('--ip', help="IP pública a usar en lugar de consultarla")
+    args = parser.parse_args()
+
+    if args.plan:
+        clave = clave_monitor({"id": args.monitor, "name": args.monitor}) if args.monitor else TODOS_LOS_MONITORES
+        print(json.dumps(planificar(args.plan == 'activado', clave, args.ip), indent=4, ensure_ascii=False))
     else:
-        logger.error("No se pudo conectar a Cloudflare.")
+        # Para pruebas manuales
+        logger.info("Iniciando prueba de conexión a Cloudflare...")
+        success, headers = connect_cloudflare()
+        if success:
+            logger.info("Conexión a Cloudflare establecida correctamente.")
+        else:
+            logger.error("No se pudo conectar a Cloudflare.")
@@ -12,6 +12,9 @@ def ensure_https_url(url):
 
 def check_unifi_config() -> Tuple[bool, str]:
 
+    # Con rutas.json los controladores y las reglas se definen en el fichero
+    if os.path.exists(FICHERO_RUTAS):
+        return True, "Configuración de Unifi en rutas.json"
     if not UNIFI_URL:
         return False, "UNIFI_URL no está configurado"
     if not UNIFI_API_TOKEN:
@@ -31,6 +34,7 @@ def check_cloudflare_config() -> Tuple[bool, str]:
 UNIFI_URL = ensure_https_url(os.getenv('UNIFI_URL'))
 UNIFI_API_TOKEN = os.getenv('UNIFI_API_TOKEN')
 NOMBRE_PBR = os.getenv('NOMBRE_PBR')
+FICHERO_RUTAS = '/app/data/rutas.json'
 
 CLIENTE_NOTIFICACION = os.getenv('CLIENTE_NOTIFICACION')
 
@@ -41,10 +45,53 @@ DISCORD_WEBHOOK = os.getenv('DISCORD_WEBHOOK')
 
 CLOUDFLARE_API_URL = os.getenv('CLOUDFLARE_API_URL', 'https://api.cloudflare.com/client/v4')
 CLOUDFLARE_API_TOKEN = os.getenv('CLOUDFLARE_API_TOKEN')
+CLOUDFLARE_BATCH = os.getenv('CLOUDFLARE_BATCH', '0') == '1'  # Cambios de cada zona en un único lote
+CLOUDFLARE_REINTENTOS = int(os.getenv('CLOUDFLARE_REINTENTOS', '4'))  # Intentos por escritura en Cloudflare
+CLOUDFLARE_PLAZO = float(os.getenv('CLOUDFLARE_PLAZO', '60'))  # Plazo total en segundos de cada escritura con reintentos
+CLOUDFLARE_LIMITE = int(os.getenv('CLOUDFLARE_LIMITE', '1200'))  # Peticiones permitidas por la API cada 5 minutos
+CLOUDFLARE_RAFAGA = int(os.getenv('CLOUDFLARE_RAFAGA', '20'))  # Peticiones que se pueden enviar seguidas sin esperar
 
 INITIAL_DELAY = int(os.getenv('INITIAL_DELAY', '2'))  # Delay in seconds
+NOTIFICACIONES_COLA_MAX = int(os.getenv('NOTIFICACIONES_COLA_MAX', '50'))  # Notificaciones pendientes como máximo
+NOTIFICACIONES_REINTENTOS = int(os.getenv('NOTIFICACIONES_REINTENTOS', '4'))  # Intentos de envío con backoff exponencial
+
+CONCURRENCIA_ZONAS = int(os.getenv('CONCURRENCIA_ZONAS', '4'))  # Zonas procesadas en paralelo
+CONCURRENCIA_RUTAS = int(os.getenv('CONCURRENCIA_RUTAS', '4'))  # Rutas de Unifi actualizadas en paralelo
+CONCURRENCIA_MONITORES = int(os.getenv('CONCURRENCIA_MONITORES', '4'))  # Monitores cuyos webhooks se aplican en paralelo
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))  # Conexiones persistentes por servicio
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '30'))  # Timeout de lectura en segundos
+HTTP_TIMEOUT_CONEXION = float(os.getenv('HTTP_TIMEOUT_CONEXION', '5'))  # Timeout de conexión en segundos
+CIRCUITO_FALLOS = int(os.getenv('CIRCUITO_FALLOS', '5'))  # Fallos seguidos que abren el circuito de un servicio (0 = desactivado)
+CIRCUITO_ESPERA = float(os.getenv('CIRCUITO_ESPERA', '30'))  # Segundos con el circuito abierto antes de la llamada de prueba
+
+IP_CACHE_TTL = int(os.getenv('IP_CACHE_TTL', '30'))  # Segundos que se reutiliza la IP pública obtenida
+IP_CONSULTAS_PARALELAS = int(os.getenv('IP_CONSULTAS_PARALELAS', '3'))  # Proveedores de IP consultados a la vez
+
+DNS_CACHE_TTL = int(os.getenv('DNS_CACHE_TTL', '60'))  # Vigencia en segundos del snapshot de registros DNS por zona
+UNIFI_CACHE_TTL = int(os.getenv('UNIFI_CACHE_TTL', '60'))  # Vigencia en segundos del índice de rutas de Unifi
+
+VALIDACION_CACHE_TTL = int(os.getenv('VALIDACION_CACHE_TTL', '3600'))  # Vigencia en segundos de token y zonas verificados
+VALIDACION_REFRESCO = os.getenv('VALIDACION_REFRESCO', '1') == '1'  # Revalidación en segundo plano antes de caducar
+
+TRABAJOS_MAX = int(os.getenv('TRABAJOS_MAX', '100'))  # Trabajos de webhook conservados para /api/jobs
+DEBOUNCE_SEGUNDOS = float(os.getenv('DEBOUNCE_SEGUNDOS', '2'))  # Ventana para agrupar webhooks seguidos
+
+RECONCILIACION_INTERVALO = int(os.getenv('RECONCILIACION_INTERVALO', '0'))  # Segundos entre reconciliaciones (0 = desactivado)
+RECONCILIACION_JITTER = int(os.getenv('RECONCILIACION_JITTER', '30'))  # Segundos aleatorios añadidos a cada intervalo
+
+VIGILANCIA_IP_INTERVALO = int(os.getenv('VIGILANCIA_IP_INTERVALO', '0'))  # Segundos entre comprobaciones de la IP con la WAN de respaldo (0 = desactivado)
+
+WORKERS = max(1, int(os.getenv('WORKERS', '1')))  # Procesos de gunicorn
+THREADS = max(1, int(os.getenv('THREADS', '4')))  # Hilos por proceso de gunicorn
 
 TZ = os.getenv('TZ', 'Europe/Madrid')
 DEBUG = os.getenv('DEBUG', '0') == '1'
+LOG_JSON = os.getenv('LOG_JSON', '0') == '1'  # Log en JSON (una línea por registro, sin colores)
+LOG_ASINCRONO = os.getenv('LOG_ASINCRONO', '1') == '1'  # Escritura del log en un hilo aparte
+LOG_MAX_PAYLOAD = int(os.getenv('LOG_MAX_PAYLOAD', '2000'))  # Caracteres máximos de cada payload en modo debug (0 = sin límite)
+TRAZAS_EXPORTADOR = os.getenv('TRAZAS_EXPORTADOR', '').strip().lower()  # Exportación de trazas: fichero, otlp o vacío (desactivada)
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT', 'http://localhost:4318')  # Colector OpenTelemetry (OTLP/HTTP)
+OTEL_SERVICE_NAME = os.getenv('OTEL_SERVICE_NAME', 'unifi-pbr-cloudflare')  # Nombre del servicio en las trazas
 
 IMG_DISCORD_URL = 'https://github.com/unraiders/unifi-pbr-cloudflare/blob/main/imagenes/unifi-pbr-cloudflare.png?raw=true'
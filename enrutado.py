@@ -0,0 +1,150 @@
+import json
+import os
+import threading
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from config import FICHERO_RUTAS, NOMBRE_PBR, UNIFI_API_TOKEN, UNIFI_URL, ensure_https_url
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+CONTROLADOR_POR_DEFECTO = 'default'
+SITIO_POR_DEFECTO = 'default'
+TODOS_LOS_MONITORES = '*'
+
+class Controlador:
+    # Datos de acceso a un controlador Unifi.
+
+    def __init__(self, nombre: str, url: str, api_token: str, verificar_ssl: bool = False):
+        self.nombre = nombre
+        self.url = url
+        self.api_token = api_token
+        self.verificar_ssl = verificar_ssl
+
+class Destino:
+    # Ruta de un sitio de un controlador que se activa o desactiva con el evento.
+
+    def __init__(self, controlador: Controlador, sitio: str, ruta: str):
+        self.controlador = controlador
+        self.sitio = sitio
+        self.ruta = ruta
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"controlador": self.controlador.nombre, "sitio": self.sitio, "ruta": self.ruta}
+
+class Perfil:
+    # Lo que hace un evento de un monitor: reglas de Unifi y registros de zonas.json (None = todos).
+
+    def __init__(self, clave: str, destinos: List[Destino], zonas: Optional[FrozenSet[str]] = None):
+        self.clave = clave
+        self.destinos = destinos
+        self.zonas = zonas
+
+class ConfiguracionRutas:
+    # Controladores y perfiles por monitor, leídos de rutas.json.
+
+    def __init__(self, controladores: Dict[str, Controlador], monitores: Dict[str, Perfil]):
+        self.controladores = controladores
+        self.monitores = monitores
+
+    def destinos(self) -> List[Destino]:
+        return [destino for perfil in self.monitores.values() for destino in perfil.destinos]
+
+_lock = threading.Lock()
+# (mtime, configuración) del fichero de rutas
+_cache: Optional[Tuple[float, ConfiguracionRutas]] = None
+
+def _controlador_por_defecto() -> Controlador:
+    return Controlador(CONTROLADOR_POR_DEFECTO, UNIFI_URL, UNIFI_API_TOKEN)
+
+def _configuracion_por_defecto() -> ConfiguracionRutas:
+    # Sin rutas.json se controla NOMBRE_PBR en el sitio default de UNIFI_URL, como siempre.
+
+    controlador = _controlador_por_defecto()
+    destinos = [Destino(controlador, SITIO_POR_DEFECTO, NOMBRE_PBR)] if NOMBRE_PBR else []
+    perfil = Perfil(TODOS_LOS_MONITORES, destinos)
+    return ConfiguracionRutas({CONTROLADOR_POR_DEFECTO: controlador}, {TODOS_LOS_MONITORES: perfil})
+
+def _parsear(datos: Dict[str, Any]) -> ConfiguracionRutas:
+
+    controladores = {CONTROLADOR_POR_DEFECTO: _controlador_por_defecto()}
+    for nombre, c in (datos.get('controladores') or {}).items():
+        base = controladores.get(nombre)
+        url = ensure_https_url(c.get('url')) or (base.url if base else None)
+        api_token = c.get('api_token') or (base.api_token if base else None)
+        if not url or not api_token:
+            raise ValueError(f"El controlador '{nombre}' necesita url y api_token")
+        controladores[nombre] = Controlador(nombre, url, api_token, bool(c.get('verificar_ssl', False)))
+
+    monitores: Dict[str, Perfil] = {}
+    for monitor, valor in (datos.get('monitores') or {}).items():
+        # Una lista son solo reglas de Unifi (todas las zonas), un objeto es un perfil con "rutas" y "zonas"
+        if isinstance(valor, list):
+            lista, zonas = valor, None
+        elif isinstance(valor, dict):
+            lista = valor.get('rutas') or []
+            zonas = None
+            if 'zonas' in valor:
+                # Una cadena suelta se recorrería letra a letra y el perfil no seleccionaría ningún registro
+                if not isinstance(valor['zonas'], list) or not all(isinstance(z, str) for z in valor['zonas']):
+                    raise ValueError(f"Las zonas del monitor '{monitor}' deben ser una lista de nombres de registro")
+                zonas = frozenset(z.lower().rstrip('.') for z in valor['zonas'])
+        else:
+            raise ValueError(f"El monitor '{monitor}' debe ser una lista de reglas o un objeto con rutas y zonas")
+
+        destinos = []
+        for d in lista:
+            nombre = d.get('controlador', CONTROLADOR_POR_DEFECTO)
+            controlador = controladores.get(nombre)
+            if controlador is None:
+                raise ValueError(f"El monitor '{monitor}' usa el controlador '{nombre}' que no está definido")
+            if not controlador.url or not controlador.api_token:
+                raise ValueError(f"El controlador '{nombre}' no tiene url o api_token (UNIFI_URL / UNIFI_API_TOKEN)")
+            if not d.get('ruta'):
+                raise ValueError(f"Falta 'ruta' en un destino del monitor '{monitor}'")
+            destinos.append(Destino(controlador, d.get('sitio', SITIO_POR_DEFECTO), d['ruta']))
+        monitores[str(monitor)] = Perfil(str(monitor), destinos, zonas)
+
+    return ConfiguracionRutas(controladores, monitores)
+
+def cargar_configuracion() -> ConfiguracionRutas:
+    # Relee rutas.json solo cuando cambia su fecha de modificación. Si el fichero nuevo no es
+    # válido se mantiene la última configuración correcta.
+
+    global _cache
+    try:
+        mtime = os.stat(FICHERO_RUTAS).st_mtime
+    except FileNotFoundError:
+        return _configuracion_por_defecto()
+
+    with _lock:
+        if _cache is not None and _cache[0] == mtime:
+            return _cache[1]
+
+        try:
+            with open(FICHERO_RUTAS, 'r') as f:
+                configuracion = _parsear(json.load(f))
+        except Exception as e:
+            logger.error(f"Error al cargar el archivo rutas.json: {e}")
+            return _cache[1] if _cache is not None else _configuracion_por_defecto()
+
+        _cache = (mtime, configuracion)
+        logger.info(f"Cargados {len(configuracion.monitores)} perfiles de monitor con {len(configuracion.destinos())} reglas de Unifi desde rutas.json")
+        return configuracion
+
+def clave_monitor(monitor: Optional[Dict[str, Any]]) -> str:
+    # Entrada de rutas.json que corresponde al monitor del webhook: primero por id, luego por nombre
+    # y si no hay ninguna, la genérica "*".
+
+    monitores = cargar_configuracion().monitores
+    monitor = monitor or {}
+    for candidata in (monitor.get('id'), monitor.get('name')):
+        if candidata is not None and str(candidata) in monitores:
+            return str(candidata)
+    return TODOS_LOS_MONITORES
+
+def perfil(clave: str) -> Perfil:
+    # Sin perfil para la clave (rutas.json sin "*") no se toca Unifi y se procesan todas las zonas.
+
+    encontrado = cargar_configuracion().monitores.get(clave)
+    return encontrado if encontrado is not None else Perfil(clave, [])
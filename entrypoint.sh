@@ -9,6 +9,19 @@ echo "$(date +'%d-%m-%Y %H:%M:%S') - URL API Cloudflare: $CLOUDFLARE_API_URL" >&
 echo "$(date +'%d-%m-%Y %H:%M:%S') - Zona horaria: $TZ" >&2
 echo "$(date +'%d-%m-%Y %H:%M:%S') - Debug: $DEBUG" >&2
 
+# Workers (procesos) e hilos por worker. El estado compartido vive en /app/data/estado.db y cada
+# transición se aplica bajo un bloqueo por monitor, así que se pueden usar varios workers.
+WORKERS=${WORKERS:-1}
+THREADS=${THREADS:-4}
+echo "$(date +'%d-%m-%Y %H:%M:%S') - Workers: $WORKERS, hilos por worker: $THREADS" >&2
+
+# Con varios workers las métricas de Prometheus se agregan a través de ficheros
+if [ "$WORKERS" -gt 1 ]; then
+    export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
 echo "$(date +'%d-%m-%Y %H:%M:%S') - Arrancando servidor..." >&2
 
-exec gunicorn -w 1 -b 0.0.0.0:1666 unifi-pbr-cloudflare:app
\ No newline at end of file
+exec gunicorn -w "$WORKERS" -k gthread --threads "$THREADS" -b 0.0.0.0:1666 unifi-pbr-cloudflare:app
\ No newline at end of file
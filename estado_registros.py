@@ -0,0 +1,188 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+FICHERO_ESTADO = '/app/data/estado.db'
+
+# Valores que se guardan antes de un cambio para poder restaurarlos después
+CAMPOS = ('contenido_anterior', 'target_cname_anterior')
+
+# (zone_id, tipo, nombre)
+ClaveRegistro = Tuple[str, str, str]
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS registros (
+    zone_id TEXT NOT NULL,
+    tipo TEXT NOT NULL,
+    nombre TEXT NOT NULL,
+    contenido_anterior TEXT NOT NULL DEFAULT '',
+    target_cname_anterior TEXT NOT NULL DEFAULT '',
+    actualizado REAL NOT NULL,
+    PRIMARY KEY (zone_id, tipo, nombre)
+);
+CREATE TABLE IF NOT EXISTS transiciones (
+    clave TEXT PRIMARY KEY,
+    deseado INTEGER,
+    evento REAL NOT NULL DEFAULT 0,
+    aplicado INTEGER,
+    actualizado REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trabajos (
+    id TEXT PRIMARY KEY,
+    datos TEXT NOT NULL,
+    actualizado REAL NOT NULL
+);
+"""
+
+class AlmacenEstado:
+    # Valores anteriores de cada registro, estado de las transiciones y trabajos en SQLite (modo WAL).
+    # Cada actualización es una transacción de una sola fila y SQLite bloquea el fichero entre
+    # procesos, así que varios workers de gunicorn pueden leer y escribir a la vez sin corromperlo.
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._inicializado = False
+        self._lock = threading.Lock()
+
+    def _conexion(self) -> sqlite3.Connection:
+        # Una conexión por hilo, sqlite3 no permite compartirlas
+
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is not None:
+            return conexion
+
+        conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+        conexion.row_factory = sqlite3.Row
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("PRAGMA synchronous=FULL")
+        with self._lock:
+            if not self._inicializado:
+                conexion.executescript(ESQUEMA)
+                self._inicializado = True
+        self._local.conexion = conexion
+        return conexion
+
+    def obtener(self, clave: ClaveRegistro) -> Dict[str, str]:
+
+        fila = self._conexion().execute(
+            "SELECT contenido_anterior, target_cname_anterior FROM registros WHERE zone_id=? AND tipo=? AND nombre=?",
+            clave
+        ).fetchone()
+        if fila is None:
+            return {campo: '' for campo in CAMPOS}
+        return {campo: fila[campo] for campo in CAMPOS}
+
+    def guardar(self, clave: ClaveRegistro, valores: Dict[str, Optional[str]]):
+        # Actualiza de forma atómica solo los campos indicados del registro.
+
+        campos = [campo for campo in CAMPOS if campo in valores]
+        if not campos:
+            return
+
+        asignaciones = ", ".join(f"{campo}=excluded.{campo}" for campo in campos)
+        self._conexion().execute(
+            f"INSERT INTO registros (zone_id, tipo, nombre, {', '.join(campos)}, actualizado) "
+            f"VALUES (?, ?, ?, {', '.join('?' for _ in campos)}, ?) "
+            f"ON CONFLICT (zone_id, tipo, nombre) DO UPDATE SET {asignaciones}, actualizado=excluded.actualizado",
+            (*clave, *[valores[campo] or '' for campo in campos], time.time())
+        )
+
+    def importar(self, entradas: Iterable[Tuple[ClaveRegistro, Dict[str, Optional[str]]]]) -> int:
+        # Copia los valores anteriores que aún estén en zonas.json de registros que no están en el almacén.
+
+        importados = 0
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            for clave, valores in entradas:
+                if not any(valores.get(campo) for campo in CAMPOS):
+                    continue
+                cursor = conexion.execute(
+                    "INSERT OR IGNORE INTO registros (zone_id, tipo, nombre, contenido_anterior, target_cname_anterior, actualizado) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (*clave, valores.get('contenido_anterior') or '', valores.get('target_cname_anterior') or '', time.time())
+                )
+                importados += cursor.rowcount
+            conexion.execute("COMMIT")
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+
+        if importados:
+            logger.info(f"Importados {importados} valores anteriores de zonas.json al almacén de estado")
+        return importados
+
+    def registrar_evento(self, clave: str, deseado: bool, instante: float):
+        # Último estado pedido para la clave, sea cual sea el worker que recibió el webhook.
+
+        self._conexion().execute(
+            "INSERT INTO transiciones (clave, deseado, evento, actualizado) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (clave) DO UPDATE SET deseado=excluded.deseado, evento=excluded.evento, "
+            "actualizado=excluded.actualizado WHERE excluded.evento >= transiciones.evento",
+            (clave, int(deseado), instante, time.time())
+        )
+
+    def obtener_transicion(self, clave: str) -> Dict[str, Any]:
+
+        fila = self._conexion().execute(
+            "SELECT deseado, evento, aplicado FROM transiciones WHERE clave=?", (clave,)
+        ).fetchone()
+        if fila is None:
+            return {"deseado": None, "evento": 0.0, "aplicado": None}
+        return {
+            "deseado": None if fila['deseado'] is None else bool(fila['deseado']),
+            "evento": fila['evento'],
+            "aplicado": None if fila['aplicado'] is None else bool(fila['aplicado']),
+        }
+
+    def transiciones(self) -> Dict[str, Dict[str, Any]]:
+        # Estado de todas las claves que han recibido algún webhook.
+
+        filas = self._conexion().execute(
+            "SELECT clave, deseado, evento, aplicado FROM transiciones WHERE deseado IS NOT NULL"
+        ).fetchall()
+        return {
+            fila['clave']: {
+                "deseado": bool(fila['deseado']),
+                "evento": fila['evento'],
+                "aplicado": None if fila['aplicado'] is None else bool(fila['aplicado']),
+            }
+            for fila in filas
+        }
+
+    def marcar_aplicado(self, clave: str, aplicado: Optional[bool]):
+
+        self._conexion().execute(
+            "INSERT INTO transiciones (clave, aplicado, actualizado) VALUES (?, ?, ?) "
+            "ON CONFLICT (clave) DO UPDATE SET aplicado=excluded.aplicado, actualizado=excluded.actualizado",
+            (clave, None if aplicado is None else int(aplicado), time.time())
+        )
+
+    def guardar_trabajo(self, trabajo_id: str, datos: Dict[str, Any], maximo: Optional[int] = None):
+        # Copia del trabajo para que /api/jobs responda desde cualquier worker. Con maximo se borran
+        # los más antiguos y se conservan los últimos.
+
+        conexion = self._conexion()
+        conexion.execute(
+            "INSERT OR REPLACE INTO trabajos (id, datos, actualizado) VALUES (?, ?, ?)",
+            (trabajo_id, json.dumps(datos, default=str), time.time())
+        )
+        if maximo is not None:
+            conexion.execute(
+                "DELETE FROM trabajos WHERE id NOT IN (SELECT id FROM trabajos ORDER BY actualizado DESC LIMIT ?)",
+                (maximo,)
+            )
+
+    def obtener_trabajo(self, trabajo_id: str) -> Optional[Dict[str, Any]]:
+
+        fila = self._conexion().execute("SELECT datos FROM trabajos WHERE id=?", (trabajo_id,)).fetchone()
+        return json.loads(fila['datos']) if fila is not None else None
+
+almacen_estado = AlmacenEstado(FICHERO_ESTADO)
@@ -0,0 +1,155 @@
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metricas
+import trazas
+from circuito import CircuitoAbierto, obtener_circuito
+from config import (
+    CLOUDFLARE_LIMITE,
+    CLOUDFLARE_RAFAGA,
+    CONCURRENCIA_ZONAS,
+    HTTP_POOL_SIZE,
+    HTTP_TIMEOUT,
+    HTTP_TIMEOUT_CONEXION,
+    WORKERS,
+)
+from planificador import CONSULTA, ESCRITURA, Planificador, segundos_retry_after
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+# Servicios externos con sesión propia
+CLOUDFLARE = 'cloudflare'
+UNIFI = 'unifi'
+IP = 'ip'
+NOTIFICACIONES = 'notificaciones'
+
+# Ventana en segundos del límite de peticiones de la API de Cloudflare
+VENTANA_CLOUDFLARE = 300
+
+class SesionHTTP(requests.Session):
+    # Sesión con conexiones persistentes (keep-alive) y timeout por defecto.
+
+    def __init__(self, nombre: str, pool_size: int, timeout: Tuple[float, float], verify: bool = True):
+        super().__init__()
+        self.nombre = nombre
+        self.timeout = timeout
+        self.verify = verify
+        self.planificador: Optional[Planificador] = None
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        # Sin la query en la span, y sin la ruta en las notificaciones: el webhook de Discord lleva el token en ella
+        partes = urlsplit(url)
+        ruta = '' if self.nombre == NOTIFICACIONES else partes.path
+        with trazas.span(f"{self.nombre} {method.upper()}", **{
+            "http.method": method.upper(),
+            "http.url": f"{partes.scheme}://{partes.netloc}{ruta}",
+            "servicio": self.nombre,
+        }) as s:
+            response = self._request(method, url, partes.netloc, s, **kwargs)
+            s.atributo("http.status_code", response.status_code)
+            if response.status_code >= 400:
+                s.marcar_error(f"HTTP {response.status_code}")
+            return response
+
+    def _request(self, method, url, host: str, s: trazas.Span, **kwargs):
+        # Un circuito por servicio y host: cada controlador y cada proveedor de IP falla por separado
+        circuito = obtener_circuito(f"{self.nombre}/{host}")
+        if not circuito.permitir():
+            raise CircuitoAbierto(f"Circuito de {circuito.nombre} abierto, llamada rechazada sin esperar al timeout")
+
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        # Si no se indica, requests prioriza REQUESTS_CA_BUNDLE sobre self.verify
+        if kwargs.get('verify') is None:
+            kwargs['verify'] = self.verify
+
+        prioridad = kwargs.pop('prioridad', None)
+        if self.planificador is not None:
+            if prioridad is None:
+                prioridad = CONSULTA if method.upper() == 'GET' else ESCRITURA
+            inicio = time.perf_counter()
+            self.planificador.adquirir(prioridad)
+            s.atributo("espera_planificador", round(time.perf_counter() - inicio, 3))
+
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.Timeout as e:
+            metricas.registrar_timeout(self.nombre)
+            circuito.fallo(f"Timeout: {e}")
+            raise
+        except requests.RequestException as e:
+            metricas.registrar_error(self.nombre)
+            circuito.fallo(f"{type(e).__name__}: {e}")
+            raise
+        except Exception as e:
+            circuito.fallo(f"{type(e).__name__}: {e}")
+            raise
+
+        # Un 429 no es una caída, lo gestiona el planificador
+        if response.status_code >= 500:
+            circuito.fallo(f"HTTP {response.status_code}")
+        else:
+            circuito.exito()
+        metricas.registrar_respuesta(self.nombre, response.status_code)
+        if response.status_code == 429 and self.planificador is not None:
+            self.planificador.bloquear(segundos_retry_after(response.headers.get('Retry-After')))
+        return response
+
+_sesiones: Dict[str, SesionHTTP] = {}
+_lock = threading.Lock()
+
+def _pool_por_defecto(nombre: str) -> int:
+
+    # Cloudflare necesita al menos una conexión por hilo de zona
+    if nombre == CLOUDFLARE:
+        return max(HTTP_POOL_SIZE, CONCURRENCIA_ZONAS)
+    return HTTP_POOL_SIZE
+
+def obtener_sesion(nombre: str, verify: bool = True, pool_size: Optional[int] = None) -> SesionHTTP:
+    # Devuelve la sesión compartida del servicio indicado, creándola la primera vez.
+
+    sesion = _sesiones.get(nombre)
+    if sesion is not None:
+        return sesion
+
+    with _lock:
+        sesion = _sesiones.get(nombre)
+        if sesion is None:
+            if pool_size is None:
+                pool_size = _pool_por_defecto(nombre)
+            sesion = SesionHTTP(
+                nombre,
+                pool_size,
+                (HTTP_TIMEOUT_CONEXION, HTTP_TIMEOUT),
+                verify=verify
+            )
+            if nombre == CLOUDFLARE:
+                # Todas las llamadas a Cloudflare comparten el cupo de peticiones del token,
+                # repartido entre los workers de gunicorn
+                sesion.planificador = Planificador(CLOUDFLARE, max(1, CLOUDFLARE_LIMITE // WORKERS),
+                                                   VENTANA_CLOUDFLARE, max(1, CLOUDFLARE_RAFAGA // WORKERS))
+            _sesiones[nombre] = sesion
+            logger.debug(f"Sesión HTTP '{nombre}' creada (pool={pool_size}, verify={verify})")
+        return sesion
+
+def cerrar_sesiones():
+
+    with _lock:
+        for sesion in _sesiones.values():
+            sesion.close()
+        _sesiones.clear()
+
+def planificadores() -> Dict[str, Dict[str, float]]:
+
+    return {nombre: sesion.planificador.estadisticas()
+            for nombre, sesion in list(_sesiones.items()) if sesion.planificador is not None}
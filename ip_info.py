@@ -1,40 +1,190 @@
-import re
-
-import requests
+import contextvars
+import ipaddress
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
 
+from config import IP_CACHE_TTL, IP_CONSULTAS_PARALELAS
+from http_client import IP, obtener_sesion
+from metricas import medir
 from utils import setup_logger
 
 logger = setup_logger(__name__)
 
-def obtener_ip_publica():
-
-    def try_get_ip(urls):
-        for url in urls:
-            try:
-                response = requests.get(url.strip(), timeout=10.0)
-                if response.status_code == 200:
-                    ip_pattern = re.compile(r'^(\d{1,3}\.){3}\d{1,3}$')
-                    ip = response.text.strip()
-                    if ip_pattern.match(ip):
-                        return ip, url.strip()
-            except Exception as e:
-                logger.debug(f"Error al obtener IP de {url.strip()}: {str(e)}")
-                continue
-        return None, None
+FICHEROS_URLS = {
+    4: '/app/data/check_ip.txt',
+    6: '/app/data/check_ip6.txt',
+}
+
+TIMEOUT_PROVEEDOR = 10.0
+
+_executor = ThreadPoolExecutor(max_workers=max(1, IP_CONSULTAS_PARALELAS) * 2, thread_name_prefix="ip")
+_lock = threading.Lock()
+
+# Fichero -> (mtime, urls)
+_urls_cache: Dict[str, Tuple[float, List[str]]] = {}
+# Versión -> (ip, instante)
+_ip_cache: Dict[int, Tuple[str, float]] = {}
+# URL -> puntuación del proveedor
+_puntuaciones: Dict[str, Dict[str, float]] = {}
+# URL -> (ETag, Last-Modified, ip) de la última respuesta, para las consultas condicionales
+_validadores: Dict[str, Tuple[Optional[str], Optional[str], str]] = {}
+
+def _cargar_urls(fichero: str) -> List[str]:
+    # Relee el fichero solo cuando cambia su fecha de modificación.
+
+    mtime = os.stat(fichero).st_mtime
+    cacheado = _urls_cache.get(fichero)
+    if cacheado and cacheado[0] == mtime:
+        return cacheado[1]
+
+    with open(fichero, 'r') as file:
+        urls = [linea.strip() for linea in file if linea.strip() and not linea.strip().startswith('#')]
+
+    _urls_cache[fichero] = (mtime, urls)
+    logger.debug(f"Cargadas {len(urls)} URLs de {fichero}")
+    return urls
+
+def _registrar(url: str, exito: bool, latencia: float):
+
+    with _lock:
+        p = _puntuaciones.setdefault(url, {"exitos": 0, "fallos": 0, "latencia": latencia})
+        p["exitos" if exito else "fallos"] += 1
+        # Media móvil para que un proveedor que se recupera vuelva a subir
+        p["latencia"] = 0.7 * p["latencia"] + 0.3 * latencia
+
+def _ordenar(urls: List[str]) -> List[str]:
+    # Primero los proveedores con más aciertos y menor latencia, los desconocidos se prueban pronto.
+
+    def clave(url: str):
+        p = _puntuaciones.get(url)
+        if p is None:
+            return (0.0, 0.0)
+        total = p["exitos"] + p["fallos"]
+        return (p["fallos"] / total, p["latencia"])
+
+    with _lock:
+        return sorted(urls, key=clave)
+
+def puntuaciones() -> Dict[str, Dict[str, float]]:
+
+    with _lock:
+        return {url: dict(p) for url, p in _puntuaciones.items()}
+
+def _consultar(url: str, version: int) -> Optional[str]:
+
+    inicio = time.monotonic()
+    try:
+        response = obtener_sesion(IP).get(url, timeout=TIMEOUT_PROVEEDOR)
+        if response.status_code == 200:
+            ip = response.text.strip()
+            if ipaddress.ip_address(ip).version == version:
+                _registrar(url, True, time.monotonic() - inicio)
+                return ip
+    except Exception as e:
+        logger.debug(f"Error al obtener IP de {url}: {str(e)}")
+
+    _registrar(url, False, time.monotonic() - inicio)
+    return None
+
+def _primera_ip(urls: List[str], version: int) -> Tuple[Optional[str], Optional[str]]:
+    # Lanza las consultas en paralelo por tandas y se queda con la primera respuesta válida.
+
+    pendientes = list(urls)
+    en_curso = {}
+
+    while pendientes or en_curso:
+        while pendientes and len(en_curso) < max(1, IP_CONSULTAS_PARALELAS):
+            url = pendientes.pop(0)
+            # Con la copia del contexto la consulta queda en la traza de quien pide la IP
+            en_curso[_executor.submit(contextvars.copy_context().run, _consultar, url, version)] = url
+
+        hechos, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+        for futuro in hechos:
+            url = en_curso.pop(futuro)
+            ip = futuro.result()
+            if ip:
+                # Las consultas que siguen en marcha terminan solas y solo actualizan su puntuación
+                for otro in en_curso:
+                    otro.cancel()
+                return ip, url
+
+    return None, None
+
+def _consultar_condicional(url: str, version: int) -> Optional[str]:
+    # Consulta con If-None-Match / If-Modified-Since si el proveedor los devolvió: un 304 confirma
+    # que la IP no ha cambiado sin descargar nada.
+
+    cabeceras = {}
+    validador = _validadores.get(url)
+    if validador:
+        etag, modificado, _ = validador
+        if etag:
+            cabeceras['If-None-Match'] = etag
+        if modificado:
+            cabeceras['If-Modified-Since'] = modificado
+
+    inicio = time.monotonic()
+    try:
+        response = obtener_sesion(IP).get(url, headers=cabeceras, timeout=TIMEOUT_PROVEEDOR)
+        if response.status_code == 304 and validador:
+            _registrar(url, True, time.monotonic() - inicio)
+            return validador[2]
+        if response.status_code == 200:
+            ip = response.text.strip()
+            if ipaddress.ip_address(ip).version == version:
+                _registrar(url, True, time.monotonic() - inicio)
+                etag, modificado = response.headers.get('ETag'), response.headers.get('Last-Modified')
+                if etag or modificado:
+                    _validadores[url] = (etag, modificado, ip)
+                return ip
+    except Exception as e:
+        logger.debug(f"Error al obtener IP de {url}: {str(e)}")
+
+    _registrar(url, False, time.monotonic() - inicio)
+    return None
+
+def comprobar_ip_publica(version: int = 4) -> Optional[str]:
+    # Consulta barata para vigilar la IP: una sola petición (condicional) al mejor proveedor y, solo
+    # si falla, la consulta normal a todos.
+
+    try:
+        urls = _ordenar(_cargar_urls(FICHEROS_URLS[version]))
+    except Exception as e:
+        logger.error(f'Error al leer el archivo {os.path.basename(FICHEROS_URLS[version])}: {str(e)}')
+        return None
+
+    ip = _consultar_condicional(urls[0], version) if urls else None
+    if ip:
+        _ip_cache[version] = (ip, time.monotonic())
+        return ip
+    return obtener_ip_publica(version, usar_cache=False)
+
+@medir('obtener_ip_publica')
+def obtener_ip_publica(version: int = 4, usar_cache: bool = True) -> Optional[str]:
+
+    if usar_cache:
+        cacheada = _ip_cache.get(version)
+        if cacheada and time.monotonic() - cacheada[1] < IP_CACHE_TTL:
+            logger.debug("IP pública (IPv%s) desde cache: %s", version, cacheada[0])
+            return cacheada[0]
 
     # Leer las URLs del archivo
+    fichero = FICHEROS_URLS[version]
     try:
-        with open('/app/data/check_ip.txt', 'r') as file:
-            urls = file.readlines()
+        urls = _ordenar(_cargar_urls(fichero))
 
-        ip, url_usado = try_get_ip(urls)
+        ip, url_usado = _primera_ip(urls, version)
         if ip:
-            logger.debug(f'Dirección IP pública desde {url_usado} es: {ip}')
+            _ip_cache[version] = (ip, time.monotonic())
+            logger.debug("Dirección IP pública desde %s es: %s", url_usado, ip)
             logger.info(f'IP pública obtenida: {ip}')
             return ip
         else:
-            logger.error('No se pudo obtener la IP pública de ninguna de las URLs disponibles')
+            logger.error(f'No se pudo obtener la IP pública (IPv{version}) de ninguna de las URLs disponibles')
             return None
     except Exception as e:
-        logger.error(f'Error al leer el archivo check_ip.txt o procesar URLs: {str(e)}')
+        logger.error(f'Error al leer el archivo {os.path.basename(fichero)} o procesar URLs: {str(e)}')
         return None
@@ -0,0 +1,188 @@
+import contextvars
+import functools
+import math
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+import trazas
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Zona y ruta que se están procesando en el hilo actual, para etiquetar las llamadas HTTP
+zona_actual: contextvars.ContextVar = contextvars.ContextVar("zona_actual", default="")
+ruta_actual: contextvars.ContextVar = contextvars.ContextVar("ruta_actual", default="")
+
+WEBHOOK_SEGUNDOS = Histogram(
+    'unifi_pbr_webhook_segundos',
+    'Tiempo desde la recepción del webhook hasta el final de su procesamiento',
+    buckets=BUCKETS
+)
+
+ETAPA_SEGUNDOS = Histogram(
+    'unifi_pbr_etapa_segundos',
+    'Duración de cada etapa del procesamiento',
+    ['etapa'],
+    buckets=BUCKETS
+)
+
+UPSTREAM_PETICIONES = Counter(
+    'unifi_pbr_upstream_peticiones_total',
+    'Respuestas HTTP recibidas de los servicios externos por código de estado',
+    ['servicio', 'codigo', 'zona', 'ruta']
+)
+
+UPSTREAM_REINTENTOS = Counter(
+    'unifi_pbr_upstream_reintentos_total',
+    'Reintentos de llamadas a servicios externos',
+    ['servicio', 'zona', 'ruta']
+)
+
+UPSTREAM_TIMEOUTS = Counter(
+    'unifi_pbr_upstream_timeouts_total',
+    'Timeouts en llamadas a servicios externos',
+    ['servicio', 'zona', 'ruta']
+)
+
+UPSTREAM_ERRORES = Counter(
+    'unifi_pbr_upstream_errores_total',
+    'Errores de conexión en llamadas a servicios externos',
+    ['servicio', 'zona', 'ruta']
+)
+
+PLANIFICADOR_COLA = Gauge(
+    'unifi_pbr_planificador_cola',
+    'Peticiones esperando turno por el límite de peticiones del servicio',
+    ['servicio'],
+    multiprocess_mode='livesum'
+)
+
+PLANIFICADOR_ESPERA = Histogram(
+    'unifi_pbr_planificador_espera_segundos',
+    'Tiempo que una petición espera por el límite de peticiones del servicio',
+    ['servicio'],
+    buckets=BUCKETS
+)
+
+IP_CAMBIOS = Counter(
+    'unifi_pbr_ip_cambios_total',
+    'Cambios de IP pública detectados mientras se usa la WAN de respaldo',
+    ['version']
+)
+
+IP_DETECCION_SEGUNDOS = Histogram(
+    'unifi_pbr_ip_deteccion_segundos',
+    'Tiempo máximo entre un cambio de IP pública y su detección (desde la última consulta con la IP anterior)',
+    ['version'],
+    buckets=BUCKETS
+)
+
+IP_PROPAGACION_SEGUNDOS = Histogram(
+    'unifi_pbr_ip_propagacion_segundos',
+    'Tiempo desde que se detecta un cambio de IP pública hasta que los registros quedan actualizados',
+    ['version'],
+    buckets=BUCKETS
+)
+
+class _ColectorEstadisticas:
+    # Publica como métricas los contadores internos (caches, notificaciones...) en cada scrape.
+
+    def __init__(self):
+        self.fuentes: Dict[str, tuple] = {}
+
+    def collect(self):
+        for nombre, (descripcion, funcion) in list(self.fuentes.items()):
+            familia = GaugeMetricFamily(f'unifi_pbr_{nombre}', descripcion, labels=['clave'])
+            for clave, valor in funcion().items():
+                if isinstance(valor, (int, float)):
+                    familia.add_metric([clave], valor)
+            yield familia
+
+_colector = _ColectorEstadisticas()
+REGISTRY.register(_colector)
+
+def registrar_estadisticas(nombre: str, descripcion: str, funcion: Callable[[], Dict[str, float]]):
+    _colector.fuentes[nombre] = (descripcion, funcion)
+
+def duracion_media(etapa: str) -> Optional[float]:
+    # Duración media de la etapa en este proceso, None si aún no se ha ejecutado nunca.
+
+    suma = cuenta = 0.0
+    for metrica in ETAPA_SEGUNDOS.collect():
+        for muestra in metrica.samples:
+            if muestra.labels.get('etapa') != etapa:
+                continue
+            if muestra.name.endswith('_sum'):
+                suma = muestra.value
+            elif muestra.name.endswith('_count'):
+                cuenta = muestra.value
+    return suma / cuenta if cuenta else None
+
+def estimar_segundos(etapa: str, llamadas: int, paralelas: int, por_defecto: float, espera_cupo: float = 0.0) -> float:
+    # Tiempo aproximado de `llamadas` a la etapa repartidas en `paralelas` hilos, con la duración
+    # media medida (o la indicada si aún no hay medidas) y sin bajar de la espera por el cupo.
+
+    if llamadas <= 0:
+        return 0.0
+    duracion = duracion_media(etapa) or por_defecto
+    return round(max(math.ceil(llamadas / max(1, paralelas)) * duracion, espera_cupo), 2)
+
+def medir(etapa: str):
+    # Decorador que registra la duración de la función en el histograma de etapas y en una span de la traza.
+
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                with trazas.span(etapa):
+                    return funcion(*args, **kwargs)
+            finally:
+                ETAPA_SEGUNDOS.labels(etapa=etapa).observe(time.perf_counter() - inicio)
+        return envoltura
+    return decorador
+
+@contextmanager
+def etiquetas(zona: Optional[str] = None, ruta: Optional[str] = None):
+    # Fija la zona y/o ruta con la que se etiquetan las llamadas HTTP dentro del bloque.
+
+    tokens = []
+    if zona is not None:
+        tokens.append((zona_actual, zona_actual.set(zona)))
+    if ruta is not None:
+        tokens.append((ruta_actual, ruta_actual.set(ruta)))
+    try:
+        yield
+    finally:
+        for variable, token in reversed(tokens):
+            variable.reset(token)
+
+def registrar_respuesta(servicio: str, codigo: int):
+    UPSTREAM_PETICIONES.labels(servicio=servicio, codigo=str(codigo), zona=zona_actual.get(), ruta=ruta_actual.get()).inc()
+
+def registrar_reintento(servicio: str):
+    UPSTREAM_REINTENTOS.labels(servicio=servicio, zona=zona_actual.get(), ruta=ruta_actual.get()).inc()
+
+def registrar_timeout(servicio: str):
+    UPSTREAM_TIMEOUTS.labels(servicio=servicio, zona=zona_actual.get(), ruta=ruta_actual.get()).inc()
+
+def registrar_error(servicio: str):
+    UPSTREAM_ERRORES.labels(servicio=servicio, zona=zona_actual.get(), ruta=ruta_actual.get()).inc()
+
+def exportar():
+    # Devuelve (contenido, content_type) en formato de exposición de Prometheus. Con varios workers
+    # (PROMETHEUS_MULTIPROC_DIR definido) se suman los valores de todos los procesos; los contadores
+    # internos de caches y colas son los del worker que atiende la petición.
+
+    if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        return generate_latest(), CONTENT_TYPE_LATEST
+
+    registro = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registro)
+    registro.register(_colector)
+    return generate_latest(registro), CONTENT_TYPE_LATEST
@@ -0,0 +1,187 @@
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import telebot
+
+import metricas
+from config import (
+    CLIENTE_NOTIFICACION,
+    DISCORD_WEBHOOK,
+    IMG_DISCORD_URL,
+    INITIAL_DELAY,
+    NOTIFICACIONES_COLA_MAX,
+    NOTIFICACIONES_REINTENTOS,
+    TELEGRAM_BOT_TOKEN,
+    TELEGRAM_CHAT_ID,
+)
+from http_client import NOTIFICACIONES, obtener_sesion
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+BACKOFF_INICIAL = 2.0
+BACKOFF_MAXIMO = 60.0
+
+# Sesión persistente compartida por Discord y por Telegram
+notificaciones_session = obtener_sesion(NOTIFICACIONES)
+telebot.apihelper.session = notificaciones_session
+telebot.apihelper.SESSION_TIME_TO_LIVE = None
+
+# (mensaje, título, parse_mode)
+Notificacion = Tuple[str, str, Optional[str]]
+
+_cola: "queue.Queue[Notificacion]" = queue.Queue(maxsize=NOTIFICACIONES_COLA_MAX)
+_hilo: Optional[threading.Thread] = None
+_lock = threading.Lock()
+_bot: Optional[telebot.TeleBot] = None
+
+_estadisticas = {
+    "encoladas": 0,
+    "enviadas": 0,
+    "fallidas": 0,
+    "descartadas": 0,
+    "reintentos": 0,
+    "agrupadas": 0,
+}
+
+def _contar(clave: str, valor: int = 1):
+    with _lock:
+        _estadisticas[clave] += valor
+
+def estadisticas() -> Dict[str, int]:
+
+    with _lock:
+        return dict(_estadisticas, en_cola=_cola.qsize(), capacidad=NOTIFICACIONES_COLA_MAX)
+
+def send_notification(message, title, parse_mode=None) -> bool:
+    # Encola la notificación y vuelve inmediatamente, el envío se hace en segundo plano.
+
+    if not CLIENTE_NOTIFICACION:
+        return False
+
+    if CLIENTE_NOTIFICACION not in ("telegram", "discord"):
+        logger.error(f"Cliente de notificación no soportado: {CLIENTE_NOTIFICACION}")
+        return False
+
+    try:
+        _cola.put_nowait((message, title, parse_mode))
+    except queue.Full:
+        _contar("descartadas")
+        logger.warning(f"Cola de notificaciones llena ({NOTIFICACIONES_COLA_MAX}). Notificación descartada: {title}")
+        return False
+
+    _contar("encoladas")
+    _arrancar_hilo()
+    return True
+
+def notificar_evento(partes: List[Tuple[str, str]], parse_mode=None) -> bool:
+    # Une en un solo mensaje los resultados de un mismo evento (Cloudflare, Unifi...).
+
+    if not partes:
+        return False
+
+    mensaje = "\n".join(mensaje for mensaje, _ in partes)
+    titulo = " / ".join(dict.fromkeys(titulo for _, titulo in partes))
+    return send_notification(mensaje, titulo, parse_mode=parse_mode)
+
+def _arrancar_hilo():
+
+    global _hilo
+    if _hilo is not None:
+        return
+    with _lock:
+        if _hilo is None:
+            _hilo = threading.Thread(target=_bucle_envio, name="notificaciones", daemon=True)
+            _hilo.start()
+
+def _bucle_envio():
+
+    while True:
+        lote = [_cola.get()]
+
+        # Margen para que el cambio de ruta se asiente antes de enviar, sin bloquear el webhook
+        if INITIAL_DELAY > 0:
+            time.sleep(INITIAL_DELAY)
+
+        # Lo que haya llegado mientras tanto se envía en el mismo mensaje
+        while True:
+            try:
+                lote.append(_cola.get_nowait())
+            except queue.Empty:
+                break
+
+        if len(lote) > 1:
+            _contar("agrupadas", len(lote) - 1)
+
+        mensaje = "\n".join(n[0] for n in lote)
+        titulo = " / ".join(dict.fromkeys(n[1] for n in lote))
+        parse_mode = lote[0][2]
+
+        try:
+            if _enviar_con_reintentos(mensaje, titulo, parse_mode):
+                _contar("enviadas")
+            else:
+                _contar("fallidas")
+        except Exception as e:
+            _contar("fallidas")
+            logger.error(f"Error inesperado al enviar notificación: {str(e)}")
+        finally:
+            for _ in lote:
+                _cola.task_done()
+
+@metricas.medir('send_notification')
+def _enviar_con_reintentos(message, title, parse_mode) -> bool:
+
+    for attempt in range(NOTIFICACIONES_REINTENTOS):
+        try:
+            if CLIENTE_NOTIFICACION == "telegram":
+                _enviar_telegram(message, parse_mode)
+            else:
+                _enviar_discord(message, title)
+            return True
+        except Exception as e:
+            logger.debug(f"Intento {attempt+1}/{NOTIFICACIONES_REINTENTOS}: Error al enviar notificación a {CLIENTE_NOTIFICACION}: {str(e)}.")
+            if attempt < NOTIFICACIONES_REINTENTOS - 1:
+                _contar("reintentos")
+                metricas.registrar_reintento(NOTIFICACIONES)
+                time.sleep(min(BACKOFF_MAXIMO, BACKOFF_INICIAL * (2 ** attempt)))
+            else:
+                logger.error(f"Error al enviar notificación a {CLIENTE_NOTIFICACION} después de {NOTIFICACIONES_REINTENTOS} intentos: {str(e)}.")
+    return False
+
+def _enviar_telegram(message, parse_mode):
+
+    global _bot
+    if not (TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID):
+        raise ValueError("TELEGRAM_BOT_TOKEN o TELEGRAM_CHAT_ID no están configurados")
+
+    if _bot is None:
+        _bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
+    _bot.send_message(TELEGRAM_CHAT_ID, message, parse_mode=parse_mode)
+    logger.info("Notificación enviada a Telegram correctamente.")
+
+def _enviar_discord(message, title):
+
+    message = message.replace("<b>", "**").replace("</b>", "**")
+
+    # Payload con embeds para incluir imagen
+    payload = {
+        "avatar_url": IMG_DISCORD_URL,
+        "embeds": [
+            {
+                "title": title,
+                "description": message,
+                "color": 6018047,
+                "thumbnail": {"url": IMG_DISCORD_URL}
+            }
+        ]
+    }
+
+    response = notificaciones_session.post(DISCORD_WEBHOOK, json=payload)
+
+    if response.status_code == 204:  # Discord devuelve 204 cuando es exitoso
+        logger.info("Notificación enviada a Discord correctamente.")
+    else:
+        raise RuntimeError(f"Error al enviar mensaje a Discord. Status code: {response.status_code}")
@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from estado_registros import almacen_estado
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+FICHERO_ZONAS = '/app/data/zonas.json'
+
+TIPOS_DIRECCION = ('A', 'AAAA')
+CAMPOS_BOOLEANOS = ('cambiar_ip', 'cambiar_proxied')
+CAMPOS_TEXTO = ('target_cname', 'contenido_anterior', 'target_cname_anterior')
+
+class OperacionZona:
+    # Entrada validada de zonas.json con todo lo que no cambia entre webhooks ya resuelto.
+
+    __slots__ = ('indice', 'zone_id', 'nombre', 'tipo', 'target_cname', 'cambiar_ip', 'cambiar_proxied', 'registro_id')
+
+    def __init__(self, indice: int, zone_id: str, nombre: str, tipo: str, target_cname: str,
+                 cambiar_ip: bool, cambiar_proxied: bool):
+        self.indice = indice
+        self.zone_id = zone_id
+        self.nombre = nombre
+        self.tipo = tipo
+        self.target_cname = target_cname
+        self.cambiar_ip = cambiar_ip
+        self.cambiar_proxied = cambiar_proxied
+        # ID del registro en Cloudflare, se resuelve con la primera búsqueda y se conserva entre recargas
+        self.registro_id: Optional[str] = _ids_resueltos.get(self.clave)
+
+    @property
+    def clave(self) -> Tuple[str, str, str]:
+        return self.zone_id, self.tipo, self.nombre.lower().rstrip('.')
+
+    @property
+    def necesita_ip(self) -> bool:
+        return self.cambiar_ip and self.tipo != 'CNAME'
+
+    def resolver(self, registro_id: Optional[str]):
+        self.registro_id = registro_id
+        if registro_id:
+            _ids_resueltos[self.clave] = registro_id
+        else:
+            _ids_resueltos.pop(self.clave, None)
+
+class PlanZonas:
+    # Operaciones válidas de zonas.json junto con las entradas originales. El fichero es solo
+    # configuración: los valores anteriores viven en el almacén de estado.
+
+    __slots__ = ('mtime', 'zonas', 'operaciones', 'errores')
+
+    def __init__(self, mtime: float, zonas: List[Dict[str, Any]], operaciones: List[OperacionZona], errores: List[str]):
+        self.mtime = mtime
+        self.zonas = zonas
+        self.operaciones = operaciones
+        self.errores = errores
+
+    def seleccionar(self, registros: Optional[Set[str]] = None) -> List[OperacionZona]:
+        # Operaciones de los registros indicados (nombres en minúsculas), o todas.
+
+        if registros is None:
+            return list(self.operaciones)
+        return [op for op in self.operaciones if op.clave[2] in registros]
+
+_ids_resueltos: Dict[Tuple[str, str, str], str] = {}
+_lock = threading.Lock()
+_plan: Optional[PlanZonas] = None
+
+def _validar(indice: int, zona: Any) -> OperacionZona:
+    # Devuelve la operación de la entrada o lanza ValueError con el motivo.
+
+    if not isinstance(zona, dict):
+        raise ValueError("no es un objeto")
+
+    zone_id = zona.get('id_zona')
+    nombre = zona.get('name') or zona.get('nombre')
+    if not isinstance(zone_id, str) or not zone_id:
+        raise ValueError("falta id_zona")
+    if not isinstance(nombre, str) or not nombre:
+        raise ValueError("falta nombre/name")
+
+    for campo in CAMPOS_BOOLEANOS:
+        if not isinstance(zona.get(campo, False), bool):
+            raise ValueError(f"{campo} debe ser true o false")
+    for campo in CAMPOS_TEXTO:
+        if not isinstance(zona.get(campo) or '', str):
+            raise ValueError(f"{campo} debe ser un texto")
+
+    tipo = str(zona.get('tipo', 'A')).upper()
+    if tipo not in TIPOS_DIRECCION:
+        raise ValueError(f"tipo {zona.get('tipo')} no soportado (A o AAAA)")
+
+    target_cname = zona.get('target_cname') or ''
+    if target_cname:
+        tipo = 'CNAME'
+
+    operacion = OperacionZona(indice, zone_id, nombre, tipo, target_cname,
+                              zona.get('cambiar_ip', False), zona.get('cambiar_proxied', False))
+    if not (target_cname or operacion.cambiar_ip or operacion.cambiar_proxied):
+        raise ValueError("no tiene ninguna acción (target_cname, cambiar_ip o cambiar_proxied)")
+    return operacion
+
+def compilar(zonas: Any, mtime: float = 0.0) -> PlanZonas:
+
+    if not isinstance(zonas, list):
+        return PlanZonas(mtime, [], [], ["zonas.json debe contener una lista de entradas"])
+
+    operaciones: List[OperacionZona] = []
+    errores: List[str] = []
+    vistas: Set[Tuple[str, str, str]] = set()
+    for i, zona in enumerate(zonas):
+        try:
+            operacion = _validar(i, zona)
+        except ValueError as e:
+            errores.append(f"Entrada #{i+1}: {e}")
+            continue
+        if operacion.clave in vistas:
+            errores.append(f"Entrada #{i+1}: registro {operacion.tipo} {operacion.nombre} duplicado")
+            continue
+        vistas.add(operacion.clave)
+        operaciones.append(operacion)
+
+    return PlanZonas(mtime, zonas, operaciones, errores)
+
+def obtener_plan() -> Optional[PlanZonas]:
+    # Compila zonas.json la primera vez y cada vez que cambia su fecha de modificación.
+
+    global _plan
+    try:
+        mtime = os.stat(FICHERO_ZONAS).st_mtime
+    except OSError as e:
+        logger.error(f"Error al cargar el archivo zonas.json: {e}")
+        return None
+
+    with _lock:
+        if _plan is not None and _plan.mtime == mtime:
+            return _plan
+
+        try:
+            with open(FICHERO_ZONAS, 'r') as f:
+                plan = compilar(json.load(f), mtime)
+        except Exception as e:
+            logger.error(f"Error al cargar el archivo zonas.json: {e}")
+            return _plan
+
+        for error in plan.errores:
+            logger.warning(f"zonas.json: {error}. Se ignorará.")
+        logger.info(f"Plan de zonas compilado: {len(plan.operaciones)} operaciones válidas de {len(plan.zonas)} entradas.")
+
+        # Versiones anteriores guardaban los valores anteriores en el propio zonas.json
+        try:
+            almacen_estado.importar((op.clave, plan.zonas[op.indice]) for op in plan.operaciones)
+        except Exception as e:
+            logger.error(f"Error al importar los valores anteriores de zonas.json: {e}")
+
+        _plan = plan
+        return plan
@@ -0,0 +1,115 @@
+import heapq
+import itertools
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import List, Optional, Tuple
+
+import metricas
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+# Prioridades: cuanto menor, antes se atiende
+ESCRITURA = 0     # Cambios de restauración o failover
+CONSULTA = 1      # Lecturas necesarias para aplicar un cambio
+VERIFICACION = 2  # Comprobaciones de token y zonas
+
+# Pausa global ante un 429 sin Retry-After. Corta: los reintentos ya esperan de forma exponencial
+# y una pausa igual al plazo de las escrituras haría que se abandonasen sin volver a intentarlo.
+RETRY_AFTER_POR_DEFECTO = 5.0
+
+class Planificador:
+    # Token bucket compartido por todas las llamadas a un servicio, con cola por prioridad
+    # y bloqueo global cuando el servicio responde 429 con Retry-After.
+
+    def __init__(self, nombre: str, peticiones: int, ventana: float, rafaga: int):
+        self.nombre = nombre
+        self.capacidad = max(1, rafaga)
+        # Descontamos la ráfaga para no superar el límite en ninguna ventana completa
+        self.tasa = max(1, peticiones - self.capacidad) / ventana
+        self.tokens = float(self.capacidad)
+        self.actualizado = time.monotonic()
+        self.bloqueado_hasta = 0.0
+        self._espera: List[Tuple[int, int]] = []
+        self._secuencia = itertools.count()
+        self._condicion = threading.Condition()
+
+    def _rellenar(self, ahora: float):
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.actualizado) * self.tasa)
+        self.actualizado = ahora
+
+    def adquirir(self, prioridad: int = CONSULTA):
+        # Bloquea hasta que hay cupo y no hay peticiones más prioritarias esperando.
+
+        inicio = time.monotonic()
+        turno = (prioridad, next(self._secuencia))
+
+        with self._condicion:
+            heapq.heappush(self._espera, turno)
+            metricas.PLANIFICADOR_COLA.labels(servicio=self.nombre).set(len(self._espera))
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    self._rellenar(ahora)
+                    if self._espera[0] == turno and ahora >= self.bloqueado_hasta and self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+
+                    if ahora < self.bloqueado_hasta:
+                        pausa = self.bloqueado_hasta - ahora
+                    elif self._espera[0] == turno:
+                        pausa = (1 - self.tokens) / self.tasa
+                    else:
+                        pausa = None  # Esperamos a que nos avise quien va delante
+                    self._condicion.wait(pausa)
+            finally:
+                self._espera.remove(turno)
+                heapq.heapify(self._espera)
+                metricas.PLANIFICADOR_COLA.labels(servicio=self.nombre).set(len(self._espera))
+                self._condicion.notify_all()
+
+        espera = time.monotonic() - inicio
+        metricas.PLANIFICADOR_ESPERA.labels(servicio=self.nombre).observe(espera)
+        if espera > 1:
+            logger.debug("Petición a %s retenida %.1f segundos por el límite de peticiones", self.nombre, espera)
+
+    def bloquear(self, segundos: float):
+        # Nadie sale hacia el servicio hasta que pase el tiempo indicado por Retry-After.
+
+        with self._condicion:
+            self.bloqueado_hasta = max(self.bloqueado_hasta, time.monotonic() + segundos)
+            self.tokens = 0
+            self._condicion.notify_all()
+        logger.warning(f"{self.nombre} ha limitado las peticiones (429). Pausando {segundos:.1f} segundos")
+
+    def espera_estimada(self, peticiones: int) -> float:
+        # Segundos que tardarían en salir `peticiones` llamadas con el cupo actual, sin consumirlo.
+
+        with self._condicion:
+            ahora = time.monotonic()
+            self._rellenar(ahora)
+            return max(0.0, self.bloqueado_hasta - ahora) + max(0.0, peticiones - self.tokens) / self.tasa
+
+    def estadisticas(self):
+
+        with self._condicion:
+            return {
+                "en_cola": len(self._espera),
+                "tokens": round(self.tokens, 2),
+                "bloqueado_segundos": round(max(0.0, self.bloqueado_hasta - time.monotonic()), 1),
+            }
+
+def segundos_retry_after(valor: Optional[str]) -> float:
+    # Retry-After puede venir en segundos o como fecha HTTP.
+
+    if not valor:
+        return RETRY_AFTER_POR_DEFECTO
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(valor).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return RETRY_AFTER_POR_DEFECTO
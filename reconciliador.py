@@ -0,0 +1,192 @@
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import trazas
+from bloqueos import bloqueo_exclusivo
+from cloudflare_zones import procesar_zonas
+from config import (
+    DEBOUNCE_SEGUNDOS,
+    RECONCILIACION_INTERVALO,
+    RECONCILIACION_JITTER,
+    check_cloudflare_config,
+    check_unifi_config,
+)
+from enrutado import TODOS_LOS_MONITORES, Destino, cargar_configuracion, perfil
+from estado_registros import almacen_estado
+from plan_zonas import obtener_plan
+from unifi import cambiar_estado_destinos, destinos_con_deriva
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+def estados_vigentes() -> Dict[str, Dict[str, Any]]:
+    # Estados de los monitores que siguen en la configuración, del evento más reciente al más antiguo.
+
+    monitores = cargar_configuracion().monitores
+    estados = {
+        clave: estado for clave, estado in almacen_estado.transiciones().items()
+        if clave in monitores or clave == TODOS_LOS_MONITORES
+    }
+    return dict(sorted(estados.items(), key=lambda item: item[1]["evento"], reverse=True))
+
+def registros_por_estado(estados: Dict[str, Dict[str, Any]], registros: Set[str]) -> Dict[bool, Set[str]]:
+    # Reparte los registros según el estado deseado: cada uno queda en el estado del último monitor
+    # que lo incluye, como con los webhooks.
+
+    pendientes = set(registros)
+    por_estado: Dict[bool, Set[str]] = {True: set(), False: set()}
+    for clave, estado in estados.items():
+        zonas = perfil(clave).zonas
+        asignados = pendientes if zonas is None else pendientes & zonas
+        por_estado[estado["deseado"]] |= asignados
+        pendientes = pendientes - asignados
+    return por_estado
+
+@contextmanager
+def bloqueo_transiciones(estados: Dict[str, Dict[str, Any]], nombre: str):
+    # Bloqueo propio (un solo worker) y de las transiciones de todos los monitores, sin esperar.
+    # Devuelve el motivo por el que no se ha obtenido o None.
+
+    ahora = time.time()
+    # Un evento reciente aún está en la ventana de agrupación: lo aplicará su trabajo
+    if any(ahora - estado["evento"] < DEBOUNCE_SEGUNDOS for estado in estados.values()):
+        yield "hay eventos en la ventana de agrupación"
+        return
+
+    with ExitStack() as pila:
+        if not pila.enter_context(bloqueo_exclusivo(nombre, esperar=False)):
+            yield f"otro worker tiene el bloqueo {nombre}"
+            return
+        for clave in estados:
+            if not pila.enter_context(bloqueo_exclusivo(f"transicion:{clave}", esperar=False)):
+                yield f"hay una transición en curso para {clave}"
+                return
+        yield None
+
+class Reconciliador:
+    # Compara cada cierto tiempo el estado deseado (último webhook de cada monitor) con los registros
+    # de Cloudflare y las reglas de Unifi y corrige solo lo que no coincide. Las lecturas salen de las
+    # caches de registros DNS y de rutas, así que un ciclo sin diferencias apenas hace llamadas.
+
+    def __init__(self, intervalo: int, jitter: int):
+        self.intervalo = intervalo
+        self.jitter = jitter
+        self.ciclos = 0
+        self.omitidos = 0
+        self.errores = 0
+        self.reparaciones_unifi = 0
+        self.ultimo: Optional[float] = None
+        self._hilo: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def iniciar(self):
+
+        with self._lock:
+            if self._hilo is not None or self.intervalo <= 0:
+                return
+            self._hilo = threading.Thread(target=self._bucle, name="reconciliador", daemon=True)
+            self._hilo.start()
+        logger.info(f"Reconciliación periódica activada cada {self.intervalo} segundos (+{self.jitter} aleatorios)")
+
+    def _bucle(self):
+
+        while True:
+            # El jitter evita que varios workers o instancias consulten las APIs a la vez
+            time.sleep(self.intervalo + random.uniform(0, self.jitter))
+            try:
+                # Cada ciclo es la raíz de su propia traza
+                with trazas.span("reconciliacion"):
+                    self.reconciliar()
+            except Exception as e:
+                with self._lock:
+                    self.errores += 1
+                logger.error(f"Error en la reconciliación: {e}")
+
+    def reconciliar(self) -> bool:
+        # Devuelve False si el ciclo se ha omitido porque hay una transición en marcha.
+
+        estados = estados_vigentes()
+        if not estados:
+            return True
+
+        with bloqueo_transiciones(estados, "reconciliador") as motivo:
+            if motivo:
+                return self._omitir(motivo)
+
+            logger.debug(f"Reconciliando el estado deseado de {len(estados)} monitores")
+            exito = True
+            if check_cloudflare_config()[0]:
+                exito = self._reconciliar_cloudflare(estados) and exito
+            if check_unifi_config()[0]:
+                exito = self._reconciliar_unifi(estados) and exito
+
+            # Si todo coincide con lo deseado las transiciones que fallaron quedan aplicadas
+            if exito:
+                for clave, estado in estados.items():
+                    if estado["aplicado"] != estado["deseado"]:
+                        almacen_estado.marcar_aplicado(clave, estado["deseado"])
+
+        with self._lock:
+            self.ciclos += 1
+            self.ultimo = time.time()
+        return True
+
+    def _omitir(self, motivo: str) -> bool:
+
+        logger.debug(f"Reconciliación omitida: {motivo}")
+        with self._lock:
+            self.omitidos += 1
+        return False
+
+    def _reconciliar_cloudflare(self, estados: Dict[str, Dict[str, Any]]) -> bool:
+
+        plan = obtener_plan()
+        if plan is None:
+            return False
+
+        exito = True
+        for enabled, registros in registros_por_estado(estados, {op.clave[2] for op in plan.operaciones}).items():
+            if registros:
+                exito = procesar_zonas('activado' if enabled else 'desactivado', None, registros) and exito
+        return exito
+
+    def _reconciliar_unifi(self, estados: Dict[str, Dict[str, Any]]) -> bool:
+
+        vistos: Set[Tuple[str, str, str]] = set()
+        por_estado: Dict[bool, List[Destino]] = {True: [], False: []}
+        for clave, estado in estados.items():
+            for destino in perfil(clave).destinos:
+                identificador = (destino.controlador.nombre, destino.sitio, destino.ruta)
+                if identificador not in vistos:
+                    vistos.add(identificador)
+                    por_estado[estado["deseado"]].append(destino)
+
+        exito = True
+        for enabled, destinos in por_estado.items():
+            con_deriva = destinos_con_deriva(destinos, enabled)
+            if not con_deriva:
+                continue
+            resultados = cambiar_estado_destinos(con_deriva, enabled)
+            reparadas = sum(1 for r in resultados if r["processed"])
+            exito = exito and reparadas == len(resultados)
+            with self._lock:
+                self.reparaciones_unifi += reparadas
+            logger.info(f"Reconciliación: {reparadas} de {len(resultados)} reglas de Unifi corregidas")
+        return exito
+
+    def estadisticas(self) -> Dict[str, Any]:
+
+        with self._lock:
+            return {
+                "intervalo": self.intervalo,
+                "ciclos": self.ciclos,
+                "omitidos": self.omitidos,
+                "errores": self.errores,
+                "reparaciones_unifi": self.reparaciones_unifi,
+                "ultimo": self.ultimo,
+            }
+
+reconciliador = Reconciliador(RECONCILIACION_INTERVALO, RECONCILIACION_JITTER)
@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pytest
+
+# Las pruebas usan el simulador de la API de Cloudflare del benchmark en lugar de la real. config.py
+# lee el entorno al importarse, así que se configura antes de importar ningún módulo de la aplicación.
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, 'benchmark'))
+
+from simuladores import CloudflareSimulado, Fallos  # noqa: E402
+
+DIRECTORIO = tempfile.mkdtemp(prefix='pruebas-unifi-pbr-')
+CLOUDFLARE = CloudflareSimulado(Fallos()).iniciar()
+
+os.environ.update({
+    'CLOUDFLARE_API_URL': f"{CLOUDFLARE.url}/client/v4",
+    'CLOUDFLARE_API_TOKEN': 'pruebas',
+    'CLOUDFLARE_LIMITE': '1000000',
+    'CLOUDFLARE_RAFAGA': '1000',
+    'CLOUDFLARE_PLAZO': '5',
+    'DEBUG': '0',
+    'LOG_ASINCRONO': '0',
+})
+for variable in ('UNIFI_URL', 'UNIFI_API_TOKEN', 'NOMBRE_PBR', 'TRAZAS_EXPORTADOR'):
+    os.environ.pop(variable, None)
+
+import bloqueos  # noqa: E402
+import config  # noqa: E402
+import enrutado  # noqa: E402
+import estado_registros  # noqa: E402
+import plan_zonas  # noqa: E402
+
+config.FICHERO_RUTAS = enrutado.FICHERO_RUTAS = os.path.join(DIRECTORIO, 'rutas.json')
+plan_zonas.FICHERO_ZONAS = os.path.join(DIRECTORIO, 'zonas.json')
+estado_registros.almacen_estado.ruta = os.path.join(DIRECTORIO, 'estado.db')
+bloqueos.DIRECTORIO_BLOQUEOS = os.path.join(DIRECTORIO, 'bloqueos')
+
+import cache_dns  # noqa: E402
+import cache_validacion  # noqa: E402
+import circuito  # noqa: E402
+
+def pytest_sessionfinish(session, exitstatus):
+    CLOUDFLARE.detener()
+    shutil.rmtree(DIRECTORIO, ignore_errors=True)
+
+@pytest.fixture
+def cloudflare():
+    # Simulador sin fallos y con las caches, los circuitos y el almacén de estado vacíos.
+
+    CLOUDFLARE.fallos = Fallos()
+    CLOUDFLARE.etag = True
+    CLOUDFLARE.cargar_zonas({})
+    CLOUDFLARE.reiniciar_contadores()
+    cache_dns.cache_dns.invalidar()
+    cache_validacion.cache_validacion.invalidar()
+    circuito._circuitos.clear()
+    conexion = estado_registros.almacen_estado._conexion()
+    for tabla in ('registros', 'transiciones', 'trabajos'):
+        conexion.execute(f"DELETE FROM {tabla}")
+    yield CLOUDFLARE
+
+_escrituras = 0
+
+@pytest.fixture
+def zonas():
+    # Escribe zonas.json. Se recompila por fecha de modificación, así que cada escritura lleva una distinta.
+
+    def escribir(entradas):
+        global _escrituras
+        _escrituras += 1
+        with open(plan_zonas.FICHERO_ZONAS, 'w') as f:
+            json.dump(entradas, f)
+        os.utime(plan_zonas.FICHERO_ZONAS, (time.time(), time.time() + _escrituras))
+
+    return escribir
@@ -0,0 +1,97 @@
+import time
+
+import pytest
+import requests
+
+import cache_dns
+from cache_dns import CacheRegistrosDNS
+from cloudflare_zones import connect_cloudflare
+
+ZONA = 'z1'
+
+@pytest.fixture
+def zona(cloudflare, monkeypatch):
+    # Cinco registros en páginas de dos para probar zonas de varias páginas sin miles de registros.
+
+    monkeypatch.setattr(cache_dns, 'REGISTROS_POR_PAGINA', 2)
+    cloudflare.cargar_zonas({ZONA: [
+        {"id": f"r{i}", "type": "A", "name": f"h{i}.z1.example", "content": "198.51.100.1", "proxied": True, "ttl": 1}
+        for i in range(5)
+    ]})
+    return cloudflare
+
+def _cargar(cache):
+    # Snapshot revalidado aunque no haya caducado, como lo pide una escritura.
+
+    _, headers = connect_cloudflare()
+    return cache.snapshot(headers, ZONA, time.monotonic())
+
+def _listados(cloudflare):
+    return cloudflare.contadores()["por_endpoint"].get("GET dns_records", 0)
+
+def test_la_revalidacion_detecta_cambios_fuera_de_la_primera_pagina(zona):
+
+    cache = CacheRegistrosDNS()
+    _cargar(cache)
+
+    respuesta = requests.patch(f"{zona.url}/client/v4/zones/{ZONA}/dns_records/r4", json={"content": "192.0.2.50"})
+    assert respuesta.status_code == 200
+
+    zona.reiniciar_contadores()
+    snapshot = _cargar(cache)
+    assert snapshot.indice[('A', 'h4.z1.example')]['content'] == '192.0.2.50'
+    # Una petición condicional por página: las dos primeras responden 304
+    assert _listados(zona) == 3
+    assert cache.estadisticas()["cargas"] == 2
+
+def test_sin_cambios_todas_las_paginas_responden_304(zona):
+
+    cache = CacheRegistrosDNS()
+    anterior = _cargar(cache)
+
+    zona.reiniciar_contadores()
+    assert _cargar(cache) is anterior
+    assert _listados(zona) == 3
+    assert cache.estadisticas()["sin_cambios"] == 1
+
+def test_si_cambia_el_total_de_registros_se_recarga_la_zona_entera(zona):
+
+    cache = CacheRegistrosDNS()
+    _cargar(cache)
+
+    # Un registro nuevo al principio desplaza el resto a la página siguiente
+    zona.zonas[ZONA] = dict({"r9": {"id": "r9", "type": "A", "name": "nuevo.z1.example", "content": "192.0.2.9",
+                                    "proxied": False, "ttl": 1}}, **zona.zonas[ZONA])
+
+    zona.reiniciar_contadores()
+    snapshot = _cargar(cache)
+    assert len(snapshot.indice) == 6
+    assert sum(len(registros) for registros in snapshot.paginas) == 6
+    assert cache.estadisticas()["recargas_completas"] == 1
+    # La primera página (con el nuevo total) y las tres de la recarga
+    assert _listados(zona) == 4
+
+def test_el_listado_sin_etag_se_cuenta_y_se_descarga_de_nuevo(zona, caplog):
+
+    zona.etag = False
+    cache = CacheRegistrosDNS()
+    _cargar(cache)
+    _cargar(cache)
+
+    assert cache.estadisticas()["sin_etag"] == 6
+    assert cache.estadisticas()["cargas"] == 2
+    # El aviso sale una sola vez por zona
+    assert sum('no ha devuelto ETag' in mensaje for mensaje in caplog.messages) == 1
+
+def test_la_escritura_propia_obliga_a_descargar_su_pagina(zona):
+    # Si otro worker deja la página como estaba al cargarla, su ETag vuelve a coincidir con el guardado.
+
+    cache = CacheRegistrosDNS()
+    _cargar(cache)
+    _, headers = connect_cloudflare()
+
+    respuesta = requests.patch(f"{zona.url}/client/v4/zones/{ZONA}/dns_records/r3", json={"content": "192.0.2.50"})
+    cache.actualizar(ZONA, respuesta.json()["result"])
+    requests.patch(f"{zona.url}/client/v4/zones/{ZONA}/dns_records/r3", json={"content": "198.51.100.1"})
+
+    assert cache.obtener(headers, ZONA, 'A', 'h3.z1.example', time.monotonic())[1]['content'] == '198.51.100.1'
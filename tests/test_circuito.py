@@ -0,0 +1,89 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import pytest
+
+import circuito
+from circuito import ABIERTO, CERRADO, Circuito, CircuitoAbierto
+from config import CLOUDFLARE_API_URL
+from http_client import CLOUDFLARE, obtener_sesion
+from simuladores import Fallos
+
+UMBRAL = 3
+ESPERA = 0.2
+VERIFICAR = f"{CLOUDFLARE_API_URL}/user/tokens/verify"
+
+@pytest.fixture
+def circuito_cloudflare(cloudflare):
+    # Circuito de la sesión de Cloudflare con umbral y espera cortos, creado antes de la primera llamada.
+
+    nombre = f"{CLOUDFLARE}/{urlsplit(CLOUDFLARE_API_URL).netloc}"
+    circuito._circuitos[nombre] = Circuito(nombre, UMBRAL, ESPERA)
+    return circuito._circuitos[nombre]
+
+def _verificar():
+    return obtener_sesion(CLOUDFLARE).get(VERIFICAR)
+
+def _llamadas(cloudflare):
+    return cloudflare.contadores()["por_endpoint"].get("GET tokens/verify", 0)
+
+def test_el_circuito_se_abre_con_los_5xx_y_se_cierra_tras_una_prueba_correcta(cloudflare, circuito_cloudflare):
+    cloudflare.fallos = Fallos(errores=1.0)
+    for _ in range(UMBRAL - 1):
+        assert _verificar().status_code == 503
+    assert circuito_cloudflare.estado == CERRADO
+
+    assert _verificar().status_code == 503
+    assert circuito_cloudflare.estado == ABIERTO
+    assert circuito.resumen()["abiertos"] == 1
+
+    # Abierto: se rechaza sin salir a la red
+    with pytest.raises(CircuitoAbierto):
+        _verificar()
+    assert _llamadas(cloudflare) == UMBRAL
+    assert circuito_cloudflare.rechazadas == 1
+
+    # Semiabierto: la prueba falla y vuelve a abrirse sin esperar otros UMBRAL fallos
+    time.sleep(ESPERA)
+    assert _verificar().status_code == 503
+    assert circuito_cloudflare.estado == ABIERTO
+    assert circuito_cloudflare.aperturas == 2
+
+    # El servicio se recupera: la prueba pasa y el circuito se cierra
+    cloudflare.fallos = Fallos()
+    time.sleep(ESPERA)
+    assert _verificar().status_code == 200
+    assert circuito_cloudflare.estado == CERRADO
+    assert circuito_cloudflare.fallos_consecutivos == 0
+    assert circuito.resumen() == {"abiertos": 0, "semiabiertos": 0, "aperturas": 2, "rechazadas": 1}
+
+def test_en_semiabierto_solo_sale_una_llamada_de_prueba(cloudflare, circuito_cloudflare):
+    cloudflare.fallos = Fallos(errores=1.0)
+    for _ in range(UMBRAL):
+        _verificar()
+    assert circuito_cloudflare.estado == ABIERTO
+
+    # La prueba tarda en responder y el resto de hilos llega mientras sigue en curso
+    cloudflare.fallos = Fallos(latencia=0.5)
+    cloudflare.reiniciar_contadores()
+    time.sleep(ESPERA)
+    hilos = 8
+    salida = threading.Barrier(hilos)
+
+    def llamar():
+        salida.wait()
+        try:
+            return _verificar().status_code
+        except CircuitoAbierto:
+            return None
+
+    with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+        resultados = list(ejecutor.map(lambda _: llamar(), range(hilos)))
+
+    assert resultados.count(200) == 1
+    assert resultados.count(None) == hilos - 1
+    assert _llamadas(cloudflare) == 1
+    assert circuito_cloudflare.rechazadas == hilos - 1
+    assert circuito_cloudflare.estado == CERRADO
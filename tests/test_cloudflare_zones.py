@@ -0,0 +1,241 @@
+import pytest
+import requests
+
+import cloudflare_zones
+import planificador
+from cache_dns import CacheRegistrosDNS
+from cloudflare_zones import procesar_zonas
+from estado_registros import almacen_estado
+
+ZONA = 'z1'
+NOMBRE = 'www.z1.example'
+IP_PRINCIPAL = '198.51.100.1'
+
+def _registro(cloudflare, registro_id='r1'):
+    return cloudflare.zonas[ZONA][registro_id]
+
+@pytest.fixture(params=[False, True], ids=['individual', 'batch'])
+def modo(request, monkeypatch):
+    monkeypatch.setattr(cloudflare_zones, 'CLOUDFLARE_BATCH', request.param)
+    return request.param
+
+@pytest.fixture
+def registro_ip(cloudflare, zonas):
+    cloudflare.cargar_zonas({ZONA: [
+        {"id": "r1", "type": "A", "name": NOMBRE, "content": IP_PRINCIPAL, "proxied": True, "ttl": 1},
+    ]})
+    zonas([{"id_zona": ZONA, "nombre": NOMBRE, "cambiar_ip": True, "cambiar_proxied": True}])
+    return cloudflare
+
+def test_cambio_de_ip_durante_la_caida_conserva_el_valor_original(registro_ip, modo):
+
+    procesar_zonas('activado', '192.0.2.50')
+    assert _registro(registro_ip)['content'] == '192.0.2.50'
+    assert almacen_estado.obtener((ZONA, 'A', NOMBRE))['contenido_anterior'] == IP_PRINCIPAL
+
+    # Un segundo DOWN en la misma caída, con otra IP de la WAN de respaldo
+    procesar_zonas('activado', '192.0.2.51')
+    assert _registro(registro_ip)['content'] == '192.0.2.51'
+    assert almacen_estado.obtener((ZONA, 'A', NOMBRE))['contenido_anterior'] == IP_PRINCIPAL
+
+    procesar_zonas('desactivado')
+    assert _registro(registro_ip)['content'] == IP_PRINCIPAL
+    assert _registro(registro_ip)['proxied'] is True
+    assert almacen_estado.obtener((ZONA, 'A', NOMBRE))['contenido_anterior'] == ''
+
+def test_la_siguiente_caida_guarda_un_valor_nuevo(registro_ip, modo):
+
+    procesar_zonas('activado', '192.0.2.50')
+    procesar_zonas('desactivado')
+
+    # La IP principal cambia entre dos caídas
+    _registro(registro_ip)['content'] = '198.51.100.2'
+    cloudflare_zones.cache_dns.invalidar()
+
+    procesar_zonas('activado', '192.0.2.50')
+    assert almacen_estado.obtener((ZONA, 'A', NOMBRE))['contenido_anterior'] == '198.51.100.2'
+    procesar_zonas('desactivado')
+    assert _registro(registro_ip)['content'] == '198.51.100.2'
+
+def test_cname_repetido_conserva_el_target_original(cloudflare, zonas, modo):
+
+    cloudflare.cargar_zonas({ZONA: [
+        {"id": "r1", "type": "CNAME", "name": NOMBRE, "content": "principal.example", "proxied": False, "ttl": 1},
+    ]})
+    zonas([{"id_zona": ZONA, "nombre": NOMBRE, "target_cname": "respaldo.example"}])
+
+    procesar_zonas('activado')
+    procesar_zonas('activado')
+    assert almacen_estado.obtener((ZONA, 'CNAME', NOMBRE))['target_cname_anterior'] == 'principal.example'
+
+    procesar_zonas('desactivado')
+    assert _registro(cloudflare)['content'] == 'principal.example'
+    assert almacen_estado.obtener((ZONA, 'CNAME', NOMBRE))['target_cname_anterior'] == ''
+
+def test_cambio_de_otro_worker_no_queda_oculto_por_el_snapshot(registro_ip, modo):
+
+    procesar_zonas('activado', '192.0.2.50')
+
+    # Otro worker restaura el registro sin pasar por el snapshot de este proceso
+    respuesta = requests.patch(f"{registro_ip.url}/client/v4/zones/{ZONA}/dns_records/r1",
+                               json={"content": IP_PRINCIPAL, "proxied": True})
+    assert respuesta.status_code == 200
+
+    procesar_zonas('activado', '192.0.2.50')
+    assert _registro(registro_ip)['content'] == '192.0.2.50'
+    assert _registro(registro_ip)['proxied'] is False
+
+def test_dos_workers_con_un_snapshot_desfasado_escriben_igualmente(registro_ip, modo, monkeypatch):
+    # Cada worker de gunicorn tiene su propia cache de registros; el almacén de estado es compartido.
+
+    worker_a, worker_b = CacheRegistrosDNS(), CacheRegistrosDNS()
+
+    monkeypatch.setattr(cloudflare_zones, 'cache_dns', worker_a)
+    procesar_zonas('activado', '192.0.2.50')
+
+    monkeypatch.setattr(cloudflare_zones, 'cache_dns', worker_b)
+    procesar_zonas('desactivado')
+    assert _registro(registro_ip)['content'] == IP_PRINCIPAL
+
+    # El snapshot de A, aún vigente, todavía muestra el registro apuntando a la WAN de respaldo
+    _, headers = cloudflare_zones.connect_cloudflare()
+    assert worker_a.obtener(headers, ZONA, 'A', NOMBRE)[1]['content'] == '192.0.2.50'
+
+    monkeypatch.setattr(cloudflare_zones, 'cache_dns', worker_a)
+    registro_ip.reiniciar_contadores()
+    procesar_zonas('activado', '192.0.2.50')
+    assert _registro(registro_ip)['content'] == '192.0.2.50'
+    assert _registro(registro_ip)['proxied'] is False
+    assert almacen_estado.obtener((ZONA, 'A', NOMBRE))['contenido_anterior'] == IP_PRINCIPAL
+    llamadas = registro_ip.contadores()["por_endpoint"]
+    assert llamadas["GET dns_records"] == 1
+    assert llamadas.get("PATCH dns_records/id", 0) + llamadas.get("POST dns_records/batch", 0) == 1
+
+def test_la_revalidacion_sin_cambios_es_condicional(registro_ip, modo):
+
+    procesar_zonas('activado', '192.0.2.50')
+    procesar_zonas('activado', '192.0.2.50')
+    registro_ip.reiniciar_contadores()
+    procesar_zonas('activado', '192.0.2.50')
+
+    # Un único listado de la zona, que responde 304 porque nadie la ha tocado, y ninguna escritura
+    assert registro_ip.contadores()["por_endpoint"] == {"GET dns_records": 1}
+
+def test_el_valor_anterior_de_zonas_json_se_importa_y_se_restaura(registro_ip, zonas, modo):
+
+    # Caída empezada con una versión que guardaba el valor anterior en el propio zonas.json
+    _registro(registro_ip).update(content='192.0.2.50', proxied=False)
+    zonas([{"id_zona": ZONA, "nombre": NOMBRE, "cambiar_ip": True, "cambiar_proxied": True,
+            "contenido_anterior": IP_PRINCIPAL}])
+
+    procesar_zonas('desactivado')
+    assert _registro(registro_ip)['content'] == IP_PRINCIPAL
+    assert _registro(registro_ip)['proxied'] is True
+    assert almacen_estado.obtener((ZONA, 'A', NOMBRE))['contenido_anterior'] == ''
+
+@pytest.fixture
+def zona_batch(cloudflare, zonas, monkeypatch):
+    monkeypatch.setattr(cloudflare_zones, 'CLOUDFLARE_BATCH', True)
+    monkeypatch.setattr(cloudflare_zones, 'BACKOFF_BASE', 0.01)
+    cloudflare.cargar_zonas({ZONA: [
+        {"id": f"r{i}", "type": "A", "name": f"h{i}.z1.example", "content": IP_PRINCIPAL, "proxied": True, "ttl": 1}
+        for i in range(3)
+    ]})
+    zonas([{"id_zona": ZONA, "nombre": f"h{i}.z1.example", "cambiar_ip": True, "cambiar_proxied": True}
+           for i in range(3)])
+    return cloudflare
+
+def _respuestas_batch(cloudflare, monkeypatch, respuestas):
+    # Las llamadas al endpoint batch reciben las respuestas indicadas en orden y después las del simulador.
+
+    original = cloudflare.responder
+    pendientes = list(respuestas)
+
+    def responder(metodo, ruta, consulta, cuerpo, cabeceras):
+        if ruta.endswith('/dns_records/batch') and pendientes:
+            return pendientes.pop(0)
+        return original(metodo, ruta, consulta, cuerpo, cabeceras)
+
+    monkeypatch.setattr(cloudflare, 'responder', responder)
+
+def _contenidos(cloudflare):
+    return [(r['content'], r['proxied']) for r in cloudflare.zonas[ZONA].values()]
+
+def test_batch_aplica_todos_los_cambios_en_una_llamada_y_actualiza_el_snapshot(zona_batch):
+
+    procesar_zonas('activado', '192.0.2.50')
+    assert _contenidos(zona_batch) == [('192.0.2.50', False)] * 3
+    llamadas = zona_batch.contadores()["por_endpoint"]
+    assert llamadas.get("POST dns_records/batch") == 1
+    assert "PATCH dns_records/id" not in llamadas
+
+    # El snapshot de la zona ya tiene los registros devueltos por el lote, sin volver a listarla
+    zona_batch.reiniciar_contadores()
+    _, headers = cloudflare_zones.connect_cloudflare()
+    disponible, registro = cloudflare_zones.cache_dns.obtener(headers, ZONA, 'A', 'h1.z1.example')
+    assert disponible and registro['content'] == '192.0.2.50' and registro['proxied'] is False
+    assert zona_batch.contadores()["total"] == 0
+
+def test_batch_rechazado_aplica_los_cambios_uno_a_uno(zona_batch, monkeypatch):
+
+    _respuestas_batch(zona_batch, monkeypatch, [(400, {"success": False, "errors": [{"code": 1004}]}, {})])
+
+    procesar_zonas('activado', '192.0.2.50')
+    assert _contenidos(zona_batch) == [('192.0.2.50', False)] * 3
+    llamadas = zona_batch.contadores()["por_endpoint"]
+    assert llamadas.get("POST dns_records/batch") == 1
+    assert llamadas.get("PATCH dns_records/id") == 3
+
+def test_batch_limitado_respeta_retry_after_y_no_pasa_a_individual(zona_batch, monkeypatch):
+
+    _respuestas_batch(zona_batch, monkeypatch, [(429, {"success": False, "errors": [{"code": 10000}]}, {'Retry-After': '0'})])
+
+    procesar_zonas('activado', '192.0.2.50')
+    assert _contenidos(zona_batch) == [('192.0.2.50', False)] * 3
+    llamadas = zona_batch.contadores()["por_endpoint"]
+    assert llamadas.get("POST dns_records/batch") == 2
+    assert "PATCH dns_records/id" not in llamadas
+
+def test_batch_limitado_sin_retry_after_se_reintenta_con_espera_exponencial(zona_batch, monkeypatch):
+    # Una pausa por defecto más larga que el plazo no debe hacer que se abandone la escritura.
+
+    monkeypatch.setattr(planificador, 'RETRY_AFTER_POR_DEFECTO', 0.3)
+    monkeypatch.setattr(cloudflare_zones, 'CLOUDFLARE_PLAZO', 0.2)
+    _respuestas_batch(zona_batch, monkeypatch, [(429, {"success": False, "errors": [{"code": 10000}]}, {})])
+
+    procesar_zonas('activado', '192.0.2.50')
+    assert _contenidos(zona_batch) == [('192.0.2.50', False)] * 3
+    assert zona_batch.contadores()["por_endpoint"].get("POST dns_records/batch") == 2
+
+def test_batch_con_cloudflare_caido_no_multiplica_las_llamadas(zona_batch, monkeypatch):
+
+    _respuestas_batch(zona_batch, monkeypatch, [(503, {"success": False}, {})] * 10)
+
+    procesar_zonas('activado', '192.0.2.50')
+    assert _contenidos(zona_batch) == [(IP_PRINCIPAL, True)] * 3
+    llamadas = zona_batch.contadores()["por_endpoint"]
+    assert llamadas.get("POST dns_records/batch") == cloudflare_zones.CLOUDFLARE_REINTENTOS
+    assert "PATCH dns_records/id" not in llamadas
+    # El valor anterior sigue guardado para restaurarlo cuando se aplique el cambio
+    assert almacen_estado.obtener((ZONA, 'A', 'h0.z1.example'))['contenido_anterior'] == IP_PRINCIPAL
+
+def test_cambio_de_ip_vigilado_solo_toca_los_registros_indicados(cloudflare, zonas, modo):
+
+    cloudflare.cargar_zonas({ZONA: [
+        {"id": "r1", "type": "A", "name": NOMBRE, "content": IP_PRINCIPAL, "proxied": True, "ttl": 1},
+        {"id": "r2", "type": "A", "name": "otro.z1.example", "content": IP_PRINCIPAL, "proxied": True, "ttl": 1},
+    ]})
+    zonas([{"id_zona": ZONA, "nombre": NOMBRE, "cambiar_ip": True},
+           {"id_zona": ZONA, "nombre": "otro.z1.example", "cambiar_ip": True}])
+
+    assert procesar_zonas('activado', '192.0.2.50')
+
+    # El vigilante detecta una IP nueva en la WAN de respaldo y solo re-aplica el primer registro
+    assert procesar_zonas('activado', '192.0.2.51', {NOMBRE})
+    assert _registro(cloudflare)['content'] == '192.0.2.51'
+    assert _registro(cloudflare, 'r2')['content'] == '192.0.2.50'
+    assert almacen_estado.obtener((ZONA, 'A', NOMBRE))['contenido_anterior'] == IP_PRINCIPAL
+
+    assert procesar_zonas('desactivado')
+    assert _registro(cloudflare)['content'] == IP_PRINCIPAL
+    assert _registro(cloudflare, 'r2')['content'] == IP_PRINCIPAL
@@ -0,0 +1,15 @@
+import pytest
+
+from enrutado import _parsear
+
+def test_las_zonas_del_perfil_se_normalizan():
+
+    configuracion = _parsear({"monitores": {"WAN": {"zonas": ["WWW.z1.example.", "api.z1.example"]}}})
+    assert configuracion.monitores["WAN"].zonas == frozenset({"www.z1.example", "api.z1.example"})
+    assert configuracion.monitores["WAN"].destinos == []
+
+@pytest.mark.parametrize("zonas", ["www.z1.example", ["www.z1.example", 1], {"www.z1.example": True}, None])
+def test_las_zonas_que_no_son_una_lista_de_nombres_se_rechazan(zonas):
+
+    with pytest.raises(ValueError, match="WAN"):
+        _parsear({"monitores": {"WAN": {"zonas": zonas}}})
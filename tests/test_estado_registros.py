@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from estado_registros import AlmacenEstado
+
+CLAVE = ('z1', 'A', 'www.z1.example')
+
+@pytest.fixture
+def almacen(tmp_path):
+    return AlmacenEstado(str(tmp_path / 'estado.db'))
+
+def test_guardar_solo_modifica_los_campos_indicados(almacen):
+
+    assert almacen.obtener(CLAVE) == {'contenido_anterior': '', 'target_cname_anterior': ''}
+
+    almacen.guardar(CLAVE, {'contenido_anterior': '198.51.100.1'})
+    almacen.guardar(CLAVE, {'target_cname_anterior': 'principal.example'})
+    assert almacen.obtener(CLAVE) == {'contenido_anterior': '198.51.100.1', 'target_cname_anterior': 'principal.example'}
+
+    almacen.guardar(CLAVE, {'contenido_anterior': None})
+    assert almacen.obtener(CLAVE) == {'contenido_anterior': '', 'target_cname_anterior': 'principal.example'}
+    assert almacen.obtener(('z1', 'A', 'otro.z1.example'))['contenido_anterior'] == ''
+
+def test_guardados_concurrentes_no_pierden_campos(almacen):
+    # Cada hilo tiene su propia conexión, como los workers de gunicorn: cada upsert es atómico
+    # y no pisa el campo que guarda el otro hilo en el mismo registro.
+
+    claves = [('z1', 'A', f'h{i}.z1.example') for i in range(20)]
+    barrera = threading.Barrier(2)
+
+    def guardar(campo, valor):
+        barrera.wait()
+        for clave in claves:
+            almacen.guardar(clave, {campo: valor})
+
+    hilos = [threading.Thread(target=guardar, args=('contenido_anterior', '198.51.100.1')),
+             threading.Thread(target=guardar, args=('target_cname_anterior', 'principal.example'))]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    for clave in claves:
+        assert almacen.obtener(clave) == {'contenido_anterior': '198.51.100.1', 'target_cname_anterior': 'principal.example'}
+
+def test_importar_solo_copia_valores_que_no_estan_en_el_almacen(almacen):
+
+    almacen.guardar(('z1', 'A', 'ya.z1.example'), {'contenido_anterior': '198.51.100.9'})
+
+    importados = almacen.importar([
+        (CLAVE, {'contenido_anterior': '198.51.100.1', 'cambiar_ip': True}),
+        (('z1', 'CNAME', 'cname.z1.example'), {'target_cname_anterior': 'principal.example'}),
+        (('z1', 'A', 'vacio.z1.example'), {'contenido_anterior': ''}),
+        (('z1', 'A', 'ya.z1.example'), {'contenido_anterior': '203.0.113.1'}),
+    ])
+
+    assert importados == 2
+    assert almacen.obtener(CLAVE)['contenido_anterior'] == '198.51.100.1'
+    assert almacen.obtener(('z1', 'CNAME', 'cname.z1.example'))['target_cname_anterior'] == 'principal.example'
+    # Un registro sin valores no ocupa fila y uno que ya estaba en el almacén no se pisa
+    assert almacen.obtener(('z1', 'A', 'ya.z1.example'))['contenido_anterior'] == '198.51.100.9'
+    assert almacen.importar([(('z1', 'A', 'vacio.z1.example'), {'contenido_anterior': '198.51.100.2'})]) == 1
+
+def test_solo_se_borran_los_trabajos_antiguos_al_indicar_el_maximo(almacen):
+
+    for n in range(3):
+        almacen.guardar_trabajo(f"t{n}", {"n": n})
+    assert all(almacen.obtener_trabajo(f"t{n}") for n in range(3))
+
+    almacen.guardar_trabajo("t3", {"n": 3}, maximo=2)
+    assert [almacen.obtener_trabajo(f"t{n}") for n in range(4)] == [None, None, {"n": 2}, {"n": 3}]
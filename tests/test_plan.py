@@ -0,0 +1,101 @@
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import runpy
+import sys
+
+import pytest
+import requests
+
+import cloudflare_zones
+import config
+from cloudflare_zones import procesar_zonas
+from estado_registros import almacen_estado
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ZONA = 'z1'
+DOWN = {"heartbeat": {"status": 0}, "monitor": {"id": 1, "name": "WAN"}}
+
+@pytest.fixture(scope='module')
+def aplicacion():
+    # unifi-pbr-cloudflare.py no se puede importar por nombre.
+
+    spec = importlib.util.spec_from_file_location('aplicacion', os.path.join(RAIZ, 'unifi-pbr-cloudflare.py'))
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo.app.test_client()
+
+@pytest.fixture(params=[False, True], ids=['individual', 'batch'])
+def modo(request, monkeypatch):
+    # La línea de comandos ejecuta una copia nueva de cloudflare_zones.py que lee config.py.
+
+    monkeypatch.setattr(cloudflare_zones, 'CLOUDFLARE_BATCH', request.param)
+    monkeypatch.setattr(config, 'CLOUDFLARE_BATCH', request.param)
+    return request.param
+
+@pytest.fixture
+def registros(cloudflare, zonas):
+    cloudflare.cargar_zonas({ZONA: [
+        {"id": "r1", "type": "A", "name": "a.z1.example", "content": "198.51.100.1", "proxied": True, "ttl": 1},
+        {"id": "r2", "type": "A", "name": "b.z1.example", "content": "198.51.100.1", "proxied": False, "ttl": 1},
+        {"id": "r3", "type": "CNAME", "name": "c.z1.example", "content": "principal.example", "proxied": False, "ttl": 1},
+    ]})
+    zonas([
+        {"id_zona": ZONA, "nombre": "a.z1.example", "cambiar_proxied": True},
+        {"id_zona": ZONA, "nombre": "b.z1.example", "cambiar_proxied": True},
+        {"id_zona": ZONA, "nombre": "c.z1.example", "target_cname": "respaldo.example"},
+        {"id_zona": ZONA, "nombre": "no-existe.z1.example", "cambiar_proxied": True},
+    ])
+    return cloudflare
+
+def _plan_linea_de_comandos(monkeypatch):
+
+    monkeypatch.setattr(sys, 'argv', ['cloudflare_zones.py', '--plan', 'activado', '--monitor', 'WAN'])
+    salida = io.StringIO()
+    with contextlib.redirect_stdout(salida):
+        runpy.run_path(os.path.join(RAIZ, 'cloudflare_zones.py'), run_name='__main__')
+    return json.loads(salida.getvalue())
+
+def _escrituras(cloudflare):
+    llamadas = cloudflare.contadores()["por_endpoint"]
+    return llamadas.get("PATCH dns_records/id", 0) + llamadas.get("POST dns_records/batch", 0)
+
+def test_el_plan_coincide_con_la_ejecucion_real_y_no_escribe(aplicacion, registros, modo, monkeypatch):
+
+    # Con el snapshot de la zona ya cargado, otro worker deja b.z1.example con el proxy activado
+    assert aplicacion.post('/api/route?plan=1', json=DOWN).status_code == 200
+    respuesta = requests.patch(f"{registros.url}/client/v4/zones/{ZONA}/dns_records/r2", json={"proxied": True})
+    assert respuesta.status_code == 200
+    registros.reiniciar_contadores()
+
+    respuesta = aplicacion.post('/api/route?plan=1', json=DOWN)
+    assert respuesta.status_code == 200
+    plan_web = respuesta.get_json()["cloudflare"]
+    plan_cli = _plan_linea_de_comandos(monkeypatch)["cloudflare"]
+
+    # Los dos planes son el mismo y calcularlos solo ha hecho lecturas
+    assert plan_web["registros"] == plan_cli["registros"]
+    assert plan_web["llamadas"] == plan_cli["llamadas"]
+    assert _escrituras(registros) == 0
+    assert registros.zonas[ZONA]["r1"]["proxied"] is True
+    assert almacen_estado.obtener((ZONA, 'CNAME', 'c.z1.example'))['target_cname_anterior'] == ''
+
+    acciones = {entrada["registro"]: entrada["accion"] for entrada in plan_web["registros"]}
+    assert acciones == {"a.z1.example": 'actualizar', "b.z1.example": 'actualizar',
+                        "c.z1.example": 'actualizar', "no-existe.z1.example": 'no_encontrado'}
+
+    # La ejecución real aplica exactamente los cambios del plan con las escrituras previstas
+    assert procesar_zonas('activado')
+    assert _escrituras(registros) == plan_web["llamadas"]["escrituras"] == (1 if modo else 3)
+    actuales = {registro["id"]: registro for registro in registros.zonas[ZONA].values()}
+    for entrada in plan_web["registros"]:
+        if entrada["accion"] == 'no_encontrado':
+            continue
+        esperado = dict(entrada["actual"], **entrada["cambios"])
+        assert {campo: actuales[entrada["id"]][campo] for campo in esperado} == esperado
+
+    # Y después el plan ya no tiene nada que cambiar
+    acciones = {entrada["accion"] for entrada in aplicacion.post('/api/route?plan=1', json=DOWN).get_json()["cloudflare"]["registros"]}
+    assert acciones == {'sin_cambios', 'no_encontrado'}
@@ -0,0 +1,47 @@
+import threading
+import time
+
+import planificador
+from planificador import CONSULTA, ESCRITURA, VERIFICACION, Planificador, segundos_retry_after
+
+def test_las_escrituras_pasan_por_delante_de_consultas_y_verificaciones():
+    # Un token cada 50 ms y ninguno disponible mientras llegan las peticiones.
+
+    cupo = Planificador('prueba', peticiones=21, ventana=1.0, rafaga=1)
+    cupo.bloquear(0.2)
+    orden = []
+
+    def pedir(prioridad, nombre):
+        cupo.adquirir(prioridad)
+        orden.append(nombre)
+
+    hilos = []
+    for prioridad, nombre in ((VERIFICACION, 'verificación'), (CONSULTA, 'consulta 1'),
+                              (ESCRITURA, 'escritura'), (CONSULTA, 'consulta 2')):
+        hilo = threading.Thread(target=pedir, args=(prioridad, nombre))
+        hilo.start()
+        hilos.append(hilo)
+        time.sleep(0.01)
+    for hilo in hilos:
+        hilo.join(5)
+
+    # Con la misma prioridad se respeta el orden de llegada
+    assert orden == ['escritura', 'consulta 1', 'consulta 2', 'verificación']
+
+def test_bloquear_retiene_todas_las_peticiones_y_no_se_acorta():
+
+    cupo = Planificador('prueba', peticiones=1000, ventana=1.0, rafaga=10)
+    cupo.bloquear(0.3)
+    cupo.bloquear(0.05)
+    assert cupo.estadisticas()["bloqueado_segundos"] >= 0.2
+
+    inicio = time.monotonic()
+    cupo.adquirir(ESCRITURA)
+    assert time.monotonic() - inicio >= 0.25
+    assert cupo.estadisticas()["bloqueado_segundos"] == 0
+
+def test_retry_after_en_segundos_fecha_o_ausente():
+
+    assert segundos_retry_after('7') == 7.0
+    assert segundos_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+    assert segundos_retry_after(None) == segundos_retry_after('mañana') == planificador.RETRY_AFTER_POR_DEFECTO
@@ -0,0 +1,63 @@
+import threading
+import time
+
+import trabajos
+from trabajos import COMPLETADO, EN_CURSO, PENDIENTE, ColaTrabajos
+
+def _esperar(cola, trabajo, limite=5.0):
+    fin = time.monotonic() + limite
+    while time.monotonic() < fin:
+        datos = cola.obtener(trabajo.id)
+        if datos["estado"] == COMPLETADO:
+            return datos
+        time.sleep(0.01)
+    raise AssertionError(f"El trabajo {trabajo.id} no ha terminado")
+
+def test_un_monitor_lento_no_retrasa_a_otro():
+
+    cola = ColaTrabajos(10, 4)
+    liberar = threading.Event()
+
+    lento = cola.encolar("lento", lambda trabajo: {"liberado": liberar.wait(5)}, carril='wan1')
+    rapido = cola.encolar("rápido", lambda trabajo: {"ok": True}, carril='wan2')
+
+    assert _esperar(cola, rapido)["resultado"] == {"ok": True}
+    assert cola.obtener(lento.id)["estado"] != COMPLETADO
+    liberar.set()
+    assert _esperar(cola, lento)["resultado"] == {"liberado": True}
+
+def test_los_trabajos_de_un_monitor_se_aplican_en_orden_y_de_uno_en_uno():
+
+    cola = ColaTrabajos(10, 4)
+    orden = []
+    en_curso = []
+
+    def paso(trabajo, n):
+        en_curso.append(n)
+        assert len(en_curso) == 1
+        time.sleep(0.02)
+        orden.append(n)
+        en_curso.remove(n)
+        return {"n": n}
+
+    trabajos = [cola.encolar(f"paso {n}", paso, n, carril='wan1') for n in range(5)]
+    for trabajo in trabajos:
+        _esperar(cola, trabajo)
+    assert orden == list(range(5))
+
+def test_el_almacen_se_escribe_fuera_del_hilo_del_webhook_y_en_orden(monkeypatch):
+
+    escrituras = []
+
+    def guardar_trabajo(trabajo_id, datos, maximo=None):
+        escrituras.append((threading.current_thread().name, datos["estado"], maximo))
+
+    monkeypatch.setattr(trabajos.almacen_estado, 'guardar_trabajo', guardar_trabajo)
+    cola = ColaTrabajos(10, 4)
+    _esperar(cola, cola.encolar("webhook", lambda trabajo: {"ok": True}))
+    cola._escritor.submit(lambda: None).result()
+
+    # Solo la copia final borra los trabajos antiguos
+    assert [(estado, maximo) for _, estado, maximo in escrituras] == [(PENDIENTE, None), (EN_CURSO, None), (COMPLETADO, 10)]
+    hilos = {hilo for hilo, _, _ in escrituras}
+    assert len(hilos) == 1 and hilos.pop().startswith("trabajo-almacen")
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from estado_registros import almacen_estado
+from trabajos import COMPLETADO, ColaTrabajos
+from transiciones import ControlTransiciones
+
+VENTANA = 0.1
+
+@pytest.fixture
+def control():
+    return ControlTransiciones(ColaTrabajos(10, 4), VENTANA)
+
+@pytest.fixture
+def clave(request):
+    # Una clave por prueba para que no compartan el estado guardado en el almacén.
+    return request.node.name
+
+class Ejecutor:
+    # Registra los estados aplicados y devuelve el éxito indicado en cada llamada.
+
+    def __init__(self, *exitos):
+        self.aplicados = []
+        self.exitos = list(exitos)
+
+    def __call__(self, trabajo, enabled):
+        self.aplicados.append(enabled)
+        return {"aplicado": enabled}, self.exitos.pop(0) if self.exitos else True
+
+def _resultado(control, trabajo, limite=5.0):
+    fin = time.monotonic() + limite
+    while time.monotonic() < fin:
+        datos = control.cola.obtener(trabajo.id)
+        if datos["estado"] == COMPLETADO:
+            return datos["resultado"]
+        time.sleep(0.01)
+    raise AssertionError(f"El trabajo {trabajo.id} no ha terminado")
+
+def test_un_enlace_que_oscila_dentro_de_la_ventana_aplica_solo_el_ultimo_estado(control, clave):
+
+    ejecutar = Ejecutor()
+    trabajo, agrupado = control.solicitar(True, "DOWN", ejecutar, clave)
+    assert not agrupado
+    for enabled in (False, True, False):
+        assert control.solicitar(enabled, "flap", ejecutar, clave) == (trabajo, True)
+
+    resultado = _resultado(control, trabajo)
+    assert ejecutar.aplicados == [False]
+    assert resultado["eventos_agrupados"] == 4 and not resultado["omitido"]
+    assert almacen_estado.obtener_transicion(clave)["aplicado"] is False
+
+def test_el_estado_ya_aplicado_se_omite(control, clave):
+
+    ejecutar = Ejecutor()
+    _resultado(control, control.solicitar(True, "DOWN", ejecutar, clave)[0])
+    resultado = _resultado(control, control.solicitar(True, "DOWN repetido", ejecutar, clave)[0])
+
+    assert ejecutar.aplicados == [True]
+    assert resultado["omitido"]
+
+def test_tras_un_fallo_el_siguiente_evento_vuelve_a_aplicar_el_estado(control, clave):
+
+    ejecutar = Ejecutor(False, True)
+    resultado = _resultado(control, control.solicitar(True, "DOWN", ejecutar, clave)[0])
+    assert not resultado["omitido"]
+    assert almacen_estado.obtener_transicion(clave)["aplicado"] is None
+
+    resultado = _resultado(control, control.solicitar(True, "DOWN repetido", ejecutar, clave)[0])
+    assert not resultado["omitido"]
+    assert ejecutar.aplicados == [True, True]
+    assert almacen_estado.obtener_transicion(clave)["aplicado"] is True
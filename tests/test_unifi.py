@@ -0,0 +1,58 @@
+import os
+import subprocess
+
+import pytest
+
+from enrutado import Controlador
+from simuladores import Fallos, UnifiSimulado
+from unifi import cambiar_estado_ruta, obtener_sitio
+
+RUTA = 'pruebas-pbr'
+
+@pytest.fixture(scope='module')
+def unifi(tmp_path_factory):
+    # Unifi solo se usa por HTTPS: certificado autofirmado para el simulador.
+
+    directorio = tmp_path_factory.mktemp('unifi')
+    certificado, clave = os.path.join(directorio, 'cert.pem'), os.path.join(directorio, 'key.pem')
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=127.0.0.1', '-keyout', clave, '-out', certificado],
+                       check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("openssl no está disponible para el certificado del simulador de Unifi")
+
+    servidor = UnifiSimulado(Fallos(), (certificado, clave)).iniciar()
+    yield servidor
+    servidor.detener()
+
+def test_el_put_se_envia_aunque_el_indice_cacheado_ya_este_en_el_estado_deseado(unifi):
+
+    unifi.cargar_rutas([RUTA])
+    sitio = obtener_sitio(Controlador('pruebas', unifi.url, 'pruebas'), 'default')
+    assert cambiar_estado_ruta(RUTA, True, sitio)[0]
+
+    # Otro worker (o alguien a mano) la desactiva sin pasar por el índice de este proceso
+    respuesta = sitio.sesion.put(f"{sitio.url_rutas}/ruta0", headers=sitio.cabeceras(), json={"enabled": False})
+    assert respuesta.status_code == 200
+
+    unifi.reiniciar_contadores()
+    assert cambiar_estado_ruta(RUTA, True, sitio)[0]
+    assert unifi.rutas[0]['enabled'] is True
+    assert unifi.contadores()["por_endpoint"] == {"GET trafficroutes": 1, "PUT trafficroutes/id": 1}
+
+def test_el_put_no_deshace_los_cambios_hechos_desde_la_interfaz(unifi):
+
+    unifi.cargar_rutas([RUTA])
+    unifi.rutas[0]['next_hop'] = 'wan1'
+    sitio = obtener_sitio(Controlador('pruebas', unifi.url, 'pruebas'), 'default')
+    assert cambiar_estado_ruta(RUTA, True, sitio)[0]
+
+    # Alguien cambia la interfaz de salida de la regla en Unifi; el índice de este worker sigue vigente
+    respuesta = sitio.sesion.put(f"{sitio.url_rutas}/ruta0", headers=sitio.cabeceras(),
+                                 json={"next_hop": "wan2", "enabled": True})
+    assert respuesta.status_code == 200
+
+    assert cambiar_estado_ruta(RUTA, False, sitio)[0]
+    assert unifi.rutas[0]['enabled'] is False
+    assert unifi.rutas[0]['next_hop'] == 'wan2'
@@ -0,0 +1,186 @@
+import contextvars
+import functools
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Optional
+
+import trazas
+from config import CONCURRENCIA_MONITORES, TRABAJOS_MAX
+from estado_registros import almacen_estado
+from metricas import WEBHOOK_SEGUNDOS
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+PENDIENTE = 'pendiente'
+EN_CURSO = 'en_curso'
+COMPLETADO = 'completado'
+ERROR = 'error'
+
+CARRIL_POR_DEFECTO = '*'
+
+class Trabajo:
+    # Ejecución en segundo plano de un webhook con el progreso de cada etapa.
+
+    def __init__(self, descripcion: str):
+        self.id = uuid.uuid4().hex
+        self.descripcion = descripcion
+        self.estado = PENDIENTE
+        self.creado = time.time()
+        self.inicio: Optional[float] = None
+        self.fin: Optional[float] = None
+        self.etapas: Dict[str, Dict[str, Any]] = OrderedDict()
+        self.resultado: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        # Traza del webhook que ha creado el trabajo, sus etapas cuelgan de ella
+        self.trace_id = trazas.trace_id_actual()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def etapa(self, nombre: str):
+        # Registra inicio, fin y resultado de una etapa. El bloque puede fijar el mensaje con etapa['mensaje'].
+
+        datos = {"estado": EN_CURSO, "inicio": time.time(), "fin": None, "mensaje": None}
+        with self._lock:
+            self.etapas[nombre] = datos
+        try:
+            with trazas.span(nombre):
+                yield datos
+        except Exception as e:
+            with self._lock:
+                datos.update(estado=ERROR, fin=time.time(), mensaje=datos.get('mensaje') or str(e))
+            raise
+        else:
+            with self._lock:
+                datos.update(estado=COMPLETADO, fin=time.time())
+
+    def to_dict(self) -> Dict[str, Any]:
+
+        with self._lock:
+            return {
+                "id": self.id,
+                "descripcion": self.descripcion,
+                "estado": self.estado,
+                "creado": self.creado,
+                "inicio": self.inicio,
+                "fin": self.fin,
+                "duracion": round(self.fin - self.inicio, 3) if self.inicio and self.fin else None,
+                "etapas": {
+                    nombre: dict(datos, duracion=round(datos['fin'] - datos['inicio'], 3) if datos['fin'] else None)
+                    for nombre, datos in self.etapas.items()
+                },
+                "resultado": self.resultado,
+                "error": self.error,
+                "trace_id": self.trace_id,
+            }
+
+class ColaTrabajos:
+    # Cola con un carril por monitor: los trabajos de un mismo carril se aplican de uno en uno y en el
+    # orden en que llegan, y los de carriles distintos en paralelo (hasta `concurrencia` a la vez), así
+    # la espera del debounce o un cambio lento de un monitor no retrasa el failover de otra WAN.
+    # Cada trabajo se copia al almacén de estado al encolarlo, al empezar y al terminar para poder
+    # consultarlo desde cualquier worker. Las copias las escribe un único hilo, en orden, así el
+    # webhook responde sin esperar a SQLite.
+
+    def __init__(self, max_trabajos: int, concurrencia: int):
+        self.max_trabajos = max_trabajos
+        self._trabajos: "OrderedDict[str, Trabajo]" = OrderedDict()
+        # Carril -> trabajos en espera. Un carril está en la tabla mientras tiene un trabajo en marcha
+        self._carriles: Dict[str, Deque[Callable[[], None]]] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrencia), thread_name_prefix="trabajo")
+        self._escritor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trabajo-almacen")
+
+    def encolar(self, descripcion: str, funcion: Callable[..., Optional[Dict[str, Any]]], *args,
+                carril: str = CARRIL_POR_DEFECTO) -> Trabajo:
+
+        trabajo = Trabajo(descripcion)
+        with self._lock:
+            self._trabajos[trabajo.id] = trabajo
+            # Conservamos solo los últimos trabajos para consultar su estado
+            while len(self._trabajos) > self.max_trabajos:
+                self._trabajos.popitem(last=False)
+
+        self._compartir(trabajo)
+        tarea = functools.partial(contextvars.copy_context().run, self._ejecutar, trabajo, funcion, *args)
+        with self._lock:
+            en_espera = self._carriles.get(carril)
+            if en_espera is None:
+                self._carriles[carril] = deque()
+            else:
+                en_espera.append(tarea)
+        if en_espera is None:
+            self._executor.submit(self._recorrer_carril, carril, tarea)
+        logger.debug("Trabajo %s encolado en el carril %s: %s", trabajo.id, carril, descripcion)
+        return trabajo
+
+    def _recorrer_carril(self, carril: str, tarea: Callable[[], None]):
+        # Ejecuta los trabajos del carril hasta vaciarlo y lo retira de la tabla.
+
+        while True:
+            try:
+                tarea()
+            except Exception as e:
+                logger.error(f"Error inesperado en el carril de trabajos {carril}: {e}")
+            with self._lock:
+                en_espera = self._carriles[carril]
+                if not en_espera:
+                    del self._carriles[carril]
+                    return
+                tarea = en_espera.popleft()
+
+    def _ejecutar(self, trabajo: Trabajo, funcion: Callable[..., Optional[Dict[str, Any]]], *args):
+
+        with trabajo._lock:
+            trabajo.estado = EN_CURSO
+            trabajo.inicio = time.time()
+        self._compartir(trabajo)
+        try:
+            with trazas.span("trabajo", trabajo=trabajo.id):
+                resultado = funcion(trabajo, *args)
+            with trabajo._lock:
+                trabajo.resultado = resultado
+                trabajo.estado = COMPLETADO
+        except Exception as e:
+            logger.error(f"Error en el trabajo {trabajo.id}: {str(e)}")
+            with trabajo._lock:
+                trabajo.error = str(e)
+                trabajo.estado = ERROR
+        finally:
+            with trabajo._lock:
+                trabajo.fin = time.time()
+            WEBHOOK_SEGUNDOS.observe(trabajo.fin - trabajo.creado)
+            self._compartir(trabajo, final=True)
+            logger.debug("Trabajo %s finalizado con estado %s", trabajo.id, trabajo.estado)
+
+    def _compartir(self, trabajo: Trabajo, final: bool = False):
+        # La copia se toma ahora y se escribe en el hilo del almacén. Los trabajos antiguos solo se
+        # borran al guardar uno terminado, no en cada copia.
+
+        self._escritor.submit(self._guardar, trabajo.id, trabajo.to_dict(), self.max_trabajos if final else None)
+
+    def _guardar(self, trabajo_id: str, datos: Dict[str, Any], maximo: Optional[int]):
+
+        try:
+            almacen_estado.guardar_trabajo(trabajo_id, datos, maximo)
+        except Exception as e:
+            logger.error(f"Error al guardar el trabajo {trabajo_id} en el almacén de estado: {e}")
+
+    def obtener(self, trabajo_id: str) -> Optional[Dict[str, Any]]:
+        # Estado del trabajo: en vivo si lo ejecuta este worker, si no la última copia del almacén.
+
+        with self._lock:
+            trabajo = self._trabajos.get(trabajo_id)
+        if trabajo is not None:
+            return trabajo.to_dict()
+        try:
+            return almacen_estado.obtener_trabajo(trabajo_id)
+        except Exception as e:
+            logger.error(f"Error al leer el trabajo {trabajo_id} del almacén de estado: {e}")
+            return None
+
+cola_trabajos = ColaTrabajos(TRABAJOS_MAX, CONCURRENCIA_MONITORES)
@@ -0,0 +1,125 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from bloqueos import bloqueo_exclusivo
+from config import DEBOUNCE_SEGUNDOS
+from estado_registros import almacen_estado
+from trabajos import ColaTrabajos, Trabajo, cola_trabajos
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+# ejecutar(trabajo, enabled) -> (response_data, exito)
+Ejecutor = Callable[[Trabajo, bool], Tuple[Dict[str, Any], bool]]
+
+CLAVE_POR_DEFECTO = '*'
+
+class EstadoTransicion:
+    # Estado deseado y aplicado de un conjunto de reglas (las de un monitor).
+
+    def __init__(self, clave: str):
+        self.clave = clave
+        self.deseado: Optional[bool] = None
+        self.aplicado: Optional[bool] = None
+        self.ultimo_evento = 0.0
+        # Hora del último evento, comparable con la que registran los demás workers
+        self.instante_evento = 0.0
+        self.eventos_pendientes = 0
+        self.pendiente: Optional[Trabajo] = None
+
+class ControlTransiciones:
+    # Máquina de estados delante del procesamiento: agrupa los webhooks de un enlace que oscila
+    # y solo aplica el último estado deseado cuando difiere del último aplicado. Cada clave
+    # (monitor) tiene su propio estado para que los eventos de monitores distintos no se mezclen.
+    # Con varios workers el estado deseado y aplicado se comparte en el almacén de estado y un
+    # bloqueo por clave impide que dos workers apliquen la misma transición a la vez.
+
+    def __init__(self, cola: ColaTrabajos, ventana: float):
+        self.cola = cola
+        self.ventana = ventana
+        self._estados: Dict[str, EstadoTransicion] = {}
+        self._lock = threading.Lock()
+
+    def solicitar(self, enabled: bool, descripcion: str, ejecutar: Ejecutor,
+                  clave: str = CLAVE_POR_DEFECTO) -> Tuple[Trabajo, bool]:
+        # Devuelve el trabajo que aplicará el estado y si el evento se ha agrupado en uno ya pendiente.
+
+        instante = time.time()
+        try:
+            almacen_estado.registrar_evento(clave, enabled, instante)
+        except Exception as e:
+            logger.error(f"Error al registrar el evento en el almacén de estado: {e}")
+
+        with self._lock:
+            estado = self._estados.get(clave)
+            if estado is None:
+                estado = self._estados[clave] = EstadoTransicion(clave)
+            estado.deseado = enabled
+            estado.ultimo_evento = time.monotonic()
+            estado.instante_evento = instante
+            estado.eventos_pendientes += 1
+
+            if estado.pendiente is not None:
+                logger.info(f"Evento agrupado en el trabajo pendiente {estado.pendiente.id}: {descripcion}")
+                return estado.pendiente, True
+
+            # Un carril por clave: el debounce y la ejecución de un monitor no hacen esperar a los demás
+            estado.pendiente = self.cola.encolar(descripcion, self._ejecutar_transicion, estado, ejecutar, carril=clave)
+            return estado.pendiente, False
+
+    def _ejecutar_transicion(self, trabajo: Trabajo, estado: EstadoTransicion, ejecutar: Ejecutor) -> Dict[str, Any]:
+
+        # Esperamos a que no lleguen eventos durante toda la ventana
+        with trabajo.etapa("debounce") as etapa:
+            while True:
+                with self._lock:
+                    restante = estado.ultimo_evento + self.ventana - time.monotonic()
+                    if restante <= 0:
+                        objetivo = estado.deseado
+                        instante = estado.instante_evento
+                        eventos = estado.eventos_pendientes
+                        estado.eventos_pendientes = 0
+                        # A partir de aquí los nuevos eventos crean otro trabajo
+                        estado.pendiente = None
+                        break
+                time.sleep(restante)
+            etapa["mensaje"] = f"{eventos} eventos agrupados, estado deseado: {'DOWN' if objetivo else 'UP'}"
+
+        # Solo un worker a la vez aplica las reglas de una clave
+        with bloqueo_exclusivo(f"transicion:{estado.clave}"):
+            compartido = self._estado_compartido(estado)
+            if compartido["evento"] > instante:
+                mensaje = "Otro worker ha recibido un evento posterior y aplicará su estado."
+                logger.info(mensaje)
+                return {"omitido": True, "eventos_agrupados": eventos, "message": mensaje}
+
+            if objetivo == compartido["aplicado"]:
+                mensaje = f"El estado {'DOWN' if objetivo else 'UP'} ya estaba aplicado. No se requiere ninguna acción."
+                logger.info(mensaje)
+                return {"omitido": True, "eventos_agrupados": eventos, "message": mensaje}
+
+            response_data, exito = ejecutar(trabajo, objetivo)
+
+            # Si algo falló no damos el estado por aplicado para que el siguiente webhook lo reintente
+            aplicado = objetivo if exito else None
+            with self._lock:
+                estado.aplicado = aplicado
+            try:
+                almacen_estado.marcar_aplicado(estado.clave, aplicado)
+            except Exception as e:
+                logger.error(f"Error al guardar el estado aplicado en el almacén de estado: {e}")
+
+        return dict(response_data, omitido=False, eventos_agrupados=eventos)
+
+    def _estado_compartido(self, estado: EstadoTransicion) -> Dict[str, Any]:
+        # Último evento y estado aplicado de todos los workers. Si el almacén falla seguimos con el local.
+
+        try:
+            return almacen_estado.obtener_transicion(estado.clave)
+        except Exception as e:
+            logger.error(f"Error al leer el almacén de estado, se usa el estado local: {e}")
+            with self._lock:
+                return {"deseado": estado.deseado, "evento": 0.0, "aplicado": estado.aplicado}
+
+control_transiciones = ControlTransiciones(cola_trabajos, DEBOUNCE_SEGUNDOS)
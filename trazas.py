@@ -0,0 +1,284 @@
+import atexit
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from bloqueos import bloqueo_exclusivo
+from config import OTEL_EXPORTER_OTLP_ENDPOINT, OTEL_SERVICE_NAME, TRAZAS_EXPORTADOR
+from utils import setup_logger, trace_id_var
+
+logger = setup_logger(__name__)
+
+FICHERO_TRAZAS = '/app/data/trazas.jsonl'
+# Al superar este tamaño el fichero pasa a trazas.jsonl.1 y se empieza uno nuevo
+TAMANO_MAXIMO_TRAZAS = 10 * 1024 * 1024
+
+FICHERO = 'fichero'
+OTLP = 'otlp'
+
+# Spans que se envían juntos y tiempo máximo que espera una span en la cola
+LOTE_MAXIMO = 256
+INTERVALO_EXPORTACION = 2.0
+TIMEOUT_OTLP = 5.0
+
+_TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+class Span:
+    # Operación con su duración y atributos. Los identificadores siguen el formato de W3C Trace Context
+    # (trace de 32 caracteres hexadecimales, span de 16), así que se pueden enviar a cualquier backend OTLP.
+
+    __slots__ = ('nombre', 'trace_id', 'span_id', 'padre_id', 'inicio', 'fin', 'atributos', 'error')
+
+    def __init__(self, nombre: str, trace_id: str, padre_id: Optional[str], atributos: Dict[str, Any]):
+        self.nombre = nombre
+        self.trace_id = trace_id
+        self.span_id = _nuevo_id(64)
+        self.padre_id = padre_id
+        self.inicio = time.time_ns()
+        self.fin: Optional[int] = None
+        self.atributos = atributos
+        self.error: Optional[str] = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @property
+    def duracion(self) -> float:
+        # Segundos, hasta ahora si la span sigue abierta
+        return ((self.fin or time.time_ns()) - self.inicio) / 1e9
+
+    def atributo(self, clave: str, valor: Any):
+        self.atributos[clave] = valor
+
+    def marcar_error(self, mensaje: str):
+        self.error = mensaje
+
+    def to_dict(self) -> Dict[str, Any]:
+
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.padre_id,
+            "name": self.nombre,
+            "start": self.inicio / 1e9,
+            "end": self.fin / 1e9 if self.fin else None,
+            "duration_ms": round(self.duracion * 1000, 3),
+            "attributes": self.atributos,
+            "status": "ERROR" if self.error else "OK",
+            "error": self.error,
+        }
+
+_span_actual: contextvars.ContextVar = contextvars.ContextVar("span_actual", default=None)
+
+def _nuevo_id(bits: int) -> str:
+    # Ni el trace ni la span pueden ser todo ceros
+    return format(random.getrandbits(bits) or 1, f'0{bits // 4}x')
+
+def _padre_remoto(traceparent: Optional[str]) -> Optional[Tuple[str, str]]:
+
+    m = _TRACEPARENT.match((traceparent or '').strip().lower())
+    if not m or m.group(1) == '0' * 32 or m.group(2) == '0' * 16:
+        return None
+    return m.group(1), m.group(2)
+
+def span_actual() -> Optional[Span]:
+    return _span_actual.get()
+
+def trace_id_actual() -> Optional[str]:
+
+    actual = _span_actual.get()
+    return actual.trace_id if actual else None
+
+@contextmanager
+def span(nombre: str, traceparent: Optional[str] = None, **atributos):
+    # Abre una span hija de la actual o, si no hay ninguna, la raíz de una traza nueva (o de la del
+    # cliente si envía una cabecera traceparent válida). Como la span actual vive en un ContextVar,
+    # los hilos lanzados con contextvars.copy_context().run quedan colgando de la span que los lanzó.
+
+    padre = _span_actual.get()
+    if padre is not None:
+        trace_id, padre_id = padre.trace_id, padre.span_id
+    else:
+        trace_id, padre_id = _padre_remoto(traceparent) or (_nuevo_id(128), None)
+
+    nueva = Span(nombre, trace_id, padre_id, atributos)
+    token = _span_actual.set(nueva)
+    # El log muestra el trace de la operación en curso
+    token_log = trace_id_var.set(trace_id)
+    try:
+        yield nueva
+    except Exception as e:
+        nueva.marcar_error(str(e) or type(e).__name__)
+        raise
+    finally:
+        nueva.fin = time.time_ns()
+        trace_id_var.reset(token_log)
+        _span_actual.reset(token)
+        exportador.exportar(nueva)
+
+def en_span(nombre: str, atributos: Dict[str, Any], funcion: Callable, *args):
+    # Ejecuta funcion(*args) dentro de una span, para lanzarla en un executor con copy_context().run.
+
+    with span(nombre, **atributos):
+        return funcion(*args)
+
+def _valor_otlp(valor: Any) -> Dict[str, Any]:
+
+    if isinstance(valor, bool):
+        return {"boolValue": valor}
+    if isinstance(valor, int):
+        return {"intValue": str(valor)}
+    if isinstance(valor, float):
+        return {"doubleValue": valor}
+    return {"stringValue": str(valor)}
+
+def _span_otlp(s: Span) -> Dict[str, Any]:
+
+    datos = {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "name": s.nombre,
+        # SPAN_KIND_SERVER para las raíces, INTERNAL para el resto
+        "kind": 2 if s.padre_id is None else 1,
+        "startTimeUnixNano": str(s.inicio),
+        "endTimeUnixNano": str(s.fin),
+        "attributes": [{"key": k, "value": _valor_otlp(v)} for k, v in s.atributos.items() if v is not None],
+        # STATUS_CODE_OK = 1, STATUS_CODE_ERROR = 2
+        "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+    }
+    if s.padre_id:
+        datos["parentSpanId"] = s.padre_id
+    return datos
+
+class ExportadorTrazas:
+    # Envía las spans terminadas en segundo plano, por lotes, a un fichero JSON Lines o a un colector
+    # OpenTelemetry por OTLP/HTTP (JSON). Sin exportador configurado las spans solo sirven para los
+    # identificadores del log y de las respuestas.
+
+    def __init__(self, tipo: str, fichero: str, endpoint: str, servicio: str):
+        if tipo not in ('', FICHERO, OTLP):
+            logger.warning(f"TRAZAS_EXPORTADOR={tipo} no es válido (fichero u otlp), las trazas no se exportan")
+            tipo = ''
+        self.tipo = tipo
+        self.fichero = fichero
+        self.endpoint = endpoint.rstrip('/')
+        self.servicio = servicio
+        self.exportadas = 0
+        self.descartadas = 0
+        self.errores = 0
+        self._cola: "queue.SimpleQueue[Optional[Span]]" = queue.SimpleQueue()
+        self._hilo: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # Sesión propia: las llamadas de la exportación no deben generar spans
+        self._sesion: Optional[requests.Session] = None
+
+    def exportar(self, s: Span):
+
+        if not self.tipo:
+            return
+        if self._hilo is None:
+            self._iniciar()
+        self._cola.put(s)
+
+    def _iniciar(self):
+
+        with self._lock:
+            if self._hilo is not None:
+                return
+            if self.tipo == OTLP:
+                self._sesion = requests.Session()
+            self._hilo = threading.Thread(target=self._bucle, name="trazas", daemon=True)
+            self._hilo.start()
+            atexit.register(self.detener)
+        logger.info(f"Exportación de trazas activada: {self.endpoint if self.tipo == OTLP else self.fichero}")
+
+    def detener(self):
+        # Envía lo que quede en la cola antes de salir.
+
+        if self._hilo is not None:
+            self._cola.put(None)
+            self._hilo.join(TIMEOUT_OTLP)
+
+    def _bucle(self):
+
+        lote: List[Span] = []
+        limite = time.monotonic() + INTERVALO_EXPORTACION
+        while True:
+            try:
+                s = self._cola.get(timeout=max(0.0, limite - time.monotonic()))
+            except queue.Empty:
+                s = False
+            if s:
+                lote.append(s)
+            if lote and (s is None or s is False or len(lote) >= LOTE_MAXIMO):
+                self._enviar(lote)
+                lote = []
+            if s is None:
+                return
+            if s is False:
+                limite = time.monotonic() + INTERVALO_EXPORTACION
+
+    def _enviar(self, lote: List[Span]):
+
+        try:
+            if self.tipo == OTLP:
+                self._enviar_otlp(lote)
+            else:
+                self._escribir_fichero(lote)
+            with self._lock:
+                self.exportadas += len(lote)
+        except Exception as e:
+            with self._lock:
+                self.errores += 1
+                self.descartadas += len(lote)
+            logger.warning(f"No se han podido exportar {len(lote)} spans: {e}")
+
+    def _escribir_fichero(self, lote: List[Span]):
+
+        lineas = ''.join(json.dumps(s.to_dict(), ensure_ascii=False, default=str) + '\n' for s in lote)
+        # Con varios workers el bloqueo evita que se mezclen las líneas o se roten a la vez
+        with bloqueo_exclusivo("trazas"):
+            try:
+                if os.path.getsize(self.fichero) > TAMANO_MAXIMO_TRAZAS:
+                    os.replace(self.fichero, self.fichero + '.1')
+            except FileNotFoundError:
+                pass
+            with open(self.fichero, 'a', encoding='utf-8') as f:
+                f.write(lineas)
+
+    def _enviar_otlp(self, lote: List[Span]):
+
+        cuerpo = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.servicio}}]},
+                "scopeSpans": [{
+                    "scope": {"name": "unifi-pbr-cloudflare"},
+                    "spans": [_span_otlp(s) for s in lote],
+                }],
+            }]
+        }
+        response = self._sesion.post(f"{self.endpoint}/v1/traces", json=cuerpo, timeout=TIMEOUT_OTLP)
+        if response.status_code >= 300:
+            raise RuntimeError(f"el colector ha respondido {response.status_code}: {response.text[:200]}")
+
+    def estadisticas(self) -> Dict[str, Any]:
+
+        with self._lock:
+            return {
+                "exportador": self.tipo or None,
+                "exportadas": self.exportadas,
+                "descartadas": self.descartadas,
+                "errores": self.errores,
+            }
+
+exportador = ExportadorTrazas(TRAZAS_EXPORTADOR, FICHERO_TRAZAS, OTEL_EXPORTER_OTLP_ENDPOINT, OTEL_SERVICE_NAME)
@@ -1,145 +1,37 @@
-import json
-import time
-
-import requests
-import telebot
-import urllib3
-from flask import Flask, jsonify, request
-
-from cloudflare_zones import procesar_zonas
+import functools
+import logging
+from typing import Any, Dict, Tuple
+
+from flask import Flask, Response, jsonify, request
+
+import circuito
+import metricas
+import trazas
+
+from cache_dns import cache_dns
+from cache_validacion import cache_validacion
+from cloudflare_zones import planificar, procesar_zonas
+from plan_zonas import obtener_plan
+from reconciliador import reconciliador
+from enrutado import TODOS_LOS_MONITORES, cargar_configuracion, clave_monitor, perfil
 from config import (
-    CLIENTE_NOTIFICACION,
-    DISCORD_WEBHOOK,
-    IMG_DISCORD_URL,
-    INITIAL_DELAY,
-    NOMBRE_PBR,
-    TELEGRAM_BOT_TOKEN,
-    TELEGRAM_CHAT_ID,
-    UNIFI_API_TOKEN,
-    UNIFI_URL,
     check_cloudflare_config,
     check_unifi_config,
 )
+from http_client import planificadores
 from ip_info import obtener_ip_publica
-from utils import generate_trace_id, setup_logger
+from ip_info import puntuaciones as puntuaciones_ip
+from notificaciones import estadisticas as estadisticas_notificaciones
+from notificaciones import notificar_evento
+from trabajos import cola_trabajos
+from transiciones import control_transiciones
+from unifi import cambiar_estado_destinos, precargar
+from unifi import estadisticas as estadisticas_unifi
+from utils import setup_logger, volcar
+from vigilante_ip import vigilante_ip
 
 logger = setup_logger(__name__)
 
-# Desactivar advertencias SSL ya que usamos verify=False
-urllib3.disable_warnings()
-verify_ssl = False
-
-def get_traffic_routes():
-    # Obtiene todas las reglas PBR configuradas en Unifi.
-
-    url = f"{UNIFI_URL}/proxy/network/v2/api/site/default/trafficroutes"
-    headers = {
-        "X-API-KEY": UNIFI_API_TOKEN,
-        "Accept": "application/json"
-    }
-
-    try:
-        response = requests.get(url, headers=headers, verify=verify_ssl)
-        if response.status_code == 200:
-            formatted_json = json.dumps(response.json(), indent=4, ensure_ascii=False)
-            logger.debug(f"Obteniendo las PBR en Unifi: {UNIFI_URL} - status: {response.status_code}\n\n{formatted_json}\n.")
-            return response.json()
-        else:
-            logger.error(f"Error al obtener las PBR en Unifi: {UNIFI_URL} {response.status_code} - {response.text}.")
-            return []
-    except requests.RequestException:
-        return []
-
-def update_traffic_route_status(route_data, enabled=False):
-
-    url = f"{UNIFI_URL}/proxy/network/v2/api/site/default/trafficroutes/{route_data['_id']}"
-    headers = {
-        "X-API-KEY": UNIFI_API_TOKEN,
-        "Accept": "application/json",
-        "Content-Type": "application/json"
-    }
-
-    payload = route_data.copy()
-    payload['enabled'] = enabled
-
-    try:
-        request_data = json.dumps(payload, indent=4)
-        logger.debug(f"Enviando petición PUT a {url} con datos:\n{request_data}.")
-
-        update_response = requests.put(
-            url,
-            headers=headers,
-            json=payload,
-            verify=verify_ssl,
-            allow_redirects=True
-        )
-
-        logger.debug(f"Respuesta del servidor ({update_response.status_code}):\n{update_response.text}.")
-
-        if update_response.status_code == 200:
-            logger.debug(f"Aplicado cambio en la PBR {route_data['description']} en Unifi {UNIFI_URL}.")
-            return True, update_response.json()
-        else:
-            error_msg = f"Error al aplicar cambio en la PBR {route_data['description']} en Unifi {UNIFI_URL}. Status: {update_response.status_code}. Respuesta: {update_response.text}."
-            logger.error(error_msg)
-            return False, {"error": error_msg}
-    except requests.RequestException as e:
-        error_msg = f"Excepción al actualizar PBR {route_data['description']}: {str(e)}."
-        logger.error(error_msg)
-        return False, {"error": error_msg}
-
-def send_notification(message, title, parse_mode=None, retries=4, delay=2.0, initial_delay=INITIAL_DELAY):
-    if CLIENTE_NOTIFICACION:
-        if CLIENTE_NOTIFICACION == "telegram":
-            if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
-
-                if initial_delay > 0:
-                    time.sleep(initial_delay)
-
-                for attempt in range(retries):
-                    try:
-                        bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
-                        bot.send_message(TELEGRAM_CHAT_ID, message, parse_mode=parse_mode)
-                        logger.info("Notificación enviada a Telegram correctamente.")
-                        return True
-                    except Exception as e:
-                        logger.debug(f"Notificación enviada a Telegram: {message}.")
-                        logger.debug(f"Intento {attempt+1}/{retries}: Error al enviar notificación a Telegram: {str(e)}.")
-                        if attempt < retries - 1:
-                            time.sleep(delay)
-                        else:
-                            logger.error(f"Error al enviar notificación a Telegram después de {retries} intentos: {str(e)}.")
-                            return False
-            return False
-        elif CLIENTE_NOTIFICACION == "discord":
-            try:
-                    message = message.replace("<b>", "**").replace("</b>", "**")
-
-                    # Payload con embeds para incluir imagen
-                    payload = {
-                        "avatar_url": IMG_DISCORD_URL,
-                        "embeds": [
-                            {
-                                "title": title,
-                                "description": message,
-                                "color": 6018047,
-                                "thumbnail": {"url": IMG_DISCORD_URL}
-                            }
-                        ]
-                    }
-
-                    response = requests.post(DISCORD_WEBHOOK, json=payload)
-
-                    if response.status_code == 204:  # Discord devuelve 204 cuando es exitoso
-                        logger.info("Notificación enviada a Discord correctamente.")
-                    else:
-                        logger.error(f"Error al enviar mensaje a Discord. Status code: {response.status_code}")
-
-            except Exception as e:
-                logger.error(f"Error al enviar mensaje a Discord: {str(e)}")
-        else:
-            logger.error(f"Cliente de notificación no soportado: {CLIENTE_NOTIFICACION}")
-
 def process_webhook_data(data):
 
     # Verificar si es una prueba de conexión
@@ -161,62 +53,148 @@ def process_webhook_data(data):
 
 app = Flask(__name__)
 
+metricas.registrar_estadisticas("cache_validacion", "Contadores de la cache de validación de Cloudflare", cache_validacion.estadisticas)
+metricas.registrar_estadisticas("cache_dns", "Contadores de la cache de registros DNS de Cloudflare", cache_dns.estadisticas)
+metricas.registrar_estadisticas("cache_rutas_unifi", "Contadores de la cache de rutas de Unifi", estadisticas_unifi)
+metricas.registrar_estadisticas("notificaciones", "Contadores del envío de notificaciones", estadisticas_notificaciones)
+metricas.registrar_estadisticas("reconciliador", "Ciclos y reparaciones de la reconciliación periódica", reconciliador.estadisticas)
+metricas.registrar_estadisticas("vigilante_ip", "Comprobaciones y cambios de la IP pública con la WAN de respaldo", vigilante_ip.estadisticas)
+metricas.registrar_estadisticas("circuitos", "Circuitos abiertos, aperturas y llamadas rechazadas sin salir a la red", circuito.resumen)
+metricas.registrar_estadisticas("trazas", "Spans exportadas y descartadas por el exportador de trazas", trazas.exportador.estadisticas)
+
+if check_unifi_config()[0]:
+    precargar(cargar_configuracion().destinos())
+# El plan de zonas se compila y valida al arrancar, los errores de zonas.json aparecen en el log desde el inicio
+if check_cloudflare_config()[0]:
+    obtener_plan()
+reconciliador.iniciar()
+vigilante_ip.iniciar()
+
 @app.route('/api/route', methods=['POST'])
 def process_webhook():
 
-    generate_trace_id()
+    # Cada webhook es la raíz de una traza, o continúa la del cliente si envía la cabecera traceparent
+    with trazas.span("webhook", traceparent=request.headers.get('traceparent')) as raiz:
+        cuerpo, codigo = _procesar_webhook(raiz)
+        raiz.atributo("http.status_code", codigo)
+
+    cuerpo.update(trace_id=raiz.trace_id, span_id=raiz.span_id)
+    respuesta = jsonify(cuerpo)
+    respuesta.status_code = codigo
+    respuesta.headers['traceparent'] = raiz.traceparent
+    return respuesta
+
+def _procesar_webhook(raiz: trazas.Span) -> Tuple[Dict[str, Any], int]:
 
     try:
         data = request.get_json()
     except Exception:
-        return jsonify({"error": "El contenido debe ser JSON."}), 400
+        return {"error": "El contenido debe ser JSON."}, 400
 
-    formatted_json = json.dumps(data, indent=4, ensure_ascii=False)
-    logger.debug(f"Payload recibido:\n\n{formatted_json}\n.")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Payload recibido:\n\n%s\n.", volcar(data))
 
     # Procesar los datos del webhook
     is_valid, is_test, enabled, message = process_webhook_data(data)
 
     if not is_valid:
-        return jsonify({"error": message}), 400
+        return {"error": message}, 400
 
     if is_test:
         logger.info("Prueba desde Uptime Kuma satisfactoria.")
-        return jsonify({"message": message})
+        return {"message": message}, 200
+
+    cloudflare_config_valid, cloudflare_message = check_cloudflare_config()
+    unifi_config_valid, unifi_message = check_unifi_config()
+
+    # Si ninguno está configurado, devolver error
+    if not cloudflare_config_valid and not unifi_config_valid:
+        return {
+            "error": "No hay configuración válida para Cloudflare ni Unifi",
+            "details": {
+                "unifi": {"processed": False, "message": unifi_message},
+                "cloudflare": {"processed": False, "message": cloudflare_message}
+            }
+        }, 500
+
+    # El procesamiento se hace en segundo plano para responder a Uptime Kuma inmediatamente,
+    # los eventos que lleguen seguidos se agrupan en un único trabajo con el último estado
+    # Cada monitor tiene su perfil de zonas y rutas de Unifi (rutas.json) y su propio estado
+    clave = clave_monitor(data.get('monitor'))
+    raiz.atributo("monitor", clave)
+    raiz.atributo("enabled", enabled)
+
+    # Con ?plan=1 solo se calculan los cambios: no se registra el evento ni se escribe nada
+    if request.args.get('plan', '').lower() in ('1', 'true', 'si'):
+        raiz.atributo("plan", True)
+        logger.info(f"Plan de cambios solicitado: {message}")
+        return dict(planificar(enabled, clave), message=message), 200
+    trabajo, agrupado = control_transiciones.solicitar(
+        enabled, message, functools.partial(ejecutar_webhook, clave=clave), clave
+    )
+    raiz.atributo("trabajo", trabajo.id)
+    raiz.atributo("agrupado", agrupado)
+    if not agrupado:
+        logger.info(f"Trabajo {trabajo.id} encolado: {message}")
+
+    # Si el evento se agrupa, el trabajo se ejecuta en la traza del webhook que lo creó
+    return {
+        "message": message,
+        "job_id": trabajo.id,
+        "job_trace_id": trabajo.trace_id,
+        "agrupado": agrupado,
+        "status_url": f"/api/jobs/{trabajo.id}"
+    }, 202
+
+def ejecutar_webhook(trabajo, enabled, clave=TODOS_LOS_MONITORES):
 
     response_data = {
         "unifi": {"processed": False, "message": "No procesado"},
         "cloudflare": {"processed": False, "message": "No procesado"}
     }
+    notificaciones = []
+    estado_webhook = 'activado' if enabled else 'desactivado'
+    perfil_monitor = perfil(clave)
+    # Un perfil con "zonas": [] solo cambia reglas de Unifi
+    sin_zonas = perfil_monitor.zonas is not None and not perfil_monitor.zonas
 
     # Primero, obtener la IP pública si es necesario
     ip_publica = None
     cloudflare_config_valid, cloudflare_message = check_cloudflare_config()
-    if cloudflare_config_valid and enabled:
-        try:
-            ip_publica = obtener_ip_publica()
-            if ip_publica:
-                logger.info(f"IP pública obtenida: {ip_publica}")
-            else:
-                logger.warning("No se pudo obtener la IP pública")
-        except Exception as e:
-            logger.error(f"Error al obtener IP pública: {str(e)}")
+    if cloudflare_config_valid and enabled and not sin_zonas:
+        with trabajo.etapa("ip_publica") as etapa:
+            try:
+                ip_publica = obtener_ip_publica()
+                if ip_publica:
+                    logger.info(f"IP pública obtenida: {ip_publica}")
+                else:
+                    logger.warning("No se pudo obtener la IP pública")
+            except Exception as e:
+                logger.error(f"Error al obtener IP pública: {str(e)}")
+            etapa["mensaje"] = ip_publica
 
     # Procesar Cloudflare si está configurado
-    if cloudflare_config_valid:
-        try:
-            estado_webhook = 'activado' if enabled else 'desactivado'
-            logger.info(f"Procesando configuraciones de Cloudflare para estado: {estado_webhook}")
-            procesar_zonas(estado_webhook, ip_publica)
-            mensaje = f"Configuraciones de Cloudflare procesadas correctamente para estado: {estado_webhook}"
-            logger.info(mensaje)
-            response_data["cloudflare"] = {"processed": True, "message": mensaje}
-            send_notification(f"🌍 *Cloudflare*: Configuraciones procesadas para estado: *{estado_webhook}*",
-                           "Estado CLOUDFLARE", parse_mode="Markdown")
-        except Exception as e:
-            error_msg = f"Error al procesar configuraciones de Cloudflare: {str(e)}"
-            logger.error(error_msg)
-            response_data["cloudflare"] = {"processed": False, "message": error_msg}
+    if cloudflare_config_valid and sin_zonas:
+        mensaje = f"No hay zonas configuradas para el monitor: {clave}"
+        logger.info(mensaje)
+        response_data["cloudflare"] = {"processed": True, "message": mensaje}
+    elif cloudflare_config_valid:
+        with trabajo.etapa("cloudflare") as etapa:
+            try:
+                logger.info(f"Procesando configuraciones de Cloudflare para estado: {estado_webhook}")
+                # False si Cloudflare no responde (o su circuito está abierto), sin plan o sin IP pública
+                if not procesar_zonas(estado_webhook, ip_publica, perfil_monitor.zonas):
+                    raise RuntimeError("no se ha podido conectar con Cloudflare, cargar zonas.json u obtener la IP pública")
+                mensaje = f"Configuraciones de Cloudflare procesadas correctamente para estado: {estado_webhook}"
+                logger.info(mensaje)
+                response_data["cloudflare"] = {"processed": True, "message": mensaje}
+                notificaciones.append((f"🌍 *Cloudflare*: Configuraciones procesadas para estado: *{estado_webhook}*",
+                                       "Estado CLOUDFLARE"))
+            except Exception as e:
+                error_msg = f"Error al procesar configuraciones de Cloudflare: {str(e)}"
+                logger.error(error_msg)
+                response_data["cloudflare"] = {"processed": False, "message": error_msg}
+            etapa["mensaje"] = response_data["cloudflare"]["message"]
     else:
         logger.info(f"Cloudflare no configurado: {cloudflare_message}")
         response_data["cloudflare"] = {"processed": False, "message": cloudflare_message}
@@ -224,46 +202,100 @@ def process_webhook():
     # Procesar Unifi si está configurado
     unifi_config_valid, unifi_message = check_unifi_config()
     if unifi_config_valid:
-        try:
-            routes = get_traffic_routes()
-            for route in routes:
-                if route['description'] == NOMBRE_PBR:
-                    success, route_response = update_traffic_route_status(route, enabled)
-                    action_msg = 'activada' if enabled else 'desactivada'
-                    if success:
-                        mensaje = f"Regla '{NOMBRE_PBR}' {action_msg} correctamente"
-                        logger.info(mensaje)
-                        response_data["unifi"] = {"processed": True, "message": mensaje}
-                        send_notification(
-                            f"⚽ Regla *{NOMBRE_PBR}* {action_msg} correctamente en Unifi {UNIFI_URL}",
-                            "Estado UNIFI",
-                            parse_mode="Markdown"
-                        )
+        with trabajo.etapa("unifi") as etapa:
+            try:
+                lista = perfil_monitor.destinos
+                if not lista:
+                    # rutas.json sin entrada "*": los monitores no listados no tocan Unifi
+                    mensaje = f"No hay rutas de Unifi configuradas para el monitor: {clave}"
+                    logger.info(mensaje)
+                    response_data["unifi"] = {"processed": True, "message": mensaje, "destinos": []}
+                else:
+                    resultados = cambiar_estado_destinos(lista, enabled)
+                    correctos = [r for r in resultados if r["processed"]]
+                    if len(lista) == 1:
+                        mensaje = resultados[0]["message"]
                     else:
-                        error_msg = f"Error al {action_msg} la regla '{NOMBRE_PBR}'"
-                        logger.error(error_msg)
-                        response_data["unifi"] = {"processed": False, "message": error_msg}
-                    break
-            else:
-                error_msg = f"No se encontró la regla: {NOMBRE_PBR}"
+                        mensaje = f"{len(correctos)} de {len(resultados)} reglas {'activadas' if enabled else 'desactivadas'} correctamente"
+                    response_data["unifi"] = {
+                        "processed": len(correctos) == len(resultados),
+                        "message": mensaje,
+                        "destinos": resultados
+                    }
+                    for r in correctos:
+                        notificaciones.append((f"⚽ Regla *{r['ruta']}* {'activada' if enabled else 'desactivada'} correctamente en Unifi {r['url']}",
+                                               "Estado UNIFI"))
+            except Exception as e:
+                error_msg = f"Error procesando Unifi: {str(e)}"
                 logger.error(error_msg)
                 response_data["unifi"] = {"processed": False, "message": error_msg}
-        except Exception as e:
-            error_msg = f"Error procesando Unifi: {str(e)}"
-            logger.error(error_msg)
-            response_data["unifi"] = {"processed": False, "message": error_msg}
+            etapa["mensaje"] = response_data["unifi"]["message"]
     else:
         logger.info(f"Unifi no configurado: {unifi_message}")
         response_data["unifi"] = {"processed": False, "message": unifi_message}
 
-    # Si ninguno está configurado, devolver error
-    if not cloudflare_config_valid and not unifi_config_valid:
-        return jsonify({
-            "error": "No hay configuración válida para Cloudflare ni Unifi",
-            "details": response_data
-        }), 500
-
-    return jsonify(response_data)
+    # Un único mensaje por evento, enviado en segundo plano por el hilo de notificaciones
+    if notificaciones:
+        with trabajo.etapa("notificaciones") as etapa:
+            encolada = notificar_evento(notificaciones, parse_mode="Markdown")
+            etapa["mensaje"] = "encolada" if encolada else "no enviada"
+
+    # La transición solo se da por aplicada si todo lo configurado se procesó correctamente
+    exito = all(
+        response_data[servicio]["processed"]
+        for servicio, valido in (("cloudflare", cloudflare_config_valid), ("unifi", unifi_config_valid))
+        if valido
+    )
+
+    return response_data, exito
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+
+    trabajo = cola_trabajos.obtener(job_id)
+    if trabajo is None:
+        return jsonify({"error": f"No existe el trabajo {job_id}."}), 404
+    return jsonify(trabajo)
+
+@app.route('/api/cache', methods=['GET'])
+def cache_stats():
+
+    return jsonify({
+        "validacion": cache_validacion.estadisticas(),
+        "dns": cache_dns.estadisticas(),
+        "rutas_unifi": estadisticas_unifi()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+
+    contenido, content_type = metricas.exportar()
+    return Response(contenido, mimetype=content_type)
+
+@app.route('/api/estado', methods=['GET'])
+def estado():
+
+    return jsonify({
+        "validacion": cache_validacion.estadisticas(),
+        "notificaciones": estadisticas_notificaciones(),
+        "proveedores_ip": puntuaciones_ip(),
+        "planificadores": planificadores(),
+        "reconciliador": reconciliador.estadisticas(),
+        "vigilante_ip": vigilante_ip.estadisticas(),
+        "trazas": trazas.exportador.estadisticas(),
+        "circuitos": circuito.estados()
+    })
+
+@app.route('/api/salud', methods=['GET'])
+def salud():
+    # Estado de los circuitos de cada servicio externo. Siempre 200: la caída de Cloudflare o de
+    # Unifi no se arregla reiniciando el contenedor.
+
+    circuitos = circuito.estados()
+    return jsonify({
+        "estado": "degradado" if any(c["estado"] != circuito.CERRADO for c in circuitos.values()) else "ok",
+        "circuitos": circuitos
+    })
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=1666)
@@ -0,0 +1,437 @@
+import contextvars
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+import urllib3
+
+import metricas
+import trazas
+from config import CONCURRENCIA_RUTAS, UNIFI_CACHE_TTL
+from enrutado import CONTROLADOR_POR_DEFECTO, SITIO_POR_DEFECTO, Controlador, Destino, cargar_configuracion
+from http_client import UNIFI, obtener_sesion
+from utils import setup_logger, volcar
+
+logger = setup_logger(__name__)
+
+# Desactivar advertencias SSL ya que usamos verify=False
+urllib3.disable_warnings()
+
+# Duración de un PUT en Unifi para estimar el plan cuando aún no hay ninguna medida
+LATENCIA_ESCRITURA_POR_DEFECTO = 0.3
+
+_executor = ThreadPoolExecutor(max_workers=max(1, CONCURRENCIA_RUTAS), thread_name_prefix="unifi")
+
+class IndiceRutas:
+    # Rutas del sitio indexadas por descripción y por _id.
+
+    def __init__(self, rutas: List[Dict[str, Any]], etag: Optional[str], huella: str):
+        self.por_descripcion: Dict[str, Dict[str, Any]] = {}
+        self.por_id: Dict[str, Dict[str, Any]] = {}
+        self.etag = etag
+        self.huella = huella
+        self.cargado = time.monotonic()
+        for ruta in rutas:
+            self._indexar(ruta)
+
+    def _indexar(self, ruta: Dict[str, Any]):
+        # Si hay varias rutas con la misma descripción nos quedamos con la primera, como la búsqueda lineal
+        if ruta.get('_id'):
+            self.por_id[ruta['_id']] = ruta
+        if ruta.get('description') is not None:
+            existente = self.por_descripcion.get(ruta['description'])
+            if existente is None or existente.get('_id') == ruta.get('_id'):
+                self.por_descripcion[ruta['description']] = ruta
+
+    def caducado(self) -> bool:
+        return time.monotonic() - self.cargado > UNIFI_CACHE_TTL
+
+def _vigente(indice: Optional[IndiceRutas], desde: Optional[float]) -> bool:
+    return indice is not None and not indice.caducado() and (desde is None or indice.cargado >= desde)
+
+class CacheRutasUnifi:
+    # Cache del listado de rutas de Unifi con revalidación en segundo plano, para que el
+    # cambio de estado sea un único PUT a un _id ya conocido.
+
+    def __init__(self, sitio: "SitioUnifi"):
+        self.sitio = sitio
+        self.hits = 0
+        self.misses = 0
+        self.recargas = 0
+        self.sin_cambios = 0
+        self._indice: Optional[IndiceRutas] = None
+        self._lock = threading.Lock()
+        self._lock_carga = threading.Lock()
+        self._hilo: Optional[threading.Thread] = None
+
+    def obtener(self, descripcion: str, forzar: bool = False,
+                desde: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        # Devuelve una copia de la ruta con esa descripción, recargando el índice si hace falta.
+        # Con desde (time.monotonic()) el índice cargado antes de ese instante se revalida aunque no
+        # haya caducado: el PUT envía la ruta completa y con un índice desfasado desharía los cambios
+        # hechos desde la interfaz de Unifi. Las rutas de un mismo evento lo revalidan una sola vez.
+
+        indice = self._indice
+        if not forzar and _vigente(indice, desde):
+            with self._lock:
+                self.hits += 1
+            ruta = indice.por_descripcion.get(descripcion)
+            return dict(ruta) if ruta else None
+
+        with self._lock:
+            self.misses += 1
+        indice = self._recargar(forzar, desde)
+        if indice is None:
+            return None
+        ruta = indice.por_descripcion.get(descripcion)
+        return dict(ruta) if ruta else None
+
+    def _recargar(self, forzar: bool = False, desde: Optional[float] = None) -> Optional[IndiceRutas]:
+
+        # Un único hilo recarga el índice, el resto reutiliza el resultado
+        with self._lock_carga:
+            indice = self._indice
+            if not forzar and _vigente(indice, desde):
+                return indice
+
+            nuevo = self._cargar(None if forzar else indice)
+            if nuevo is not None:
+                self._indice = nuevo
+                self._arrancar_refresco()
+            return nuevo
+
+    @metricas.medir('get_traffic_routes')
+    def _cargar(self, anterior: Optional[IndiceRutas]) -> Optional[IndiceRutas]:
+
+        cabeceras = self.sitio.cabeceras()
+        # Revalidación barata si el controlador devuelve ETag
+        if anterior is not None and anterior.etag:
+            cabeceras['If-None-Match'] = anterior.etag
+
+        response = self.sitio.sesion.get(self.sitio.url_rutas, headers=cabeceras)
+
+        if response.status_code == 304 and anterior is not None:
+            anterior.cargado = time.monotonic()
+            with self._lock:
+                self.sin_cambios += 1
+            return anterior
+
+        if response.status_code != 200:
+            logger.error(f"Error al obtener las PBR en Unifi: {self.sitio} {response.status_code} - {response.text}.")
+            return None
+
+        # Sin ETag comparamos la huella del contenido para no reconstruir el índice si no ha cambiado
+        huella = hashlib.sha256(response.content).hexdigest()
+        if anterior is not None and anterior.huella == huella:
+            anterior.cargado = time.monotonic()
+            with self._lock:
+                self.sin_cambios += 1
+            return anterior
+
+        rutas = response.json()
+        logger.debug(f"Índice de PBR de Unifi {self.sitio} recargado: {len(rutas)} rutas.")
+        with self._lock:
+            self.recargas += 1
+        return IndiceRutas(rutas, response.headers.get('ETag'), huella)
+
+    def actualizar(self, ruta: Dict[str, Any]):
+        # Sustituye en el índice la ruta devuelta por Unifi tras un PUT.
+
+        indice = self._indice
+        if indice is None or not ruta.get('_id'):
+            return
+        with self._lock_carga:
+            indice._indexar(ruta)
+
+    def invalidar(self):
+
+        self._indice = None
+
+    def precargar(self):
+        # Carga el índice en segundo plano al arrancar para que el primer evento ya sea un único PUT.
+
+        def cargar():
+            try:
+                self._recargar()
+            except Exception as e:
+                logger.debug(f"Error al precargar las rutas de Unifi {self.sitio}: {e}")
+
+        threading.Thread(target=cargar, name="precarga-unifi", daemon=True).start()
+
+    def estadisticas(self) -> Dict[str, int]:
+
+        indice = self._indice
+        with self._lock:
+            return {
+                "rutas": len(indice.por_id) if indice else 0,
+                "hits": self.hits,
+                "misses": self.misses,
+                "recargas": self.recargas,
+                "sin_cambios": self.sin_cambios,
+            }
+
+    def _arrancar_refresco(self):
+
+        if UNIFI_CACHE_TTL <= 0 or self._hilo is not None:
+            return
+        self._hilo = threading.Thread(target=self._bucle_refresco, name=f"refresco-unifi-{self.sitio.sitio}", daemon=True)
+        self._hilo.start()
+
+    def _bucle_refresco(self):
+        # Revalida el índice antes de que caduque para que el webhook no tenga que descargarlo.
+
+        intervalo = max(1.0, UNIFI_CACHE_TTL / 2)
+        while True:
+            time.sleep(intervalo)
+            try:
+                self._revalidar()
+            except Exception as e:
+                logger.debug(f"Error al refrescar las rutas de Unifi {self.sitio}: {e}")
+
+    def _revalidar(self):
+
+        with self._lock_carga:
+            nuevo = self._cargar(self._indice)
+            if nuevo is not None:
+                self._indice = nuevo
+
+class SitioUnifi:
+    # Sitio de un controlador Unifi con su sesión y su cache de rutas.
+
+    def __init__(self, controlador: Controlador, sitio: str):
+        self.controlador = controlador
+        self.sitio = sitio
+        self.url_rutas = f"{controlador.url}/proxy/network/v2/api/site/{sitio}/trafficroutes"
+        # Una sesión (pool de conexiones) por controlador, compartida por todos sus sitios
+        nombre = UNIFI if controlador.nombre == CONTROLADOR_POR_DEFECTO else f"{UNIFI}-{controlador.nombre}"
+        self.sesion = obtener_sesion(nombre, verify=controlador.verificar_ssl)
+        self.cache = CacheRutasUnifi(self)
+
+    def cabeceras(self) -> Dict[str, str]:
+        return {
+            "X-API-KEY": self.controlador.api_token,
+            "Accept": "application/json"
+        }
+
+    def __str__(self) -> str:
+        return f"{self.controlador.url} (sitio {self.sitio})"
+
+_sitios: Dict[Tuple[str, str, str, str], SitioUnifi] = {}
+_lock_sitios = threading.Lock()
+
+def obtener_sitio(controlador: Controlador, sitio: str) -> SitioUnifi:
+    # Reutiliza el sitio (y su cache) mientras no cambien los datos del controlador.
+
+    clave = (controlador.nombre, controlador.url, controlador.api_token, sitio)
+    with _lock_sitios:
+        existente = _sitios.get(clave)
+        if existente is None:
+            existente = _sitios[clave] = SitioUnifi(controlador, sitio)
+        return existente
+
+def sitio_por_defecto() -> SitioUnifi:
+    return obtener_sitio(cargar_configuracion().controladores[CONTROLADOR_POR_DEFECTO], SITIO_POR_DEFECTO)
+
+def precargar(destinos: List[Destino]):
+    # Carga en segundo plano el índice de rutas de cada sitio configurado.
+
+    sitios = []
+    for destino in destinos:
+        sitio = obtener_sitio(destino.controlador, destino.sitio)
+        if sitio not in sitios:
+            sitios.append(sitio)
+    for sitio in sitios:
+        sitio.cache.precargar()
+
+def estadisticas() -> Dict[str, int]:
+    # Suma de los contadores de las caches de rutas de todos los sitios.
+
+    total: Dict[str, int] = {}
+    with _lock_sitios:
+        sitios = list(_sitios.values())
+    for sitio in sitios:
+        for clave, valor in sitio.cache.estadisticas().items():
+            total[clave] = total.get(clave, 0) + valor
+    total["sitios"] = len(sitios)
+    return total
+
+@metricas.medir('get_traffic_routes')
+def get_traffic_routes(sitio: Optional[SitioUnifi] = None):
+    # Obtiene todas las reglas PBR configuradas en el sitio de Unifi.
+
+    sitio = sitio or sitio_por_defecto()
+    try:
+        response = sitio.sesion.get(sitio.url_rutas, headers=sitio.cabeceras())
+        if response.status_code == 200:
+            rutas = response.json()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Obteniendo las PBR en Unifi: %s - status: %s\n\n%s\n.", sitio, response.status_code, volcar(rutas))
+            return rutas
+        else:
+            logger.error(f"Error al obtener las PBR en Unifi: {sitio} {response.status_code} - {response.text}.")
+            return []
+    except requests.RequestException:
+        return []
+
+@metricas.medir('update_traffic_route_status')
+def update_traffic_route_status(route_data, enabled=False, sitio: Optional[SitioUnifi] = None):
+
+    sitio = sitio or sitio_por_defecto()
+    url = f"{sitio.url_rutas}/{route_data['_id']}"
+    headers = dict(sitio.cabeceras(), **{"Content-Type": "application/json"})
+
+    payload = route_data.copy()
+    payload['enabled'] = enabled
+
+    try:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Enviando petición PUT a %s con datos:\n%s.", url, volcar(payload))
+
+        update_response = sitio.sesion.put(
+            url,
+            headers=headers,
+            json=payload,
+            allow_redirects=True
+        )
+
+        # response.text decodifica todo el cuerpo: solo si se va a escribir
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Respuesta del servidor (%s):\n%s.", update_response.status_code, volcar(update_response.text))
+
+        if update_response.status_code == 200:
+            logger.debug("Aplicado cambio en la PBR %s en Unifi %s.", route_data['description'], sitio)
+            return True, update_response.json()
+        else:
+            error_msg = f"Error al aplicar cambio en la PBR {route_data['description']} en Unifi {sitio}. Status: {update_response.status_code}. Respuesta: {update_response.text}."
+            logger.error(error_msg)
+            return False, {"error": error_msg, "status_code": update_response.status_code}
+    except requests.RequestException as e:
+        error_msg = f"Excepción al actualizar PBR {route_data['description']}: {str(e)}."
+        logger.error(error_msg)
+        return False, {"error": error_msg}
+
+def cambiar_estado_ruta(descripcion: str, enabled: bool, sitio: Optional[SitioUnifi] = None,
+                        desde: Optional[float] = None) -> Tuple[Optional[bool], Dict[str, Any]]:
+    # Activa o desactiva la ruta con un PUT al _id del índice, revalidado (condicional si Unifi
+    # devuelve ETag) si se cargó antes de desde. Si Unifi responde 404 la ruta se ha recreado o
+    # borrado: se vuelve a descargar el listado y se reintenta una vez.
+    # El PUT se envía aunque el índice ya muestre el estado deseado: el índice es de este worker y
+    # puede no reflejar los cambios de otros workers o hechos a mano, y repetir el PUT no cambia nada.
+    # Devuelve (None, {}) si la ruta no existe.
+
+    sitio = sitio or sitio_por_defecto()
+    desde = time.monotonic() if desde is None else desde
+    try:
+        ruta = sitio.cache.obtener(descripcion, desde=desde)
+    except requests.RequestException as e:
+        return False, {"error": f"Error al obtener las PBR en Unifi: {str(e)}."}
+    if ruta is None:
+        return None, {}
+
+    success, respuesta = update_traffic_route_status(ruta, enabled, sitio)
+    if not success and respuesta.get("status_code") == 404:
+        logger.info(f"La PBR {descripcion} ya no existe con el _id {ruta['_id']}. Recargando rutas de Unifi {sitio}.")
+        try:
+            ruta = sitio.cache.obtener(descripcion, forzar=True)
+        except requests.RequestException as e:
+            return False, {"error": f"Error al obtener las PBR en Unifi: {str(e)}."}
+        if ruta is None:
+            return None, {}
+        success, respuesta = update_traffic_route_status(ruta, enabled, sitio)
+
+    if success and isinstance(respuesta, dict):
+        sitio.cache.actualizar(respuesta)
+    return success, respuesta
+
+def _cambiar_destino(destino: Destino, enabled: bool, desde: float) -> Dict[str, Any]:
+
+    sitio = obtener_sitio(destino.controlador, destino.sitio)
+    action_msg = 'activada' if enabled else 'desactivada'
+    with metricas.etiquetas(ruta=destino.ruta), \
+            trazas.span("unifi_ruta", ruta=destino.ruta, sitio=destino.sitio, controlador=destino.controlador.nombre) as s:
+        try:
+            success, _ = cambiar_estado_ruta(destino.ruta, enabled, sitio, desde)
+        except Exception as e:
+            success, error = False, str(e)
+        else:
+            error = None
+        s.atributo("enabled", enabled)
+        if not success:
+            s.marcar_error(error or ("Regla no encontrada" if success is None else "Error al aplicar el cambio"))
+
+    if success is None:
+        mensaje = f"No se encontró la regla: {destino.ruta}"
+    elif success:
+        mensaje = f"Regla '{destino.ruta}' {action_msg} correctamente"
+    else:
+        mensaje = f"Error al {action_msg} la regla '{destino.ruta}'" + (f": {error}" if error else "")
+
+    if success:
+        logger.info(f"{mensaje} en Unifi {sitio}")
+    else:
+        logger.error(f"{mensaje} en Unifi {sitio}")
+    return dict(destino.to_dict(), url=destino.controlador.url, processed=bool(success), message=mensaje)
+
+def _diferencia_destino(destino: Destino, enabled: bool) -> Tuple[str, Optional[Dict[str, Any]]]:
+    # Compara la ruta del índice cacheado con el estado deseado, sin escribir nada. Devuelve la acción
+    # ('actualizar', 'sin_cambios', 'no_encontrada' o 'error') y la ruta cacheada.
+
+    sitio = obtener_sitio(destino.controlador, destino.sitio)
+    try:
+        ruta = sitio.cache.obtener(destino.ruta)
+    except requests.RequestException as e:
+        logger.error(f"Error al obtener las PBR en Unifi {sitio}: {e}")
+        return 'error', None
+    if ruta is None:
+        return 'no_encontrada', None
+    return ('sin_cambios' if ruta.get('enabled') == enabled else 'actualizar'), ruta
+
+def destinos_con_deriva(destinos: List[Destino], enabled: bool) -> List[Destino]:
+    # Rutas cuyo estado en el índice cacheado de su sitio no coincide con el deseado.
+
+    con_deriva = []
+    for destino in destinos:
+        accion, ruta = _diferencia_destino(destino, enabled)
+        if accion == 'actualizar':
+            sitio = obtener_sitio(destino.controlador, destino.sitio)
+            logger.warning(f"La regla '{destino.ruta}' de Unifi {sitio} está {'activada' if ruta.get('enabled') else 'desactivada'} y debería estar {'activada' if enabled else 'desactivada'}")
+            con_deriva.append(destino)
+    return con_deriva
+
+def planificar_destinos(destinos: List[Destino], enabled: bool) -> Dict[str, Any]:
+    # Reglas que cambiaría cambiar_estado_destinos y llamadas necesarias, sin hacer ningún PUT.
+
+    reglas = []
+    for destino in destinos:
+        accion, ruta = _diferencia_destino(destino, enabled)
+        reglas.append(dict(destino.to_dict(), url=destino.controlador.url, accion=accion,
+                           actual=ruta.get('enabled') if ruta else None, deseado=enabled))
+
+    # La ejecución real envía un PUT a cada regla encontrada, también a las que ya están bien
+    escrituras = sum(1 for regla in reglas if regla["accion"] in ('actualizar', 'sin_cambios'))
+    return {
+        "reglas": reglas,
+        "resumen": {accion: sum(1 for regla in reglas if regla["accion"] == accion)
+                    for accion in ('actualizar', 'sin_cambios', 'no_encontrada', 'error')},
+        "llamadas": {"escrituras": escrituras},
+        "tiempo_estimado": metricas.estimar_segundos('update_traffic_route_status', escrituras,
+                                                     CONCURRENCIA_RUTAS, LATENCIA_ESCRITURA_POR_DEFECTO),
+    }
+
+def cambiar_estado_destinos(destinos: List[Destino], enabled: bool) -> List[Dict[str, Any]]:
+    # Aplica el estado a todas las rutas en paralelo y devuelve el resultado de cada una en el mismo orden.
+
+    # El índice de cada sitio se revalida una vez en este evento antes de los PUT
+    desde = time.monotonic()
+    if len(destinos) == 1:
+        return [_cambiar_destino(destinos[0], enabled, desde)]
+
+    futuros = [
+        _executor.submit(contextvars.copy_context().run, _cambiar_destino, destino, enabled, desde)
+        for destino in destinos
+    ]
+    return [futuro.result() for futuro in futuros]
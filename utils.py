@@ -1,10 +1,16 @@
+import atexit
 import contextvars
+import copy
+import json
 import logging
-import random
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Optional
 
 from colorama import Fore, Style, init
 
-from config import DEBUG
+from config import DEBUG, LOG_ASINCRONO, LOG_JSON, LOG_MAX_PAYLOAD
 
 # Inicializar colorama
 # Asegura que los códigos ANSI no se eliminen en macOS.
@@ -18,17 +24,103 @@ COLORS = {
     logging.CRITICAL: Fore.RED + Style.BRIGHT,
 }
 
+FORMATO = "[%(asctime)s] [%(trace_id)s] [%(levelname)s] %(message)s"
+FORMATO_FECHA = "%d-%m-%Y %H:%M:%S"
+
+# Trace de la operación en curso, lo fija trazas.span
 trace_id_var = contextvars.ContextVar("trace_id")
 class TraceIdFilter(logging.Filter):
     def filter(self, record):
         record.trace_id = trace_id_var.get("----")
         return True
 class ColoredFormatter(logging.Formatter):
-    def format(self, record):
-        # Aplicar color según el nivel del log
+    def formatMessage(self, record):
+        # Aplicar color según el nivel del log solo al texto formateado: el registro lo comparten
+        # todos los handlers y no se modifica
         color = COLORS.get(record.levelno, Fore.WHITE)
-        record.msg = f"{color}{record.msg}{Style.RESET_ALL}"
-        return super().format(record)
+        mensaje = record.message
+        record.message = f"{color}{mensaje}{Style.RESET_ALL}"
+        try:
+            return super().formatMessage(record)
+        finally:
+            record.message = mensaje
+
+class JsonFormatter(logging.Formatter):
+    # Una línea JSON por registro, sin colores, para recolectores de logs (LOG_JSON=1).
+
+    def format(self, record):
+        datos = {
+            "timestamp": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "trace_id": getattr(record, 'trace_id', '----'),
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            datos["exception"] = record.exc_text
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+class ManejadorCola(QueueHandler):
+    # Como QueueHandler, pero deja la traza de la excepción en exc_text en lugar de unirla al
+    # mensaje, para que el formateador de salida (texto o JSON) la trate por separado.
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or _formateador_excepciones.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_formateador_excepciones = logging.Formatter()
+_lock = threading.Lock()
+_cola: "queue.SimpleQueue" = queue.SimpleQueue()
+_listener: Optional[QueueListener] = None
+
+def _handler_salida() -> logging.Handler:
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if LOG_JSON else ColoredFormatter(FORMATO, datefmt=FORMATO_FECHA))
+    return handler
+
+def _crear_handler() -> logging.Handler:
+    # Con LOG_ASINCRONO los registros pasan por una cola y un único hilo los escribe, así la
+    # escritura en stderr nunca bloquea el hilo que atiende la petición.
+
+    global _listener
+    if not LOG_ASINCRONO:
+        handler = _handler_salida()
+    else:
+        with _lock:
+            if _listener is None:
+                _listener = QueueListener(_cola, _handler_salida())
+                _listener.start()
+                # Al salir se escriben los registros que queden en la cola
+                atexit.register(_listener.stop)
+        handler = ManejadorCola(_cola)
+    # El trace_id se toma en el hilo que genera el registro, antes de encolarlo
+    handler.addFilter(TraceIdFilter())
+    return handler
+
+def volcar(datos: Any, indent: Optional[int] = 4) -> str:
+    # Serializa un payload para el log de depuración, recortado a LOG_MAX_PAYLOAD caracteres.
+    # Llamar solo si el nivel DEBUG está activo: logger.isEnabledFor(logging.DEBUG).
+
+    if isinstance(datos, (bytes, bytearray)):
+        datos = datos.decode('utf-8', errors='replace')
+    if isinstance(datos, str):
+        texto = datos
+    else:
+        try:
+            texto = json.dumps(datos, indent=indent, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            texto = repr(datos)
+    if LOG_MAX_PAYLOAD > 0 and len(texto) > LOG_MAX_PAYLOAD:
+        return f"{texto[:LOG_MAX_PAYLOAD]}... ({len(texto) - LOG_MAX_PAYLOAD} caracteres más)"
+    return texto
 
 def setup_logger(name: str):
     logger = logging.getLogger(name)
@@ -36,11 +128,7 @@ def setup_logger(name: str):
     logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
 
     if not logger.hasHandlers():
-        handler = logging.StreamHandler()
-        formatter = ColoredFormatter("[%(asctime)s] [%(trace_id)s] [%(levelname)s] %(message)s", datefmt="%d-%m-%Y %H:%M:%S")
-        handler.setFormatter(formatter)
-        handler.addFilter(TraceIdFilter())
-        logger.addHandler(handler)
+        logger.addHandler(_crear_handler())
 
     # Control exhaustivo de librerías de terceros
     third_party_loggers = [
@@ -58,6 +146,3 @@ def setup_logger(name: str):
 
     return logger
 
-def generate_trace_id():
-    trace_id_var.set(random.randint(1000, 9999))
-
@@ -0,0 +1,128 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import trazas
+from cloudflare_zones import procesar_zonas
+from config import VIGILANCIA_IP_INTERVALO, check_cloudflare_config
+from ip_info import comprobar_ip_publica
+from metricas import IP_CAMBIOS, IP_DETECCION_SEGUNDOS, IP_PROPAGACION_SEGUNDOS
+from plan_zonas import OperacionZona, obtener_plan
+from reconciliador import bloqueo_transiciones, estados_vigentes, registros_por_estado
+from utils import setup_logger
+
+logger = setup_logger(__name__)
+
+class VigilanteIP:
+    # Mientras algún monitor está en DOWN (WAN de respaldo) comprueba la IP pública cada cierto tiempo
+    # y, si cambia, vuelve a aplicar solo los registros con cambiar_ip de esos monitores. Con todos
+    # los monitores en UP no hace ninguna consulta.
+
+    def __init__(self, intervalo: int):
+        self.intervalo = intervalo
+        self.comprobaciones = 0
+        self.cambios = 0
+        self.errores = 0
+        # Versión -> (ip, última vez que se ha visto)
+        self._ultima: Dict[int, Tuple[str, float]] = {}
+        self._hilo: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def iniciar(self):
+
+        with self._lock:
+            if self._hilo is not None or self.intervalo <= 0:
+                return
+            self._hilo = threading.Thread(target=self._bucle, name="vigilante_ip", daemon=True)
+            self._hilo.start()
+        logger.info(f"Vigilancia de la IP pública activada cada {self.intervalo} segundos con la WAN de respaldo")
+
+    def _bucle(self):
+
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                with trazas.span("vigilancia_ip"):
+                    self.comprobar()
+            except Exception as e:
+                with self._lock:
+                    self.errores += 1
+                logger.error(f"Error al vigilar la IP pública: {e}")
+
+    def comprobar(self):
+
+        if not check_cloudflare_config()[0]:
+            return
+        plan = obtener_plan()
+        if plan is None:
+            return
+
+        estados = estados_vigentes()
+        con_ip = [op for op in plan.operaciones if op.necesita_ip]
+        caidos = registros_por_estado(estados, {op.clave[2] for op in con_ip})[True]
+        if not caidos:
+            # Sin monitores en DOWN la próxima caída empieza sin IP de referencia
+            self._ultima.clear()
+            return
+
+        versiones = sorted({6 if op.tipo == 'AAAA' else 4 for op in con_ip if op.clave[2] in caidos})
+        cambios: List[Tuple[int, str, float, bool]] = []
+        for version in versiones:
+            ip = comprobar_ip_publica(version)
+            ahora = time.time()
+            with self._lock:
+                self.comprobaciones += 1
+                if not ip:
+                    self.errores += 1
+                    continue
+
+            anterior = self._ultima.get(version)
+            if anterior and anterior[0] == ip:
+                self._ultima[version] = (ip, ahora)
+                continue
+            if anterior:
+                logger.warning(f"La IP pública (IPv{version}) ha cambiado de {anterior[0]} a {ip} con la WAN de respaldo")
+                IP_DETECCION_SEGUNDOS.labels(version=str(version)).observe(ahora - anterior[1])
+            # La primera IP de una caída también se aplica por si cambió antes de empezar a vigilar
+            cambios.append((version, ip, ahora, anterior is not None))
+
+        if cambios:
+            self._aplicar(estados, caidos, con_ip, cambios)
+
+    def _aplicar(self, estados: Dict[str, Dict[str, Any]], caidos: Set[str], con_ip: List[OperacionZona],
+                 cambios: List[Tuple[int, str, float, bool]]):
+
+        tipos = {'AAAA' if version == 6 else 'A' for version, _, _, _ in cambios}
+        registros = {op.clave[2] for op in con_ip if op.clave[2] in caidos and op.tipo in tipos}
+        ip_v4 = next((ip for version, ip, _, _ in cambios if version == 4), None)
+
+        with bloqueo_transiciones(estados, "vigilante_ip") as motivo:
+            # Sin actualizar la IP de referencia para volver a intentarlo en la siguiente comprobación
+            if motivo:
+                logger.debug(f"Actualización por cambio de IP aplazada: {motivo}")
+                return
+            if not procesar_zonas('activado', ip_v4, registros):
+                return
+
+        for version, ip, detectado, cambio in cambios:
+            self._ultima[version] = (ip, detectado)
+            if cambio:
+                IP_CAMBIOS.labels(version=str(version)).inc()
+                IP_PROPAGACION_SEGUNDOS.labels(version=str(version)).observe(time.time() - detectado)
+                with self._lock:
+                    self.cambios += 1
+                logger.info(f"Registros con cambiar_ip actualizados a la nueva IP pública {ip}")
+
+    def estadisticas(self) -> Dict[str, Any]:
+
+        with self._lock:
+            return {
+                "intervalo": self.intervalo,
+                "comprobaciones": self.comprobaciones,
+                "cambios": self.cambios,
+                "errores": self.errores,
+                "ip_v4": self._ultima.get(4, (None,))[0],
+                "ip_v6": self._ultima.get(6, (None,))[0],
+            }
+
+vigilante_ip = VigilanteIP(VIGILANCIA_IP_INTERVALO)